@@ -1,21 +1,24 @@
 import datetime
 import os
-import json
 
 def open_makedirs(filename, *args, **kwargs):
     """ Open file, creating the parent directories if neccesary. """
     os.makedirs(os.path.dirname(filename), exist_ok=True)
     return open(filename, *args, **kwargs)
 
-def grottext(conf, data, jsonmsg) :
+# extension API version 2: grottext(conf, record) 
+grottext_version = 2
+
+def grottext(conf, record) :
     """
     Grot extension to log data to CSV file
     One CSV file per day is saved.
     extvar configuration:
     "outpath": path where to save CSV files, default: "/home/pi/grottlog"
     "csvheader": comma separated string with fields to store, defaults to all available fields
-    Updated: 2022-01-05
-    Version 2.6.1
+    record: processed record (device, time, values, scaled: values with the layout divide factor applied)
+    Updated: 2026-10-18
+    Version 2.6.2
     """
 
     resultcode = 0
@@ -27,13 +30,11 @@ def grottext(conf, data, jsonmsg) :
         ### uncomment this print statements if you want to see the information that is availble.
         ###
 
-        # print(jsonmsg)
-        # print(data)
+        # print(record.json)
+        # print(record.hex)
         # print(dir(conf))
         # print(conf.extvar)
 
-    jsonobj = json.loads(jsonmsg)
-
     try:
         outpath = conf.extvar["outpath"]
     except:
@@ -41,31 +42,22 @@ def grottext(conf, data, jsonmsg) :
     try:
         csvheader = conf.extvar["csvheader"]
     except:
-        csvheader = "device,time," + ",".join(jsonobj["values"].keys())
+        csvheader = "device,time," + ",".join(record.values.keys())
     csventries = [s.strip() for s in csvheader.split(',')]
 
     now = datetime.datetime.now()
     csvfile = os.path.join(outpath, '{0.year}-minute/{0.year}{0.month:02}{0.day:02}.csv'.format(now))
 
     values = {
-        "device":jsonobj["device"],
-        "time":jsonobj["time"],
+        "device":record.device,
+        "time":record.time,
     }
 
-    for key in jsonobj["values"]:
-        # test if there is an divide factor is specifed
-        try:
-            keydivide =  conf.recorddict[conf.layout][key]["divide"]
-        except:
-            keydivide = 1
-
-        if type(jsonobj["values"][key]) != type(str()) and keydivide != 1:
-            values[key] = jsonobj["values"][key]/keydivide
-            if key == "totworktime":
-                # round totworktime a bit so it doesn't take 18 characters
-                values[key] = round(values[key], 2)
-        else:
-            values[key] = jsonobj["values"][key]
+    # values with divide factor applied
+    values.update(record.scaled)
+    if "totworktime" in values and record.divide("totworktime") != 1:
+        # round totworktime a bit so it doesn't take 18 characters
+        values["totworktime"] = round(values["totworktime"], 2)
 
     csvline = ','.join(str(values[k]) for k in csventries) + '\n'
 
@@ -8,7 +8,7 @@ from paho.mqtt.publish import multiple, single
 
 from grottconf import Conf
 
-__version__ = "0.0.7"
+__version__ = "0.0.8"
 __author__ = "Etienne G."
 
 """A plugin for grott
@@ -613,8 +613,12 @@ def publish_multiple(conf: Conf, msgs):
     return multiple(msgs, **conf)
 
 
+# Extension API version 2: grott passes the processed record instead of a JSON string
+grottext_version = 2
+
+
 # Must be defined. This allows grott to call the function as a plugin
-def grottext(conf: Conf, data: str, jsonmsg: str):
+def grottext(conf: Conf, record):
     """Allow pushing to HA MQTT bus, with auto discovery"""
 
     required_params = [
@@ -625,17 +629,15 @@ def grottext(conf: Conf, data: str, jsonmsg: str):
         print("Missing configuration for ha_mqtt")
         return 1
 
-    # Need to decode the json string
-    jsonmsg = json.loads(jsonmsg)
-
-    if jsonmsg.get("buffered") == "yes":
+    if record.buffered == "yes":
         # Skip buffered message, HA don't support them
         if conf.verbose:
             print("\t - Grott HA - skipped buffered")
         return 5
 
-    device_serial = jsonmsg["device"]
-    values = jsonmsg["values"]
+    device_serial = record.device
+    # copy, the record is shared with the other outputs
+    values = dict(record.values)
 
     # Send the last push in UTC with TZ
     dt = datetime.now(timezone.utc)
@@ -19,35 +19,49 @@ import sys
 from grottconf import Conf
 from grottproxy import Proxy
 from grottsniffer import Sniff
+from grottreplay import Replay
 
-#proces config file
-conf = Conf(verrel)
+#main (not run when imported, e.g. by the decode worker processes, see grottworker)
+if __name__ == "__main__":
+    #proces config file
+    conf = Conf(verrel)
 
-#print configuration
-if conf.verbose: conf.print()
+    #print configuration
+    if conf.verbose: conf.print()
 
-#To test config only remove # below
-#sys.exit(1)
+    #configuration is not changed at runtime (records can be processed in parallel)
+    conf.freeze()
 
-if conf.mode == 'proxy':
-        proxy = Proxy(conf)
-        try:
-            proxy.main(conf)
-        except KeyboardInterrupt:
-            print("Ctrl C - Stopping server")
+    #To test config only remove # below
+    #sys.exit(1)
+
+    if conf.mode == 'proxy':
+            proxy = Proxy(conf)
+            try:
+                proxy.main(conf)
+            except KeyboardInterrupt:
+                print("Ctrl C - Stopping server")
+                try: 
+                    proxy.on_close(conf)
+                except:     
+                    print("\t - no ports to close")
+                sys.exit(1)
+
+    elif conf.mode == 'sniff':
+            sniff = Sniff(conf)
             try: 
-                proxy.on_close(conf)
-            except:     
-                print("\t - no ports to close")
-            sys.exit(1)
-
-if conf.mode == 'sniff':
-        sniff = Sniff(conf)
-        try: 
-            sniff.main(conf)
-        except KeyboardInterrupt:
-            print("Ctrl C - Stopping server")
-            sys.exit(1)
-
-else:
-    print("- Grott undefined mode")
\ No newline at end of file
+                sniff.main(conf)
+            except KeyboardInterrupt:
+                print("Ctrl C - Stopping server")
+                sys.exit(1)
+
+    elif conf.mode == 'replay':
+            replay = Replay(conf)
+            try: 
+                replay.main(conf)
+            except KeyboardInterrupt:
+                print("Ctrl C - Stopping replay")
+                sys.exit(1)
+
+    else:
+        print("- Grott undefined mode")
\ No newline at end of file
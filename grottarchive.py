@@ -0,0 +1,213 @@
+# grottarchive.py Grott raw record archive
+# Updated: 2026-10-18
+#
+# With archive = True the validated records (as received, still scrambled) are kept in an archive directory, e.g. to
+# decode them again after a layout fix (grottbackfill.py). Every entry has the receive time, datalogger serial, record
+# type and record layout. Entries are collected in memory and written by a background thread as zlib compressed
+# blocks (max archiveflush seconds or 64 KB of records per block) to segment files (a new segment when archivesegment
+# MB is reached). A sqlite index (index.sqlite) has a row per block and datalogger (first and last receive time), so
+# a device / time range is read without scanning the archive.
+
+import atexit
+import collections
+import os
+import sqlite3
+import struct
+import threading
+import time
+import zlib
+
+from grottdata import GrottLayoutCache
+from grottmetrics import metrics
+from grottprotocol import scramble
+
+# block: magic, compressed length, number of entries; entry: receive time, record length, record type, datalogger
+# serial, layout name length (followed by the layout name and the record)
+BLOCK = struct.Struct("<4sII")
+ENTRY = struct.Struct("<dIB10sB")
+MAGIC = b"GRA1"
+BLOCKSIZE = 65536
+INDEX = "index.sqlite"
+
+ArchiveEntry = collections.namedtuple("ArchiveEntry", "received device rectype layout data")
+
+
+def loggerserial(data):
+    # datalogger serial (record bytes 8-18), protocol 05 / 06 records are scrambled
+    serial = scramble(data[:18])[8:18] if data[3] in (5, 6) else bytes(data[8:18])
+    return serial
+
+
+def openindex(path):
+    index = sqlite3.connect(os.path.join(path, INDEX), check_same_thread=False)
+    index.execute("CREATE TABLE IF NOT EXISTS segments (id INTEGER PRIMARY KEY, name TEXT, created REAL)")
+    index.execute("CREATE TABLE IF NOT EXISTS blocks (device TEXT, first REAL, last REAL, segment INTEGER, offset INTEGER, entries INTEGER)")
+    index.execute("CREATE INDEX IF NOT EXISTS blocks_device ON blocks (device, first)")
+    index.execute("CREATE INDEX IF NOT EXISTS blocks_first ON blocks (first)")
+    index.commit()
+    return index
+
+
+class GrottArchive:
+
+    def __init__(self, conf):
+        self.conf = conf
+        self.path = conf.archivedir
+        self.segmentsize = conf.archivesegment * 1000000
+        self.flush = conf.archiveflush
+        self.maxqueue = conf.archivequeue
+        self.entries = []
+        self.size = 0
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.stopped = False
+        self.segment = None                                 # open segment file (a new one is started per run)
+        # own layout cache: the writer thread does not touch the cache (counters, evictions) of the decode path
+        self.layoutcache = GrottLayoutCache(conf, quiet=True) if not conf.compat else None
+
+        os.makedirs(self.path, exist_ok=True)
+        # index connection is only used by the writer thread
+        self.index = openindex(self.path)
+
+        metrics.set("archive_queue_depth", lambda: len(self.entries))
+        self.thread = threading.Thread(target=self.run, name="grottarchive", daemon=True)
+        self.thread.start()
+        atexit.register(self.stop)
+        print("\t - Grott archive started:", self.path)
+
+    def put(self, data, received=None):
+        # queue a record (bytes-like, copied) for the archive, never blocks
+        with self.lock:
+            if len(self.entries) >= self.maxqueue:
+                metrics.inc("archive_dropped")
+                return
+            self.entries.append((time.time() if received is None else received, bytes(data)))
+            self.size += len(data)
+            if self.size >= BLOCKSIZE:
+                self.wakeup.notify()
+
+    def pending(self):
+        return len(self.entries)
+
+    def run(self):
+        stopped = False
+        while not stopped:
+            with self.lock:
+                if self.size < BLOCKSIZE and not self.stopped:
+                    self.wakeup.wait(self.flush)
+                stopped = self.stopped
+                entries, self.entries, self.size = self.entries, [], 0
+            if entries:
+                try:
+                    self.write(entries)
+                except Exception as e:
+                    metrics.inc("archive_errors")
+                    print("\t - Grott archive write error, records not archived :", repr(e))
+        if self.segment is not None:
+            self.segment.close()
+        self.index.close()
+
+    def describe(self, data):
+        # datalogger serial, record type and record layout of a record
+        try:
+            layout = self.layoutcache.resolve(data)[0] if self.layoutcache is not None else "none"
+        except Exception:
+            layout = "none"
+        return loggerserial(data), data[7], layout.encode("ascii", "replace")[:255]
+
+    def write(self, entries):
+        # write entries as compressed block(s) to the segment and add them to the index
+        for first in range(0, len(entries), 10000):
+            chunk = entries[first:first + 10000]
+            parts = []
+            devices = {}
+            for received, data in chunk:
+                serial, rectype, layout = self.describe(data)
+                parts.append(ENTRY.pack(received, len(data), rectype, serial, len(layout)))
+                parts.append(layout)
+                parts.append(data)
+                device = serial.decode("ascii", "replace").rstrip("\x00")
+                if device in devices:
+                    low, high, count = devices[device]
+                    devices[device] = (min(low, received), max(high, received), count + 1)
+                else:
+                    devices[device] = (received, received, 1)
+            compressed = zlib.compress(b"".join(parts), 6)
+
+            segment, offset = self.open()
+            self.segment.write(BLOCK.pack(MAGIC, len(compressed), len(chunk)) + compressed)
+            self.segment.flush()
+            self.index.executemany("INSERT INTO blocks (device, first, last, segment, offset, entries) VALUES (?, ?, ?, ?, ?, ?)",
+                                   [(device, low, high, segment, offset, count) for device, (low, high, count) in devices.items()])
+            self.index.commit()
+            metrics.inc("archive_records", len(chunk))
+            metrics.inc("archive_blocks")
+            metrics.inc("archive_bytes", BLOCK.size + len(compressed))
+
+    def open(self):
+        # current segment (id, write offset), a new segment is started when the segment size is reached
+        if self.segment is not None and self.segment.tell() >= self.segmentsize:
+            self.segment.close()
+            self.segment = None
+        if self.segment is None:
+            cursor = self.index.execute("INSERT INTO segments (name, created) VALUES ('', ?)", (time.time(),))
+            self.segmentid = cursor.lastrowid
+            name = "segment-{:06d}.gra".format(self.segmentid)
+            self.index.execute("UPDATE segments SET name = ? WHERE id = ?", (name, self.segmentid))
+            self.index.commit()
+            self.segment = open(os.path.join(self.path, name), "ab")
+            if self.conf.verbose: print("\t - Grott archive segment started:", name)
+        return self.segmentid, self.segment.tell()
+
+    def stop(self, timeout=10):
+        # let the writer write the queued entries and stop (called at exit)
+        with self.lock:
+            self.stopped = True
+            self.wakeup.notify()
+        self.thread.join(timeout)
+
+
+class GrottArchiveReader:
+    """Read archived records by datalogger serial and receive time range (uses the index, blocks are read directly)."""
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.exists(os.path.join(path, INDEX)):
+            raise FileNotFoundError("no grott archive index in " + path)
+        self.index = openindex(path)
+        self.segments = dict(self.index.execute("SELECT id, name FROM segments"))
+
+    def blocks(self, devices=None, start=None, end=None):
+        # (segment id, offset) of the blocks with entries of the devices (None: all) in the time range, in write order
+        query = "SELECT DISTINCT segment, offset FROM blocks WHERE last >= ? AND first <= ?"
+        args = [start if start is not None else float("-inf"), end if end is not None else float("inf")]
+        if devices:
+            query += " AND device IN (" + ",".join("?" * len(devices)) + ")"
+            args += list(devices)
+        return self.index.execute(query + " ORDER BY segment, offset", args).fetchall()
+
+    def readblock(self, segment, offset, devices=None, start=None, end=None):
+        # entries of a block (list of ArchiveEntry) of the devices (None: all) in the time range
+        with open(os.path.join(self.path, self.segments[segment]), "rb") as segmentfile:
+            segmentfile.seek(offset)
+            magic, length, count = BLOCK.unpack(segmentfile.read(BLOCK.size))
+            if magic != MAGIC:
+                raise ValueError("no archive block at offset {} of {}".format(offset, self.segments[segment]))
+            payload = zlib.decompress(segmentfile.read(length))
+        entries = []
+        pos = 0
+        for i in range(count):
+            received, length, rectype, serial, layoutlength = ENTRY.unpack_from(payload, pos)
+            pos += ENTRY.size
+            layout = payload[pos:pos + layoutlength].decode("ascii", "replace")
+            pos += layoutlength
+            device = serial.decode("ascii", "replace").rstrip("\x00")
+            if (start is None or received >= start) and (end is None or received <= end) and (not devices or device in devices):
+                entries.append(ArchiveEntry(received, device, rectype, layout, payload[pos:pos + length]))
+            pos += length
+        return entries
+
+    def read(self, devices=None, start=None, end=None):
+        # yields the archived records (ArchiveEntry) of the devices (None: all) in the time range
+        for segment, offset in self.blocks(devices, start, end):
+            yield from self.readblock(segment, offset, devices, start, end)
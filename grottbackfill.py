@@ -0,0 +1,221 @@
+# grottbackfill.py Grott archive re-decode (backfill)
+# Updated: 2026-10-18
+#
+# Decodes archived records (see grottarchive, [archive] archive = True) again with the current record layouts, e.g.
+# after a field offset fix in a layout, and writes the result to InfluxDB, CSV files or stdout:
+#
+#   python grottbackfill.py -c grott.ini -s 2025-01-01 -e 2026-01-01 -d DLG1234567 -o influx
+#
+# The archive index selects the blocks with records of the dataloggers (-d, datalogger serial) in the time range
+# (-s, -e: iso date/time in local time or epoch seconds). Worker processes (-p, default one per CPU) read, decompress
+# and decode the blocks (procdata, the archived receive time is used as server time), results are written in archive
+# order. The grott.ini settings are used for decoding (layouts, invtype, timezone); MQTT, PVOutput, extensions and the
+# archive are not used. InfluxDB points are written by the InfluxDB writer (grottinflux) in batches of -b points, CSV
+# output is a file per record layout in the -f directory, stdout output is the MQTT JSON message per line.
+
+import argparse
+import contextlib
+import csv
+import datetime
+import multiprocessing
+import os
+import sys
+import time
+
+# grott modules report (e.g. missing libraries) on stdout, keep stdout for the records (stdout output)
+with contextlib.redirect_stdout(sys.stderr):
+    from grott import verrel
+    from grottarchive import GrottArchiveReader
+    from grottinflux import GrottLineEncoder
+    from grottreplay import waitoutputs
+
+# seconds between progress reports
+REPORTINT = 5.0
+# seconds the InfluxDB writer may not make progress (queue half full, not in backoff) before backfill stops
+STALLTIMEOUT = 60
+
+# outputs not used by backfill (env settings override the ini file)
+DISABLED = ("gpvoutput", "gextension")
+
+
+def loadconf(cfgfile, influx, verbose, batch=None):
+    # grott configuration (ini file, environment) without MQTT, PVOutput and extensions, as non main process (no
+    # archive, own InfluxDB spill file)
+    from grottconf import Conf
+    sys.argv = ["grott", "-nm"] + (["-c", cfgfile] if cfgfile else []) + (["-v"] if verbose else [])
+    for envvar in DISABLED:
+        os.environ[envvar] = "False"
+    if not influx: os.environ["ginflux"] = "False"
+    if batch: os.environ["gifbatch"] = str(batch)
+    stdout, sys.stdout = sys.stdout, sys.stderr
+    try:
+        return Conf(verrel, worker="backfill")
+    finally:
+        sys.stdout = stdout
+
+
+def parsetime(value):
+    # iso date/time (local time) or epoch seconds
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.datetime.fromisoformat(value).timestamp()
+
+
+def influxbusy(sink, maxpending):
+    # InfluxDB writer to wait for: more than maxpending points queued and writing (in backoff the writer does not
+    # empty its queue, the points are spilled)
+    return [sink] if sink.backoff == 0 and sink.pending() > maxpending else []
+
+
+class GrottBackfillSink:
+    """Takes the place of the InfluxDB output in a worker: procdata hands every decoded record to writerecord."""
+
+    def __init__(self):
+        self.records = []
+
+    def writerecord(self, record, measurement):
+        self.records.append((record, measurement))
+        return b""
+
+
+# worker process state: configuration, archive reader, command line arguments, line encoders per layout
+worker = None
+
+
+def workinit(args):
+    global worker
+    if not args.verbose: sys.stdout = open(os.devnull, "w")
+    conf = loadconf(args.config, False, args.verbose)
+    # records are decoded for the influx output, the sink keeps them
+    conf.influx = True
+    conf.ifsink = GrottBackfillSink()
+    conf.freeze()
+    worker = (conf, GrottArchiveReader(args.archivedir), args, {})
+
+
+def decodeblock(block):
+    # decode the selected records of an archive block, returns (records read, decode errors, output items)
+    from grottdata import procdata
+    conf, reader, args, encoders = worker
+    sink = conf.ifsink
+    items = []
+    errors = 0
+    entries = reader.readblock(block[0], block[1], args.device, args.start, args.end)
+    for entry in entries:
+        try:
+            procdata(conf, entry.data, entry.received)
+        except (Exception, SystemExit) as e:
+            errors += 1
+            if args.verbose: print("\t - Grott backfill record processing error : ", repr(e))
+        for record, measurement in sink.records:
+            if args.output == "influx":
+                try:
+                    encoder = encoders[record.layout]
+                except KeyError:
+                    encoder = encoders[record.layout] = GrottLineEncoder(record.reclayout, conf.ifscaled)
+                items.append(encoder.encode(measurement, record.values, record.epoch * 1000000000))
+            elif args.output == "csv":
+                items.append((record.layout, record.time, record.epoch, record.device, record.buffered, record.values))
+            else:
+                items.append(record.json)
+        sink.records.clear()
+    return len(entries), errors, items
+
+
+class GrottCsvOutput:
+    """CSV file per record layout (fields of the first record of a layout as header)."""
+
+    def __init__(self, path):
+        self.path = path
+        self.writers = {}
+        os.makedirs(path, exist_ok=True)
+
+    def write(self, items):
+        for layout, rectime, epoch, device, buffered, values in items:
+            try:
+                output, writer = self.writers[layout]
+            except KeyError:
+                output = open(os.path.join(self.path, layout + ".csv"), "w", newline="")
+                writer = csv.DictWriter(output, ["time", "epoch", "device", "buffered"] + list(values), restval="", extrasaction="ignore")
+                writer.writeheader()
+                self.writers[layout] = (output, writer)
+            row = dict(values)
+            row.update(time=rectime, epoch=epoch, device=device, buffered=buffered)
+            writer.writerow(row)
+
+    def stop(self):
+        for output, writer in self.writers.values():
+            output.close()
+
+
+class GrottStdoutOutput:
+    """MQTT JSON message per line."""
+
+    def write(self, items):
+        sys.stdout.write("".join(item + "\n" for item in items))
+
+    def stop(self):
+        sys.stdout.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='grottbackfill', description="decode archived Growatt records again and write them to InfluxDB, CSV or stdout")
+    parser.add_argument('--version', action='version', version=verrel)
+    parser.add_argument('-c',dest='config',help="set config file if not specified config file is grott.ini",metavar="[config file]")
+    parser.add_argument('-a',dest='archivedir',help="archive directory, if not specified archivedir of .ini file is used",metavar="[archive dir]")
+    parser.add_argument('-d',dest='device',help="datalogger serial(s), if not specified all dataloggers",nargs='+',metavar="[serial]")
+    parser.add_argument('-s',dest='start',help="start time (iso date/time or epoch seconds)",type=parsetime,metavar="[time]")
+    parser.add_argument('-e',dest='end',help="end time (iso date/time or epoch seconds)",type=parsetime,metavar="[time]")
+    parser.add_argument('-o',dest='output',help="output: influx, csv or stdout (default)",choices=("influx", "csv", "stdout"),default="stdout")
+    parser.add_argument('-f',dest='csvdir',help="csv output directory (a file per record layout)",default="grottbackfill",metavar="[dir]")
+    parser.add_argument('-p',dest='processes',help="decode worker processes (default: number of CPUs)",type=int,default=os.cpu_count() or 1)
+    parser.add_argument('-b',dest='batch',help="InfluxDB points per write",type=int,default=5000)
+    parser.add_argument('-v','--verbose',help="set verbose",action='store_true')
+    args = parser.parse_args()
+
+    conf = loadconf(args.config, args.output == "influx", args.verbose, args.batch)
+    if args.archivedir is None: args.archivedir = conf.archivedir
+    if args.output == "influx":
+        if not conf.influx: raise SystemExit("Grott backfill: influx output needs InfluxDB settings ([influx] influx = True)")
+        output = conf.ifsink
+        # keep the InfluxDB writer queue in memory (no spill): wait while it is half full
+        maxpending = max(conf.ifqueue // 2, conf.ifbatch)
+        busy = lambda: influxbusy(output, maxpending)
+    elif args.output == "csv":
+        output = GrottCsvOutput(args.csvdir)
+    else:
+        output = GrottStdoutOutput()
+
+    reader = GrottArchiveReader(args.archivedir)
+    blocks = reader.blocks(args.device, args.start, args.end)
+    print("\nGrott backfill started, archive:", args.archivedir, "blocks:", len(blocks), "output:", args.output, file=sys.stderr)
+
+    started = reported = time.monotonic()
+    records = errors = written = 0
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(max(args.processes, 1), workinit, (args,)) as pool:
+        for read, failed, items in pool.imap(decodeblock, blocks):
+            records += read
+            errors += failed
+            written += len(items)
+            if args.output == "influx":
+                for line in items:
+                    output.write(line)
+                if waitoutputs(busy, STALLTIMEOUT):
+                    raise SystemExit("Grott backfill: InfluxDB writer queue not emptied in {} seconds".format(STALLTIMEOUT))
+            else:
+                output.write(items)
+            now = time.monotonic()
+            if now - reported >= REPORTINT:
+                reported = now
+                print("\t - Grott backfill: {} records, {} written, {:.0f} records/s".format(records, written, records / (now - started)), file=sys.stderr)
+    output.stop()
+
+    elapsed = max(time.monotonic() - started, 1e-6)
+    print("\nGrott backfill ready: {} records read, {} written, {} errors in {:.1f} s ({:.0f} records/s)".format(
+        records, written, errors, elapsed, records / elapsed), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
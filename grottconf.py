@@ -6,18 +6,27 @@
 import configparser, sys, argparse, os, json, io
 import ipaddress
 from os import walk
-from grottdata import format_multi_line, str2bool
+from grottprotocol import FRAME_MAX_LEN, MAX_RECORD_LEN
+from grottdata import format_multi_line, str2bool, GrottLayout, GrottLayoutCache
+from grottmqtt import GrottMqtt
+from grottinflux import GrottInflux
+from grotttime import GrottTimezone
+from grottpvoutput import GrottPvOutput
+from grottplugin import GrottExtensions
+from grottarchive import GrottArchive
 
 class Conf : 
 
-    def __init__(self, vrm): 
+    def __init__(self, vrm, worker=None): 
         self.verrel = vrm
+        self.worker = worker                                                                        #decode worker process index (grottworker), None: main process
 
         #Set default variables 
         self.verbose = False
         self.trace = False
         self.cfgfile = "grott.ini"
         self.minrecl = 100
+        self.maxrecl = FRAME_MAX_LEN                                                                #max record length accepted by the framer (proxy, sniff)
         self.decrypt = True
         self.compat = False
         self.invtype = "default"                                                                    #specify sepcial invertype default (spf, sph)
@@ -30,14 +39,28 @@ class Conf :
         self.valueoffset = 6 
         self.inverterid = "automatic" 
         self.mode = "proxy"
+        self.replayfiles = []                                                                       #replay mode: pcap / pcapng files (command line -r)
         self.grottport = 5279
         self.grottip = "default"                                                                    #connect to server IP adress     
         self.outfile ="sys.stdout"  
-        self.tmzone = "local"                                                                       #set timezone (at this moment only used for influxdb)                
+        self.tmzone = "local"                                                                       #set timezone (record date/time to UTC, server time for records without date)                
+        self.procqueue = 1000                                                                       #proxy processing queue size (0 = unbounded)
+        self.procdrop = "oldest"                                                                    #processing queue full: drop oldest / newest record or block 
+        self.procworkers = 1                                                                        #proxy processing threads (0 = process in proxy loop)
+        self.procprocesses = 0                                                                      #proxy decode worker processes (0 = threads, procworkers, are used)
+        self.metricsint = 0                                                                         #print metrics every metricsint seconds (0 = disabled)
+        self.sniffring = False                                                                      #sniff mode: capture with a TPACKET_V3 mmap ring (linux)
+        self.sniffringblocks = 16                                                                   #sniff mode: ring size in blocks of 1 MB
 
         #Growatt server default 
         self.growattip = "47.91.67.66"
         self.growattport = 5279
+        self.growatttimeout = 5.0                                                                   #connect timeout (seconds) 
+        self.growattretries = 2                                                                     #connect retries after a failed / timed out connect
+        self.spool = False                                                                          #offline mode: ack and spool records if Growatt server is not reachable
+        self.spoolfile = "grottspool.dat"
+        self.spoolrate = 2.0                                                                        #replay rate (records per second)
+        self.spoolretry = 60                                                                        #seconds between replay attempts
 
         #MQTT default
         self.mqttip = "localhost"
@@ -51,11 +74,15 @@ class Conf :
         self.mqttuser = "grott"
         self.mqttpsw = "growatt2020"
         self.mqttretain = False
+        self.mqttqos = 0
+        self.mqttqueue = 1000                                                                       #outbound message queue size (oldest dropped if full)
+        self.mqttclientid = "auto"                                                                  #auto: grott-<hostname>-<pid> (unique per process)
+        self.mqttsink = None
 
         #pvoutput default 
         self.pvoutput = False
         self.pvinverters = 1
-        self.pvurl = "https://pvoutput.org/service/r2/addstatus.jsp"
+        self.pvurl = "https://pvoutput.org/service/r2/addbatchstatus.jsp"                           #batch status API
         self.pvapikey = "yourapikey"
         self.pvsystemid = {}
         self.pvinverterid = {}
@@ -64,6 +91,9 @@ class Conf :
         self.pvdisv1 = False
         self.pvtemp = False
         self.pvuplimit = 5
+        self.pvtimeout = 10                                                                         #seconds
+        self.pvqueue = 1000                                                                         #max statuses queued per systemid (oldest dropped)
+        self.pvsink = None
         
         #influxdb default 
         self.influx = False
@@ -76,12 +106,32 @@ class Conf :
         self.iftoken  = "influx_token"
         self.iforg  = "grottorg"
         self.ifbucket = "grottdb" 
+        self.ifbatch = 100                                                                          #points per write
+        self.ifflush = 5.0                                                                          #max seconds a point waits for a (not full) batch
+        self.ifqueue = 10000                                                                        #max points in memory, more are spilled to ifspillfile
+        self.ifspillfile = "grottinflux.dat"
+        self.ifbackoff = 300                                                                        #max seconds between retries after a write error
+        self.ifscaled = False                                                                       #True: fields with divide written as float (value / divide)
+        self.ifsink = None
 
         #extension 
         self.extension = False
         self.extname = "grottext"
         #self.extvar = {"ip": "localhost", "port":8000}  
         self.extvar = {"none": "none"}  
+        self.exttimeout = 10.0                                                                      #max seconds per extension call
+        self.extordered = True                                                                      #True: records delivered one at a time in order
+        self.extworkers = 2                                                                         #parallel calls per extension (extordered = False)
+        self.extqueue = 1000                                                                        #max records queued per extension
+        self.extensions = None
+
+        #raw record archive
+        self.archive = False
+        self.archivedir = "grottarchive"
+        self.archivesegment = 64                                                                    #MB per archive segment file
+        self.archiveflush = 5.0                                                                     #max seconds a record waits before it is written
+        self.archivequeue = 10000                                                                   #max records in memory, more are dropped
+        self.archivesink = None
         
         print("Grott Growatt logging monitor : " + self.verrel)    
 
@@ -99,14 +149,36 @@ class Conf :
         #Process environmental variable to override config and environmental settings
         self.parserset() 
 
+        #decode worker process: own spill file and MQTT client id, no worker processes of its own
+        if self.worker is not None: 
+            self.procprocesses = 0
+            self.ifspillfile = self.ifspillfile + "." + str(self.worker)
+            if self.mqttclientid != "auto": self.mqttclientid = self.mqttclientid + "-" + str(self.worker)
+
         #Prepare invert settings
         self.SN = "".join(['{:02x}'.format(ord(x)) for x in self.inverterid])
         self.offset = 6 
         if self.compat: self.offset = int(self.valueoffset)                                       #set offset for older inverter types or after record change by Growatt
         
+        #resolve timezone (once) 
+        self.tz = GrottTimezone(self.tmzone, self.verbose)
+
         #prepare MQTT security
         if not self.mqttauth: self.pubauth = None
         else: self.pubauth = dict(username=self.mqttuser, password=self.mqttpsw)
+
+        #proxy with decode worker processes: records are processed (MQTT, extensions) by the workers, not here
+        procpool = self.mode == "proxy" and self.procprocesses > 0
+
+        #start MQTT client (one long lived connection, background network loop)
+        if not self.nomqtt and not procpool: self.mqttsink = GrottMqtt(self)
+
+        #start PVOutput sender (batch status API, background thread), main process only: decode workers hand their
+        #statuses to it (grottworker), so pvuplimit holds for all workers together
+        if self.pvoutput and self.worker is None: self.pvsink = GrottPvOutput(self)
+
+        #load extensions (once, every extension runs in its own thread(s))
+        if self.extension and not procpool: self.extensions = GrottExtensions(self)
         
         #define recordlayouts 
         self.set_reclayouts()
@@ -114,6 +186,9 @@ class Conf :
         #define record whitlist (if blocking / filtering enabled 
         self.set_recwl()
 
+        #start raw record archive (main process only, background writer thread)
+        if self.archive and self.worker is None: self.archivesink = GrottArchive(self)
+
         #prepare influxDB
         if self.influx :  
             if self.ifip == "localhost" : self.ifip = '0.0.0.0'
@@ -190,6 +265,18 @@ class Conf :
                     print(e)
                     self.influx = False                       # no influx processing any more till restart (and errors repared)
                     raise SystemExit("Grott Influxdb initialisation error") 
+
+            #start InfluxDB writer (batched, background thread)
+            self.ifsink = GrottInflux(self)
+
+    def freeze(self): 
+        #configuration is read only from here on (runtime), per record state is kept in the record context (grottdata.GrottContext)
+        self.__dict__["frozen"] = True
+
+    def __setattr__(self, name, value): 
+        if self.__dict__.get("frozen", False): 
+            raise AttributeError("Grott configuration is read only at runtime, can not set: " + name)
+        self.__dict__[name] = value
             
     def print(self): 
         print("\nGrott settings:\n")
@@ -199,6 +286,7 @@ class Conf :
         print("\ttrace:               \t",self.trace)
         print("\tconfig file:         \t",self.cfgfile)
         print("\tminrecl:             \t",self.minrecl)
+        print("\tmaxrecl:             \t",self.maxrecl)
         print("\tdecrypt:             \t",self.decrypt)
         print("\tcompat:              \t",self.compat)
         print("\tinvtype:             \t",self.invtype)
@@ -213,8 +301,16 @@ class Conf :
         print("\toffset:              \t",self.offset)
         print("\tinverterid:          \t",self.inverterid)
         print("\tmode:                \t",self.mode)
+        if self.mode == "replay": print("\treplayfiles:         \t",self.replayfiles)
         print("\tgrottip              \t",self.grottip)
         print("\tgrottport            \t",self.grottport)
+        print("\tprocqueue:           \t",self.procqueue)
+        print("\tprocdrop:            \t",self.procdrop)
+        print("\tprocworkers:         \t",self.procworkers)
+        print("\tprocprocesses:       \t",self.procprocesses)
+        print("\tmetricsint:          \t",self.metricsint)
+        print("\tsniffring:           \t",self.sniffring)
+        print("\tsniffringblocks:     \t",self.sniffringblocks)
         #print("\tSN           \t",self.SN)
         print("_MQTT:")
         print("\tnomqtt               \t",self.nomqtt)
@@ -226,17 +322,29 @@ class Conf :
         print("\tmqttinverterintopic: \t",self.mqttinverterintopic)
         print("\tmqtttretain:         \t",self.mqttretain)
         print("\tmqtttauth:           \t",self.mqttauth)
+        print("\tmqttqos:             \t",self.mqttqos)
+        print("\tmqttqueue:           \t",self.mqttqueue)
+        print("\tmqttclientid:        \t",self.mqttclientid)
         print("\tmqttuser:            \t",self.mqttuser)
         print("\tmqttpsw:             \t","**secret**")                       #scramble output if tested!
         #print("\tmqttpsw:     \t",self.mqttpsw)                       #scramble output if tested!
         print("_Growatt server:")
         print("\tgrowattip:           \t",self.growattip)
         print("\tgrowattport:         \t",self.growattport)
+        print("\tgrowatttimeout:      \t",self.growatttimeout)
+        print("\tgrowattretries:      \t",self.growattretries)
+        print("\tspool:               \t",self.spool)
+        print("\tspoolfile:           \t",self.spoolfile)
+        print("\tspoolrate:           \t",self.spoolrate)
+        print("\tspoolretry:          \t",self.spoolretry)
         print("_PVOutput:")
         print("\tpvoutput:            \t",self.pvoutput)
         print("\tpvdisv1:             \t",self.pvdisv1)
         print("\tpvtemp:              \t",self.pvtemp)   
         print("\tpvurl:               \t",self.pvurl)
+        print("\tpvuplimit:           \t",self.pvuplimit)
+        print("\tpvtimeout:           \t",self.pvtimeout)
+        print("\tpvqueue:             \t",self.pvqueue)
         print("\tpvapikey:            \t",self.pvapikey)                
         print("\tpvinverters:         \t",self.pvinverters)
         if self.pvinverters == 1 :
@@ -256,12 +364,28 @@ class Conf :
         print("\torganization:       \t",self.iforg ) 
         print("\tbucket:             \t",self.ifbucket) 
         print("\ttoken:              \t","**secret**")
+        print("\tbatch:              \t",self.ifbatch)
+        print("\tflushinterval:      \t",self.ifflush)
+        print("\tqueue:              \t",self.ifqueue)
+        print("\tspillfile:          \t",self.ifspillfile)
+        print("\tmaxbackoff:         \t",self.ifbackoff)
+        print("\tscaled:             \t",self.ifscaled)
         #print("\ttoken:       \t",self.iftoken)  
         
         print("_Extension:")
         print("\textension:          \t",self.extension) 
         print("\textname:            \t",self.extname)  
         print("\textvar:             \t",self.extvar) 
+        print("\texttimeout:         \t",self.exttimeout) 
+        print("\textordered:         \t",self.extordered) 
+        print("\textworkers:         \t",self.extworkers) 
+        print("\textqueue:           \t",self.extqueue) 
+        print("_Archive:")
+        print("\tarchive:            \t",self.archive) 
+        print("\tarchivedir:         \t",self.archivedir) 
+        print("\tsegment:            \t",self.archivesegment) 
+        print("\tflushinterval:      \t",self.archiveflush) 
+        print("\tqueue:              \t",self.archivequeue) 
          
         print()
 
@@ -273,7 +397,8 @@ class Conf :
         parser.add_argument('--version', action='version', version=self.verrel)
         parser.add_argument('-c',help="set config file if not specified config file is grott.ini",metavar="[config file]")
         parser.add_argument('-o',help="set output file, if not specified output is stdout",metavar="[output file]")
-        parser.add_argument('-m',help="set mode (sniff or proxy), if not specified mode is sniff",metavar="[mode]")
+        parser.add_argument('-m','--mode',dest='m',help="set mode (sniff, proxy or replay), if not specified mode is sniff",metavar="[mode]")
+        parser.add_argument('-r','--replay',help="replay mode: pcap / pcapng file(s) to process",nargs='+',metavar="[capture file]")
         parser.add_argument('-i',help="set inverterid, if not specified inverterid of .ini file is used",metavar="[inverterid]")
         parser.add_argument('-nm','--nomqtt',help="disable mqtt send",action='store_true')
         parser.add_argument('-t','--trace',help="enable trace, use in addition to verbose option (only available in sniff mode)",action='store_true')
@@ -298,8 +423,11 @@ class Conf :
             #print("mode: ",args.m)
             if (args.m == "proxy") : 
                 self.amode = "proxy"
+            elif (args.m == "replay") : 
+                self.amode = "replay"
             else :
                 self.amode = "sniff"                                        # default
+        if (args.replay != None) : self.replayfiles = args.replay
         if (args.i != None and args.i != "none") :                          # added none for docker support 
             self.ainverterid = args.i             
 
@@ -339,6 +467,11 @@ class Conf :
         self.blockcmd = str2bool(self.blockcmd)     
         self.noipf = str2bool(self.noipf) 
         self.sendbuf = str2bool(self.sendbuf)      
+        self.spool = str2bool(self.spool)
+        self.sniffring = str2bool(self.sniffring)
+        if self.procdrop not in ("oldest", "newest", "block") : 
+            print("\nGrott invalid procdrop specified, oldest used") 
+            self.procdrop = "oldest"
         #
         self.nomqtt = str2bool(self.nomqtt)        
         self.mqttmtopic = str2bool(self.mqttmtopic)        
@@ -351,13 +484,17 @@ class Conf :
         # 
         self.influx = str2bool(self.influx)
         self.influx2 = str2bool(self.influx2)
+        self.ifscaled = str2bool(self.ifscaled)
         self.extension = str2bool(self.extension)
+        self.extordered = str2bool(self.extordered)
+        self.archive = str2bool(self.archive)
                
     def procconf(self): 
         print("\nGrott process configuration file")
         config = configparser.ConfigParser()
         config.read(self.cfgfile)
         if config.has_option("Generic","minrecl"): self.minrecl = config.getint("Generic","minrecl")
+        if config.has_option("Generic","maxrecl"): self.maxrecl = config.getint("Generic","maxrecl")
         if config.has_option("Generic","verbose"): self.verbose = config.getboolean("Generic","verbose")
         if config.has_option("Generic","decrypt"): self.decrypt = config.getboolean("Generic","decrypt")
         if config.has_option("Generic","compat"): self.compat = config.getboolean("Generic","compat")
@@ -374,8 +511,21 @@ class Conf :
         if config.has_option("Generic","ip"): self.grottip = config.get("Generic","ip")
         if config.has_option("Generic","port"): self.grottport = config.getint("Generic","port")
         if config.has_option("Generic","valueoffset"): self.valueoffset = config.get("Generic","valueoffset")
+        if config.has_option("Generic","procqueue"): self.procqueue = config.getint("Generic","procqueue")
+        if config.has_option("Generic","procdrop"): self.procdrop = config.get("Generic","procdrop")
+        if config.has_option("Generic","procworkers"): self.procworkers = config.getint("Generic","procworkers")
+        if config.has_option("Generic","procprocesses"): self.procprocesses = config.getint("Generic","procprocesses")
+        if config.has_option("Generic","metricsint"): self.metricsint = config.getint("Generic","metricsint")
+        if config.has_option("Generic","sniffring"): self.sniffring = config.get("Generic","sniffring")
+        if config.has_option("Generic","sniffringblocks"): self.sniffringblocks = config.getint("Generic","sniffringblocks")
         if config.has_option("Growatt","ip"): self.growattip = config.get("Growatt","ip") 
         if config.has_option("Growatt","port"): self.growattport = config.getint("Growatt","port")
+        if config.has_option("Growatt","connecttimeout"): self.growatttimeout = config.getfloat("Growatt","connecttimeout")
+        if config.has_option("Growatt","connectretries"): self.growattretries = config.getint("Growatt","connectretries")
+        if config.has_option("Growatt","spool"): self.spool = config.get("Growatt","spool")
+        if config.has_option("Growatt","spoolfile"): self.spoolfile = config.get("Growatt","spoolfile")
+        if config.has_option("Growatt","spoolrate"): self.spoolrate = config.getfloat("Growatt","spoolrate")
+        if config.has_option("Growatt","spoolretry"): self.spoolretry = config.getint("Growatt","spoolretry")
         if config.has_option("MQTT","nomqtt"): self.nomqtt = config.get("MQTT","nomqtt")
         if config.has_option("MQTT","ip"): self.mqttip = config.get("MQTT","ip")
         if config.has_option("MQTT","port"): self.mqttport = config.getint("MQTT","port")
@@ -385,6 +535,9 @@ class Conf :
         if config.has_option("MQTT","inverterintopic"): self.mqttinverterintopic = config.getboolean("MQTT","inverterintopic")
         if config.has_option("MQTT","retain"): self.mqttretain = config.getboolean("MQTT","retain")
         if config.has_option("MQTT","auth"): self.mqttauth = config.getboolean("MQTT","auth")
+        if config.has_option("MQTT","qos"): self.mqttqos = config.getint("MQTT","qos")
+        if config.has_option("MQTT","queue"): self.mqttqueue = config.getint("MQTT","queue")
+        if config.has_option("MQTT","clientid"): self.mqttclientid = config.get("MQTT","clientid")
         if config.has_option("MQTT","user"): self.mqttuser = config.get("MQTT","user")
         if config.has_option("MQTT","password"): self.mqttpsw = config.get("MQTT","password")
         if config.has_option("PVOutput","pvoutput"): self.pvoutput = config.get("PVOutput","pvoutput")
@@ -393,6 +546,9 @@ class Conf :
         if config.has_option("PVOutput","pvinverters"): self.pvinverters = config.getint("PVOutput","pvinverters")
         if config.has_option("PVOutput","apikey"): self.pvapikey = config.get("PVOutput","apikey")
         if config.has_option("PVOutput", "pvuplimit"): self.pvuplimit = config.getint("PVOutput", "pvuplimit")
+        if config.has_option("PVOutput","url"): self.pvurl = config.get("PVOutput","url")
+        if config.has_option("PVOutput","timeout"): self.pvtimeout = config.getfloat("PVOutput","timeout")
+        if config.has_option("PVOutput","queue"): self.pvqueue = config.getint("PVOutput","queue")
         # if more inverter are installed at the same interface (shinelink) get systemids
         #if self.pvinverters > 1 : 
         for x in range(self.pvinverters+1) : 
@@ -411,10 +567,26 @@ class Conf :
         if config.has_option("influx","org"): self.iforg = config.get("influx","org")
         if config.has_option("influx","bucket"): self.ifbucket = config.get("influx","bucket")
         if config.has_option("influx","token"): self.iftoken = config.get("influx","token")
+        if config.has_option("influx","batch"): self.ifbatch = config.getint("influx","batch")
+        if config.has_option("influx","flushinterval"): self.ifflush = config.getfloat("influx","flushinterval")
+        if config.has_option("influx","queue"): self.ifqueue = config.getint("influx","queue")
+        if config.has_option("influx","spillfile"): self.ifspillfile = config.get("influx","spillfile")
+        if config.has_option("influx","maxbackoff"): self.ifbackoff = config.getint("influx","maxbackoff")
+        if config.has_option("influx","scaled"): self.ifscaled = config.get("influx","scaled")
         #extensionINFLUX
         if config.has_option("extension","extension"): self.extension = config.get("extension","extension") 
         if config.has_option("extension","extname"): self.extname = config.get("extension","extname") 
         if config.has_option("extension","extvar"): self.extvar = eval(config.get("extension","extvar"))
+        if config.has_option("extension","timeout"): self.exttimeout = config.getfloat("extension","timeout") 
+        if config.has_option("extension","ordered"): self.extordered = config.get("extension","ordered") 
+        if config.has_option("extension","workers"): self.extworkers = config.getint("extension","workers") 
+        if config.has_option("extension","queue"): self.extqueue = config.getint("extension","queue") 
+        #archive
+        if config.has_option("archive","archive"): self.archive = config.get("archive","archive") 
+        if config.has_option("archive","archivedir"): self.archivedir = config.get("archive","archivedir") 
+        if config.has_option("archive","segment"): self.archivesegment = config.getint("archive","segment") 
+        if config.has_option("archive","flushinterval"): self.archiveflush = config.getfloat("archive","flushinterval") 
+        if config.has_option("archive","queue"): self.archivequeue = config.getint("archive","queue") 
 
     def getenv(self, envvar):
         envval = os.getenv(envvar)
@@ -428,6 +600,8 @@ class Conf :
         if os.getenv('gverbose') != None :  self.verbose = self.getenv('verbose')
         if os.getenv('gminrecl') != None : 
             if 0 <= int(os.getenv('gminrecl')) <= 255  :     self.minrecl = self.getenv('gminrecl')
+        if os.getenv('gmaxrecl') != None : 
+            if 100 <= int(os.getenv('gmaxrecl')) <= MAX_RECORD_LEN  :     self.maxrecl = int(self.getenv('gmaxrecl'))
         if os.getenv('gdecrypt') != None : self.decrypt = self.getenv('gdecrypt')
         if os.getenv('gcompat') != None :  self.compat = self.getenv('gcompat')
         if os.getenv('gincludeall') != None :  self.includeall = self.getenv('gincludeall')
@@ -449,6 +623,18 @@ class Conf :
             if 0 <= int(os.getenv('ggrottport')) <= 65535  :  self.grottport = self.getenv('ggrottport')
         if os.getenv('gvalueoffset') != None :     
             if 0 <= int(os.getenv('gvalueoffset')) <= 255  :  self.valueoffset = self.getenv('gvalueoffset')
+        if os.getenv('gprocqueue') != None :     
+            if 0 <= int(os.getenv('gprocqueue')) :  self.procqueue = int(self.getenv('gprocqueue'))
+        if os.getenv('gprocdrop') in ("oldest", "newest", "block") : self.procdrop = self.getenv('gprocdrop')
+        if os.getenv('gprocworkers') != None :     
+            if 0 <= int(os.getenv('gprocworkers')) <= 64 :  self.procworkers = int(self.getenv('gprocworkers'))
+        if os.getenv('gprocprocesses') != None :     
+            if 0 <= int(os.getenv('gprocprocesses')) <= 64 :  self.procprocesses = int(self.getenv('gprocprocesses'))
+        if os.getenv('gmetricsint') != None :     
+            if 0 <= int(os.getenv('gmetricsint')) :  self.metricsint = int(self.getenv('gmetricsint'))
+        if os.getenv('gsniffring') != None :  self.sniffring = self.getenv('gsniffring')
+        if os.getenv('gsniffringblocks') != None :     
+            if 1 <= int(os.getenv('gsniffringblocks')) :  self.sniffringblocks = int(self.getenv('gsniffringblocks'))
         if os.getenv('ggrowattip') != None :    
             try: 
                 ipaddress.ip_address(os.getenv('ggrowattip'))
@@ -459,6 +645,16 @@ class Conf :
             if 0 <= int(os.getenv('ggrowattport')) <= 65535  :  self.growattport = int(self.getenv('ggrowattport'))
             else : 
                if self.verbose : print("\nGrott Growatt server Port address env invalid")   
+        if os.getenv('ggrowatttimeout') != None :     
+            if 0 < float(os.getenv('ggrowatttimeout')) :  self.growatttimeout = float(self.getenv('ggrowatttimeout'))
+        if os.getenv('ggrowattretries') != None :     
+            if 0 <= int(os.getenv('ggrowattretries')) <= 100 :  self.growattretries = int(self.getenv('ggrowattretries'))
+        if os.getenv('gspool') != None : self.spool = self.getenv('gspool')
+        if os.getenv('gspoolfile') != None : self.spoolfile = self.getenv('gspoolfile')
+        if os.getenv('gspoolrate') != None :     
+            if 0 < float(os.getenv('gspoolrate')) :  self.spoolrate = float(self.getenv('gspoolrate'))
+        if os.getenv('gspoolretry') != None :     
+            if 0 < int(os.getenv('gspoolretry')) :  self.spoolretry = int(self.getenv('gspoolretry'))
         #handle mqtt environmentals    
         if os.getenv('gnomqtt') != None :  self.nomqtt = self.getenv('gnomqtt')
         if os.getenv('gmqttip') != None :    
@@ -480,11 +676,20 @@ class Conf :
         if os.getenv('gmqttauth') != None :  self.mqttauth = self.getenv('gmqttauth')
         if os.getenv('gmqttuser') != None :  self.mqttuser = self.getenv('gmqttuser')
         if os.getenv('gmqttpassword') != None : self.mqttpsw = self.getenv('gmqttpassword')
+        if os.getenv('gmqttqos') in ("0", "1", "2") : self.mqttqos = int(self.getenv('gmqttqos'))
+        if os.getenv('gmqttqueue') != None :     
+            if 0 <= int(os.getenv('gmqttqueue')) :  self.mqttqueue = int(self.getenv('gmqttqueue'))
+        if os.getenv('gmqttclientid') != None :  self.mqttclientid = self.getenv('gmqttclientid')
         #Handle PVOutput variables
         if os.getenv('gpvoutput') != None :  self.pvoutput = self.getenv('gpvoutput')
         if os.getenv('gpvtemp') != None :  self.pvtemp = self.getenv('gpvtemp')
         if os.getenv('gpvdisv1') != None :  self.pvdisv1 = self.getenv('gpvdisv1')
         if os.getenv('gpvapikey') != None :  self.pvapikey = self.getenv('gpvapikey')
+        if os.getenv('gpvuplimit') != None :  self.pvuplimit = int(self.getenv('gpvuplimit'))
+        if os.getenv('gpvurl') != None :  self.pvurl = self.getenv('gpvurl')
+        if os.getenv('gpvtimeout') != None :  self.pvtimeout = float(self.getenv('gpvtimeout'))
+        if os.getenv('gpvqueue') != None :     
+            if 0 < int(os.getenv('gpvqueue')) :  self.pvqueue = int(self.getenv('gpvqueue'))
         if os.getenv('gpvinverters') != None :  self.pvinverters = int(self.getenv('gpvinverters'))
         for x in range(self.pvinverters+1) : 
                 if os.getenv('gpvsystemid'+str(x)) != None :  self.pvsystemid[x] = self.getenv('gpvsystemid'+ str(x))
@@ -509,11 +714,33 @@ class Conf :
         if os.getenv('gifpassword') != None :  self.ifpsw = self.getenv('gifpassword')
         if os.getenv('giforg') != None :  self.iforg = self.getenv('giforg')
         if os.getenv('gifbucket') != None :  self.ifbucket = self.getenv('gifbucket')
+        if os.getenv('gifbatch') != None :     
+            if 0 < int(os.getenv('gifbatch')) :  self.ifbatch = int(self.getenv('gifbatch'))
+        if os.getenv('gifflushinterval') != None :  self.ifflush = float(self.getenv('gifflushinterval'))
+        if os.getenv('gifqueue') != None :     
+            if 0 < int(os.getenv('gifqueue')) :  self.ifqueue = int(self.getenv('gifqueue'))
+        if os.getenv('gifspillfile') != None :  self.ifspillfile = self.getenv('gifspillfile')
+        if os.getenv('gifmaxbackoff') != None :  self.ifbackoff = int(self.getenv('gifmaxbackoff'))
+        if os.getenv('gifscaled') != None :  self.ifscaled = self.getenv('gifscaled')
         if os.getenv('giftoken') != None :  self.iftoken = self.getenv('giftoken')
         #Handle Extension
         if os.getenv('gextension') != None :  self.extension = self.getenv('gextension')
         if os.getenv('gextname') != None :  self.extname = self.getenv('gextname')
         if os.getenv('gextvar') != None :  self.extvar = eval(self.getenv('gextvar'))
+        if os.getenv('gexttimeout') != None :  self.exttimeout = float(self.getenv('gexttimeout'))
+        if os.getenv('gextordered') != None :  self.extordered = self.getenv('gextordered')
+        if os.getenv('gextworkers') != None :     
+            if 0 < int(os.getenv('gextworkers')) :  self.extworkers = int(self.getenv('gextworkers'))
+        if os.getenv('gextqueue') != None :     
+            if 0 < int(os.getenv('gextqueue')) :  self.extqueue = int(self.getenv('gextqueue'))
+        #Handle Archive
+        if os.getenv('garchive') != None :  self.archive = self.getenv('garchive')
+        if os.getenv('garchivedir') != None :  self.archivedir = self.getenv('garchivedir')
+        if os.getenv('garchivesegment') != None :     
+            if 0 < int(os.getenv('garchivesegment')) :  self.archivesegment = int(self.getenv('garchivesegment'))
+        if os.getenv('garchiveflush') != None :  self.archiveflush = float(self.getenv('garchiveflush'))
+        if os.getenv('garchivequeue') != None :     
+            if 0 < int(os.getenv('garchivequeue')) :  self.archivequeue = int(self.getenv('garchivequeue'))
         
     def set_recwl(self):    
         #define record that will not be blocked or inspected if blockcmd is specified
@@ -1287,6 +1514,12 @@ class Conf :
                     self.recorddict.update(dicttemp)
                 
                 
+        #compile layouts into field extractors (used by procdata) 
+        self.layouts = {}
+        for key in self.recorddict :
+            self.layouts[key] = GrottLayout(key, self.recorddict[key], self.includeall)
+        self.layoutcache = GrottLayoutCache(self)
+
         if self.verbose: print("\nGrott layout records loaded")
         for key in self.recorddict :
             if self.verbose : print(key, " : ")
@@ -2,76 +2,28 @@
 # Version 2.7.6
 # Updated: 2022-08-27
 
-#import time
-from datetime import datetime, timedelta
-from os import times_result
+from datetime import datetime
 #import pytz
 import time
-import sys
 import struct
 import textwrap
-from itertools import cycle # to support "cycling" the iterator
 import json, codecs
-from typing import Dict
+import threading
 # requests
 
-#import mqtt                       
-import paho.mqtt.publish as publish
 
-
-class GrottPvOutLimit:
-
-    def __init__(self):
-        self.register: Dict[str, int] = {}
-
-    def ok_send(self, pvserial: str, conf) -> bool:
-        now = time.perf_counter()
-        ok = False
-        if self.register.get(pvserial):
-            ok = True if self.register.get(pvserial) + conf.pvuplimit * 60 < now else False
-            if ok:
-                self.register[pvserial] = int(now)
-            else:
-                if conf.verbose: print(f'\t - PVOut: Update refused for {pvserial} due to time limitation')
-        else:
-            self.register.update({pvserial: int(now)})
-            ok = True
-        return ok
-
-
-pvout_limit = GrottPvOutLimit()
+from grottprotocol import decrypt, decrypt_into, MAX_RECORD_LEN
 
 
 # Formats multi-line data
 def format_multi_line(prefix, string, size=80):
     size -= len(prefix)
-    if isinstance(string, bytes):
+    if isinstance(string, (bytes, bytearray, memoryview)):
         string = ''.join(r'\x{:02x}'.format(byte) for byte in string)
         if size % 2:
             size -= 1
     return '\n'.join([prefix + line for line in textwrap.wrap(string, size)])
 
-#decrypt data. 
-def decrypt(decdata) :   
-
-    ndecdata = len(decdata)
-
-    # Create mask and convert to hexadecimal
-    mask = "Growatt"
-    hex_mask = ['{:02x}'.format(ord(x)) for x in mask]    
-    nmask = len(hex_mask)
-
-    #start decrypt routine 
-    unscrambled = list(decdata[0:8])                                            #take unscramble header
-    
-    for i,j in zip(range(0,ndecdata-8),cycle(range(0,nmask))): 
-        unscrambled = unscrambled + [decdata[i+8] ^ int(hex_mask[j],16)]
-    
-    result_string = "".join("{:02x}".format(n) for n in unscrambled)
-    
-    print("\t - " + "Growatt data decrypted V2")   
-    return result_string        
-
 def str2bool(defstr):
     if defstr in ("True", "true", "TRUE", "y", "Y", "yes", "YES", 1, "1") : defret = True 
     if defstr in ("False", "false", "FALSE", "n", "N", "no", "NO", 0, "0") : defret = False 
@@ -79,15 +31,362 @@ def str2bool(defstr):
         return(defret)
     else : return()
 
-def procdata(conf,data):    
+
+# struct codes for the numeric field lengths (in bytes), other lengths are converted with int.from_bytes
+NUMCODES = {1: "B", 2: "H", 4: "I", 8: "Q"}
+NUMXCODES = {1: "b", 2: "h", 4: "i", 8: "q"}
+# layout keywords that are not record fields
+LAYOUTKEYS = ("decrypt", "date", "logstart", "device")
+# record date: year (since 2000), month, day, hour, minute, second bytes
+DATESTRUCT = struct.Struct("6B")
+# days per month (february 29, leap years are tested separately)
+MONTHDAYS = (0, 31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+
+# per thread scratch buffer records are decrypted into (procdata can run in more than one thread)
+_scratch = threading.local()
+
+def scratchbuffer():
+    try:
+        return _scratch.buffer
+    except AttributeError:
+        _scratch.buffer = bytearray(MAX_RECORD_LEN)
+        return _scratch.buffer
+
+
+class GrottLayout:
+    """Record layout (conf.recorddict entry) compiled once into flat field extractors.
+
+    Layout offsets ("value") are positions in the hex string (2 per byte), lengths are in bytes.
+    All byte aligned num/numx/text fields are read with one struct.unpack_from per pass (a pass holds
+    non overlapping fields), the small post-processing loop only touches text, log and irregular fields.
+    """
+
+    def __init__(self, name, layout, includeall=False):
+        self.name = name
+        self.error = None
+
+        try:
+            self.decrypt = str2bool(layout["decrypt"]["value"])
+        except:
+            self.decrypt = True
+        try:
+            self.dateoffset = int(layout["date"]["value"])
+        except:
+            self.dateoffset = 0
+        try:
+            self.logstart = layout["logstart"]["value"]
+        except:
+            self.logstart = None
+        try:
+            self.device = layout["device"]["value"]
+        except:
+            self.device = None
+
+        self.names = []                                     # field names in layout order
+        self.divide = {}                                    # divide factor per field (only if specified)
+        structfields = []                                   # (byte offset, length, struct code, field index)
+        fixups = []                                         # (field index, kind, argument)
+
+        for keyword, field in layout.items():
+            if keyword in LAYOUTKEYS:
+                continue
+            try:
+                if field.get("incl") == "no" and not includeall:
+                    continue
+                keytype = field.get("type", "num")
+                if keytype not in ("num", "numx", "text", "log", "logpos", "logneg"):
+                    continue
+                index = len(self.names)
+                if keytype in ("log", "logpos", "logneg"):
+                    fixups.append((index, keytype, field["pos"] - 1))
+                else:
+                    offset = field["value"]
+                    length = field["length"]
+                    if keytype == "text":
+                        code = str(length) + "s"
+                    elif keytype == "num":
+                        code = NUMCODES.get(length)
+                    else:
+                        code = NUMXCODES.get(length)
+                    if offset % 2 or code is None:
+                        # not byte aligned or uncommon length: convert from the field bytes afterwards
+                        fixups.append((index, "hex", (offset, length, keytype)))
+                    else:
+                        structfields.append((offset // 2, length, code, index))
+                        if keytype == "text":
+                            fixups.append((index, "text", None))
+            except Exception as e:
+                self.error = "invalid layout keyword " + keyword + " : " + repr(e)
+                continue
+            self.names.append(keyword)
+            if "divide" in field:
+                self.divide[keyword] = field["divide"]
+
+        # build struct passes: greedy fill, fields overlapping an earlier field go to a next pass
+        passes = []
+        for offset, length, code, index in sorted(structfields):
+            for spass in passes:
+                if spass["end"] <= offset:
+                    break
+            else:
+                spass = {"end": 0, "fmt": ">", "index": []}
+                passes.append(spass)
+            if offset > spass["end"]:
+                spass["fmt"] += str(offset - spass["end"]) + "x"
+            spass["fmt"] += code
+            spass["end"] = offset + length
+            spass["index"].append(index)
+
+        self.structs = [struct.Struct(spass["fmt"]) for spass in passes]
+        self.span = max([spass["end"] for spass in passes], default=0)
+
+        # position of each field in the concatenated unpack result, log and irregular fields get a placeholder
+        order = [index for spass in passes for index in spass["index"]]
+        position = {index: pos for pos, index in enumerate(order)}
+        placeholder = len(order)
+        self.getter = [position.get(index, placeholder) for index in range(len(self.names))]
+        self.fixups = fixups
+        self.haslog = any(kind in ("log", "logpos", "logneg") for index, kind, arg in fixups)
+
+    def decode(self, plain):
+        # decode all fields from the plain (decrypted) record, returns dict in layout order
+        if self.error:
+            raise ValueError(self.error)
+        raw = []
+        for recstruct in self.structs:
+            raw.extend(recstruct.unpack_from(plain, 0))
+        raw.append(None)
+        values = [raw[pos] for pos in self.getter]
+
+        if self.fixups:
+            logdict = None
+            if self.haslog and self.logstart is not None:
+                logdict = self.logfields(plain)
+            for index, kind, arg in self.fixups:
+                if kind == "text":
+                    values[index] = values[index].decode("utf-8")
+                elif kind == "log":
+                    values[index] = logdict[arg]
+                elif kind == "logpos":
+                    values[index] = logdict[arg] if float(logdict[arg]) > 0 else 0
+                elif kind == "logneg":
+                    values[index] = logdict[arg] if float(logdict[arg]) < 0 else 0
+                else:
+                    values[index] = self.hexfield(plain, *arg)
+
+        return dict(zip(self.names, values))
+
+    def datefields(self, plain):
+        # year, month, day, hour, minute, second of the record date (date keyword)
+        if self.dateoffset % 2:
+            return tuple(self.hexfield(plain, self.dateoffset + 2 * i, 1, "num") for i in range(6))
+        return DATESTRUCT.unpack_from(plain, self.dateoffset // 2)
+
+    def recorddate(self, plain, tz):
+        # record date/time: (datetime, epoch seconds (tz: grotttime.GrottTimezone)), None if not a valid date/time
+        try:
+            year, month, day, hour, minute, second = self.datefields(plain)
+        except (struct.error, ValueError):
+            return None
+        if year > 99 or not 1 <= month <= 12 or not 1 <= day <= MONTHDAYS[month] or hour > 23 or minute > 59 or second > 59:
+            return None
+        if month == 2 and day == 29 and year % 4:
+            # 2000-2099: every 4th year is a leap year
+            return None
+        year += 2000
+        return datetime(year, month, day, hour, minute, second), tz.epoch(year, month, day, hour, minute, second)
+
+    def logfields(self, plain):
+        # comma separated log fields (SDM630 / CHNT smart meter records), CRC excluded
+        try:
+            if self.logstart % 2:
+                return bytes.fromhex(bytes(plain).hex()[self.logstart:len(plain) * 2 - 4]).decode("ASCII").split(",")
+            return bytes(plain[self.logstart // 2:len(plain) - 2]).decode("ASCII").split(",")
+        except:
+            return None
+
+    @staticmethod
+    def hexfield(plain, offset, length, keytype):
+        # field at an odd hex offset or with an uncommon length
+        start = offset // 2
+        hexval = bytes(plain[start:start + length + 1]).hex()[offset % 2:offset % 2 + length * 2]
+        if len(hexval) < length * 2:
+            raise ValueError("field outside record")
+        if keytype == "text":
+            return bytes.fromhex(hexval).decode("utf-8")
+        return int.from_bytes(bytes.fromhex(hexval), "big", signed=(keytype == "numx"))
+
+
+class GrottRecord:
+    """Processed record, handed to the outputs and to extensions (extension API version 2).
+
+    values holds the field values as decoded (integers, text), scaled the numeric values divided by the layout divide
+    factor and json the MQTT message; scaled and json are built on first use and cached.
+    """
+
+    __slots__ = ("device", "time", "epoch", "buffered", "layout", "reclayout", "values", "plain", "_json", "_scaled")
+
+    def __init__(self, device, time, epoch, buffered, layout, reclayout, values, plain=None):
+        self.device = device                                # device id (inverter serial, datalogger serial or layout device)
+        self.time = time                                    # record date/time (local, iso format)
+        self.epoch = epoch                                  # record date/time (epoch seconds)
+        self.buffered = buffered                            # "yes", "no" or "nodetect" (compat)
+        self.layout = layout                                # layout name
+        self.reclayout = reclayout                          # compiled layout (GrottLayout), None in compat mode
+        self.values = values                                # field values (dict, layout order)
+        self.plain = plain                                  # plain (decrypted) record bytes (only kept for extensions)
+        self._json = None
+        self._scaled = None
+
+    @property
+    def json(self):
+        if self._json is None:
+            self._json = json.dumps({"device": self.device, "time": self.time, "buffered": self.buffered, "values": self.values})
+        return self._json
+
+    @property
+    def scaled(self):
+        if self._scaled is None:
+            divide = self.reclayout.divide if self.reclayout is not None else {}
+            self._scaled = {key: value / divide[key] if key in divide and divide[key] != 1 and not isinstance(value, str) else value
+                            for key, value in self.values.items()}
+        return self._scaled
+
+    @property
+    def decrypt(self):
+        # record was decrypted (layout decrypt keyword, default and compat mode: decrypt)
+        return self.reclayout.decrypt if self.reclayout is not None else True
+
+    @property
+    def hex(self):
+        # plain record as hex string (extension API version 1)
+        return self.plain.hex() if self.plain is not None else None
+
+    def divide(self, key):
+        # divide factor of a field (1 if not specified)
+        return self.reclayout.divide.get(key, 1) if self.reclayout is not None else 1
+
+
+class GrottContext:
+    """Per record processing state, kept out of the (shared, read only at runtime) conf so records can be processed
+    at the same time (threads, worker processes)."""
+
+    __slots__ = ("rectype", "layout", "reclayout", "decrypt", "buffered", "inverterserial", "invertertype", "received")
+
+    def __init__(self, conf, data, received=None):
+        # data is bytes-like (memoryview on the receive buffer), only the record type is needed as hex
+        self.rectype = "{:02x}".format(data[7])
+        self.received = received                            # receive time (epoch seconds), None: now
+        self.layout = "none"
+        self.reclayout = None
+        self.inverterserial = None
+        self.invertertype = None
+        # buffer detection nodetect for compat mode, with automatic detection yes or no
+        self.buffered = "nodetect"
+        if conf.compat is False:
+            #resolve layout (cached on header, record length and inverter serial)
+            self.layout, self.reclayout, self.inverterserial, self.invertertype = conf.layoutcache.resolve(data)
+            self.buffered = "yes" if self.rectype == "50" else "no"
+        # compiled layout knows if decrypt keyword is defined, if not defined (or compat mode) default is decrypt
+        self.decrypt = self.reclayout.decrypt if self.reclayout is not None else True
+
+
+class GrottLayoutCache:
+    """Resolve the compiled layout for a record with a single dict lookup.
+
+    Key: (protocol, device byte, record type, extended flag, inverter serial bytes). The serial is only part of the
+    key when an invtypemap is used; it is taken from the (still encrypted) record, for a given header the encrypted
+    bytes map one to one on the plain serial, so no decrypt is needed for a cache hit.
+    """
+
+    def __init__(self, conf, maxsize=1024, quiet=False):
+        self.conf = conf
+        self.verbose = conf.verbose and not quiet           # quiet: no verbose messages (cache not used by procdata)
+        self.maxsize = maxsize
+        self.cache = {}
+        self.hits = 0
+        self.misses = 0
+
+    def resolve(self, data):
+        # returns (layout name, compiled layout or None, inverter serial or None, inverter type)
+        ndata = len(data)
+        is_smart_meter = data[7] in (0x20, 0x1b)
+        extended = ndata > 375 and not is_smart_meter
+        serial = None
+        if self.conf.invtype == "default" and self.conf.invtypemap and ndata > 50 and not is_smart_meter:
+            serial = bytes(data[38:48])
+        key = (data[3], data[6], data[7], extended, serial)
+        try:
+            resolved = self.cache[key]
+            self.hits += 1
+            return resolved
+        except KeyError:
+            self.misses += 1
+
+        resolved = self.lookup(data, is_smart_meter, extended, serial)
+        if len(self.cache) >= self.maxsize:
+            self.cache.clear()
+        self.cache[key] = resolved
+        if self.verbose: print("\t - " + "Grott layout cache miss, hits:", self.hits, "misses:", self.misses)
+        return resolved
+
+    def lookup(self, data, is_smart_meter, extended, serial):
+        conf = self.conf
+        # record layout name: T + protocol + device + record type (+ X for extended, + invtype)
+        devrec = "{:02x}{:02x}".format(data[6], data[7])
+        layout = "T" + "{:02x}".format(data[3]) + devrec
+        #v270 add X for extended except for smart monitor records
+        if extended: layout = layout + "X"
+        #v270 no invtype added to layout for smart monitor records
+        if (conf.invtype != "default") and not is_smart_meter :
+            layout = layout + conf.invtype.upper()
+
+        if self.verbose : print("\t - " + "layout   : ", layout)
+        if layout not in conf.layouts:
+            #try generic if generic record exist
+            if self.verbose : print("\t - " + "no matching record layout found, try generic")
+            if data[7] in (0x04, 0x50) :
+                layout = layout.replace(devrec, "NNNN")
+                if layout not in conf.layouts:
+                    if self.verbose : print("\t - " + "no matching record layout found, standard processing performed")
+                    layout = "none"
+        reclayout = conf.layouts.get(layout)
+
+        # Handle systems with mixed invtype: lookup inverter type based on inverter serial
+        inverterSerial = None
+        inverterType = "default"
+        if serial is not None and reclayout is not None:
+            if reclayout.decrypt:
+                serial = decrypt(data[:48])[38:48]
+            try:
+                inverterSerial = serial.decode('ASCII')
+            except UnicodeDecodeError:
+                # In case of problem (eg: new record type with different serial placement)
+                pass
+            if inverterSerial:
+                inverterType = conf.invtypemap.get(inverterSerial, "default")
+            if inverterType != "default":
+                if layout + inverterType.upper() in conf.layouts:
+                    layout = layout + inverterType.upper()
+                    reclayout = conf.layouts[layout]
+                elif self.verbose:
+                    print("\t - " + "no record layout for inverter type", inverterType, ", layout used:", layout)
+
+        return (layout, reclayout, inverterSerial, inverterType)
+
+
+def procdata(conf,data,received=None):    
+    # received: receive time of the record (epoch seconds, e.g. capture time in replay mode), used as server time
     if conf.verbose: 
         print("\t - " + "Growatt original Data:") 
         print(format_multi_line("\t\t ", data))
 
-    header = "".join("{:02x}".format(n) for n in data[0:8])
     ndata = len(data)
-    buffered = "nodetect"                                               # set buffer detection to nodetect (for compat mode), wil in auto detection changed to no or yes        
-    is_smart_meter = header[14:16] in ("20","1b")
+
+    # per record state (record type, layout, decrypt, buffered) is kept in the record context, conf is not changed
+    ctx = GrottContext(conf, data, received)
+    rectype, layout, reclayout, buffered = ctx.rectype, ctx.layout, ctx.reclayout, ctx.buffered
+    is_smart_meter = rectype in ("20","1b")
 
     # automatic detect protocol (decryption and protocol) only if compat = False!
     novalidrec = False
@@ -95,64 +394,23 @@ def procdata(conf,data):
         if conf.verbose : 
             print("\t - " + "Grott automatic protocol detection")  
             print("\t - " + "Grott data record length", ndata)
-        #print(header)
-        layout = "T" + header[6:8] + header[12:14] + header[14:16]
-        #v270 add X for extended except for smart monitor records
-        if ((ndata > 375) and not is_smart_meter) :  layout = layout + "X"
-
-        #v270 no invtype added to layout for smart monitor records
-        if (conf.invtype != "default") and not is_smart_meter :
-                layout = layout + conf.invtype.upper()
-
-        if header[14:16] == "50" : buffered = "yes"
-        else: buffered = "no" 
-
-        if conf.verbose : print("\t - " + "layout   : ", layout)
-        try:            
-            # does record layout record exists? 
-            test = conf.recorddict[layout]
-        except:
-            #try generic if generic record exist
-            if conf.verbose : print("\t - " + "no matching record layout found, try generic")
-            if header[14:16] in ("04","50") :
-                layout = layout.replace(header[12:16], "NNNN")
-                try:
-                    # does generic record layout record exists? 
-                    test = conf.recorddict[layout]
-                except:
-                    #no valid record fall back on old processing? 
-                    if conf.verbose : print("\t - " + "no matching record layout found, standard processing performed")
-                    layout = "none"
-                    novalidrec = True  
-            else:         
-                novalidrec = True     
-    
-        conf.layout = layout
+        inverterSerial, inverterType = ctx.inverterserial, ctx.invertertype
+        novalidrec = reclayout is None
         if conf.verbose : print("\t - " + "Record layout used : ", layout)
-    
-    #Decrypt 
-    try: 
-        #see if decrypt keyword is defined
-        conf.decrypt =  str2bool(conf.recorddict[layout]["decrypt"]["value"])
-    except:   
-        #if decrypt not defined, default is decypt
-        conf.decrypt = True  
-    
-    if conf.decrypt: 
-        result_string = decrypt(data) 
+
+    if ctx.decrypt: 
+        #decrypt into the (per thread) scratch buffer, plaindata is a memoryview on it
+        plaindata = decrypt_into(data, scratchbuffer())
         if conf.verbose : print("\t - " + "Grott Growatt data decrypted")        
     else: 
         #do not decrypt 
-        result_string = data.hex()
+        plaindata = memoryview(data)
         if conf.verbose: print("\t - " + "Grott Growatt unencrypted data used")                                      
                                                         
     if conf.verbose: 
+        #hex dump only created when asked for
         print("\t - " + 'Growatt plain data:')
-        print(format_multi_line("\t\t ", result_string))
-        #debug only: print(result_string)
-
-    # test position : 
-    # print(result_string.find('0074' ))
+        print(format_multi_line("\t\t ", plaindata.hex()))
 
     # Test length if < 12 it is a data ack record, if novalidrec flag is true it is not a (recognized) data record  
     if ndata < 12 or novalidrec == True: 
@@ -169,180 +427,83 @@ def procdata(conf,data):
     if conf.compat is False: 
         # new method if compat = False (automatic detection):  
        
-        if (conf.invtype == "default") :
-            # Handle systems with mixed invtype
-            if (ndata > 50) and not is_smart_meter:
-                # There is enough data for an inverter serial number
-                inverterType = "default"
-
-                inverterSerial = None
-                try:
-                    inverterSerial = codecs.decode(result_string[76:96], "hex").decode('ASCII')
-                    if conf.verbose:
-                        print("\t - Possible Inverter serial", inverterSerial)
-                except UnicodeDecodeError:
-                    # In case of problem (eg: new record type with different serial placement)
-                    pass
-
-                if inverterSerial:
-                    # Lookup inverter type based on inverter serial
-                    try:
-                        inverterType = conf.invtypemap[inverterSerial]
-                        print("\t - Matched inverter serial to inverter type", inverterType)
-                    except:
-                        inverterType = "default"
-                        print("\t - Inverter serial not recognised - using inverter type", inverterType)
-
-                if (inverterType != "default") :
-                    layout = layout + inverterType.upper()
-                    # Update the conf.layout like done earlier
-                    conf.layout = layout
+        if inverterSerial is not None :
+            # Handle systems with mixed invtype (inverter type resolved with the layout)
+            if conf.verbose:
+                print("\t - Possible Inverter serial", inverterSerial)
+            if inverterType != "default" :
+                print("\t - Matched inverter serial to inverter type", inverterType)
+            else:
+                print("\t - Inverter serial not recognised - using inverter type", inverterType)
 
         if conf.verbose: 
            print("\t - " + 'Growatt new layout processing')
-           print("\t\t - " + "decrypt       : ",conf.decrypt)
+           print("\t\t - " + "decrypt       : ",ctx.decrypt)
            print("\t\t - " + "offset        : ", conf.offset)
            print("\t\t - " + "record layout : ", layout)
            print()
 
         
         
+        #v270 log data record processing (SDM630 smart monitor with railog) included in compiled layout
         try:
-            #v270 try if logstart and log fields are defined, if yes prepare log fields 
-            logstart = conf.recorddict[layout]["logstart"]["value"] 
-            logdict = {}
-            logdict = bytes.fromhex(result_string[conf.recorddict[layout]["logstart"]["value"]:len(result_string)-4]).decode("ASCII").split(",")
-        except:
-            pass
+            definedkey = reclayout.decode(plaindata)
+        except Exception as e:
+            if conf.verbose : print("\t - grottdata - error in keyword processing : ", layout, repr(e) + " ,data processing stopped")
+            return(8)
 
-        #v270 log data record processing (SDM630 smart monitor with railog 
-        #if rectype == "data" : 
-        for keyword in  conf.recorddict[layout].keys() :
-            
-            if keyword not in ("decrypt","date","logstart","device") :  
-                #try if keyword should be included 
-                include=True
-                try:
-                    #try if key type is specified 
-                    if conf.recorddict[layout][keyword]["incl"] == "no" : 
-                        include=False
-                except: 
-                    #no include statement keyword should be process, set include to prevent except errors
-                    include = True
-                #process only keyword needs to be included (default):     
-                try: 
-                    if ((include) or (conf.includeall)): 
-                        try:
-                            #try if key type is specified  
-                            keytype = conf.recorddict[layout][keyword]["type"]           
-                        except: 
-                            #if not default is num
-                            keytype = "num"               
-                        if keytype == "text" :
-                            definedkey[keyword] = result_string[conf.recorddict[layout][keyword]["value"]:conf.recorddict[layout][keyword]["value"]+(conf.recorddict[layout][keyword]["length"]*2)]
-                            definedkey[keyword] = codecs.decode(definedkey[keyword], "hex").decode('utf-8')
-                            #print(definedkey[keyword])
-                        if keytype == "num" :
-                        #else:                    
-                            definedkey[keyword] = int(result_string[conf.recorddict[layout][keyword]["value"]:conf.recorddict[layout][keyword]["value"]+(conf.recorddict[layout][keyword]["length"]*2)],16)                                     
-                        if keytype == "numx" :
-                            #process signed integer 
-                            keybytes = bytes.fromhex(result_string[conf.recorddict[layout][keyword]["value"]:conf.recorddict[layout][keyword]["value"]+(conf.recorddict[layout][keyword]["length"]*2)])
-                            definedkey[keyword] = int.from_bytes(keybytes, byteorder='big', signed=True)
-                        if keytype == "log" :
-                            # Proces log fields
-                            definedkey[keyword] = logdict[conf.recorddict[layout][keyword]["pos"]-1]
-                        if keytype == "logpos" :
-                        #only display this field if positive    
-                            # Proces log fields
-                            if float(logdict[conf.recorddict[layout][keyword]["pos"]-1]) > 0 : 
-                                definedkey[keyword] = logdict[conf.recorddict[layout][keyword]["pos"]-1]
-                            else : definedkey[keyword] = 0
-                        if keytype == "logneg" :
-                        #only display this field if negative    
-                            # Proces log fields
-                            if float(logdict[conf.recorddict[layout][keyword]["pos"]-1]) < 0 : 
-                                definedkey[keyword] = logdict[conf.recorddict[layout][keyword]["pos"]-1]    
-                            else : definedkey[keyword] = 0
-                except: 
-                    if conf.verbose : print("\t - grottdata - error in keyword processing : ", keyword + " ,data processing stopped") 
-                    return(8) 
-                                 
         # test if pvserial was defined, if not take inverterid from config.
         device_defined = False 
-        try:    
-            definedkey["device"] = conf.recorddict[layout]["device"]["value"]
+        if reclayout.device is not None:
+            definedkey["device"] = reclayout.device
             device_defined = True
-        except:         
+        else:
             # test if pvserial was defined, if not take inverterid from config.     
             try: 
                 test = definedkey["pvserial"]
             except: 
                 definedkey["pvserial"] = conf.inverterid
-                conf.recorddict[layout]["pvserial"] = {"value" : 0, "type" : "text"}
                 if conf.verbose : print("\t - pvserial not found and device not specified used configuration defined invertid:", definedkey["pvserial"] ) 
      
         # test if dateoffset is defined, if not take set to 0 (no futher date retrieval processing) . 
-        try: 
-            # test of date is specified in layout
-            dateoffset = int(conf.recorddict[layout]["date"]["value"]) 
-        except:
-            # no date specified, default no date specified
-            dateoffset = 0        
+        # (compiled layout dateoffset is 0 if no date specified) 
+        dateoffset = reclayout.dateoffset
 
         #proces date value if specifed 
         if dateoffset > 0 and (conf.gtime != "server" or buffered == "yes"):
             if conf.verbose: print("\t - " + 'Grott data record date/time processing started')
-            #date
-            pvyearI =  int(result_string[dateoffset:dateoffset+2],16)
-            if pvyearI < 10 : pvyear = "200" + str(pvyearI)
-            else: pvyear = "20" + str(pvyearI) 
-            pvmonthI = int(result_string[dateoffset+2:dateoffset+4],16)
-            if pvmonthI < 10 : pvmonth = "0" + str(pvmonthI)
-            else: pvmonth = str(pvmonthI) 
-            pvdayI = int(result_string[dateoffset+4:dateoffset+6],16)
-            if pvdayI < 10 : pvday = "0" + str(pvdayI)
-            else: pvday = str(pvdayI) 
-            #Time
-            pvhourI = int(result_string[dateoffset+6:dateoffset+8],16)
-            if pvhourI < 10 : pvhour = "0" + str(pvhourI)
-            else: pvhour = str(pvhourI) 
-            pvminuteI = int(result_string[dateoffset+8:dateoffset+10],16)
-            if pvminuteI < 10 : pvminute = "0" + str(pvminuteI)
-            else: pvminute = str(pvminuteI) 
-            pvsecondI = int(result_string[dateoffset+10:dateoffset+12],16)
-            if pvsecondI < 10 : pvsecond = "0" + str(pvsecondI)
-            else: pvsecond = str(pvsecondI) 
-            # create date/time is format
-            pvdate = pvyear + "-" + pvmonth + "-" + pvday + "T" + pvhour + ":" + pvminute + ":" + pvsecond
-            # test if valid date/time in data record
-            try:
-                testdate = datetime.strptime(pvdate, "%Y-%m-%dT%H:%M:%S")
-                jsondate = pvdate
+            #date/time bytes decoded and validated in one pass (datetime and epoch)
+            recdate = reclayout.recorddate(plaindata, conf.tz)
+            if recdate is not None:
+                recdatetime, rectime = recdate
+                jsondate = recdatetime.isoformat()
                 if conf.verbose : print("\t - date-time: ", jsondate) 
                 timefromserver = False                                              # Indicate of date/time is from server (used for buffered data)           
-            except ValueError:
-                # Date could not be parsed - either the format is different or it's not a
-                # valid date
+            else:
+                # no valid date/time in the record
                 if conf.verbose : print("\t - " + "no or no valid time/date found, grott server time will be used (buffer records not sent!)")  
                 timefromserver = True          
-                jsondate = datetime.now().replace(microsecond=0).isoformat()
+                rectime, localtime = conf.tz.now(ctx.received)
+                jsondate = localtime.isoformat()
         else:
             if conf.verbose: print("\t - " + "Grott server date/time used") 
-            jsondate = datetime.now().replace(microsecond=0).isoformat()   
+            rectime, localtime = conf.tz.now(ctx.received)
+            jsondate = localtime.isoformat()   
             timefromserver = True     
 
         dataprocessed = True
 
     else:
-        # old data processing only here for compatibility 
+        # old data processing only here for compatibility (hex string based)
+        result_string = plaindata.hex()
         serialfound = False 
         if(result_string.find(conf.SN) > -1):
             serialfound = True   
 
         if serialfound == True:
             
-            jsondate = datetime.now().replace(microsecond=0).isoformat()
+            rectime, localtime = conf.tz.now(ctx.received)
+            jsondate = localtime.isoformat()
             timefromserver = True 
 
             if conf.verbose: print("\t - " + 'Growatt processing values for: ', bytearray.fromhex(conf.SN).decode())
@@ -408,13 +569,7 @@ def procdata(conf,data):
                 print("\t - " + "Grott values retrieved:")
                 for key in definedkey : 
                     # test if there is an divide factor is specifed 
-                    try:  
-                        #print(keyword)
-                        keydivide =  conf.recorddict[layout][key]["divide"]
-                        #print(keydivide)
-                    except:
-                        #print("error")
-                        keydivide = 1  
+                    keydivide = reclayout.divide.get(key, 1)
         
                     if type(definedkey[key]) != type(str()) and keydivide != 1 :
                         printkey = "{:.1f}".format(definedkey[key]/keydivide)          
@@ -427,7 +582,7 @@ def procdata(conf,data):
         
        
         # filter invalid 0120 record (0 < voltage_l1 > 500 ) 
-        if header[14:16] == "20" :
+        if rectype == "20" :
             if (definedkey["voltage_l1"]/10 > 500) or (definedkey["voltage_l1"]/10 < 0) :
                 print("\t - " + "Grott invalid 0120 record processing stopped") 
                 return 
@@ -440,30 +595,14 @@ def procdata(conf,data):
             deviceid = definedkey["device"]
 
         else : 
-            if header[14:16] not in ("20","1b") :
+            if rectype not in ("20","1b") :
                 deviceid = definedkey["pvserial"]           
             else : 
                 deviceid = definedkey["datalogserial"]
             
-        jsonobj = {
-                        "device" : deviceid,
-                        "time" : jsondate, 
-                        "buffered" : buffered,
-                        "values" : {}
-                    }
-
-        for key in definedkey : 
-
-            #if key != "pvserial" : 
-                #if conf.recorddict[layout][key]["type"] == "num" : 
-                # only add int values to the json object 
-                #print(definedkey[key])
-                #print(type(definedkey[key]))                                 
-                #if type(definedkey[key]) == type(1) :                                                                     
-                #    jsonobj["values"][key] = definedkey[key]
-            jsonobj["values"][key] = definedkey[key]
-                     
-        jsonmsg = json.dumps(jsonobj) 
+        #record object handed to all outputs and extensions, JSON message is created once (and cached)
+        record = GrottRecord(deviceid, jsondate, rectime, buffered, layout, reclayout, definedkey, bytes(plaindata) if conf.extension else None)
+        jsonmsg = record.json
         
         if conf.verbose:
             print("\t - " + "MQTT jsonmsg: ")        
@@ -477,7 +616,7 @@ def procdata(conf,data):
 
         if conf.nomqtt != True:
             #if meter data use mqtttopicname topic
-            if (header[14:16] in ("20","1b")) and (conf.mqttmtopic == True) :
+            if (rectype in ("20","1b")) and (conf.mqttmtopic == True) :
                 mqtttopic = conf.mqttmtopicname 
             else : 
                 #test if invertid needs to be added to topic
@@ -490,22 +629,16 @@ def procdata(conf,data):
                if conf.verbose: print("\t - " + 'Grott MQTT message retain enabled')  
 
             try:
-                #v2.7.1 add retrain variable  
-                publish.single(mqtttopic, payload=jsonmsg, qos=0, retain=conf.mqttretain, hostname=conf.mqttip,port=conf.mqttport, client_id=conf.inverterid, keepalive=60, auth=conf.pubauth)
-                if conf.verbose: print("\t - " + 'MQTT message message sent') 
-            except TimeoutError:     
-                if conf.verbose: print("\t - " + 'MQTT connection time out error') 
-            except ConnectionRefusedError:     
-                if conf.verbose: print("\t - " + 'MQTT connection refused by target')     
+                #v2.7.1 add retrain variable, message is queued and sent by the MQTT client (grottmqtt) 
+                conf.mqttsink.publish(mqtttopic, jsonmsg, conf.mqttretain)
+                if conf.verbose: print("\t - " + 'MQTT message queued') 
             except BaseException as error:     
                 if conf.verbose: print("\t - "+ 'MQTT send failed:', str(error)) 
         else:
             if conf.verbose: print("\t - " + 'No MQTT message sent, MQTT disabled') 
 
-        # process pvoutput if enabled
+        # process pvoutput if enabled (statuses are queued, sent in batches by the PVOutput sender thread, see grottpvoutput)
         if conf.pvoutput :      
-            import requests
- 
             pvidfound = False    
             if  conf.pvinverters == 1 :  
                 pvssid = conf.pvsystemid[1]
@@ -520,21 +653,14 @@ def procdata(conf,data):
             if not pvidfound:
                 if conf.verbose : print("\t - " + "pvsystemid not found for inverter : ", definedkey["pvserial"])   
                 return
-            if not pvout_limit.ok_send(definedkey["pvserial"], conf):
-                # Will print a line for the refusal in verbose mode (see GrottPvOutLimit at the top)
-                return
             if conf.verbose : print("\t - " + "Grott send data to PVOutput systemid: ", pvssid, "for inverter: ", definedkey["pvserial"]) 
-            pvheader = { 
-                "X-Pvoutput-Apikey"     : conf.pvapikey,
-                "X-Pvoutput-SystemId"   : pvssid
-            }
             
             pvodate = jsondate[:4] +jsondate[5:7] + jsondate[8:10]
             # debug: pvodate = jsondate[:4] +jsondate[5:7] + "16" 
             pvotime = jsondate[11:16] 
             # debug: pvotime = "09:05" 
             # if record is a smart monitor record sent smart monitor data to PVOutput
-            if header[14:16] != "20" :
+            if rectype != "20" :
                 pvdata = { 
                     "d"     : pvodate,
                     "t"     : pvotime,
@@ -551,11 +677,8 @@ def procdata(conf,data):
                     pvdata["v5"] = definedkey["pvtemperature"]/10
                 
                 #print(pvdata)
-                if conf.verbose : print("\t\t - ", pvheader)
                 if conf.verbose : print("\t\t - ", pvdata)
-                reqret = requests.post(conf.pvurl, data = pvdata, headers = pvheader)
-                if conf.verbose :  print("\t - " + "Grott PVOutput response: ") 
-                if conf.verbose : print("\t\t - ", reqret.text)
+                conf.pvsink.add(pvssid, "status", pvdata, definedkey["pvserial"])
             else: 
                 # send smat monitor data c1 = 3 indiates v3 is lifetime energy (day wil be calculated), n=1 indicates is net data (import /export)
                 # value seprated because it is not allowed to sent combination at once
@@ -575,120 +698,41 @@ def procdata(conf,data):
                    "n"     : 1
                    }                       
                     #"v4"    : definedkey["pos_act_power"]/10,
-                #print(pvheader)
-                if conf.verbose : print("\t\t - ", pvheader)
                 if conf.verbose : print("\t\t - ", pvdata1)
                 if conf.verbose : print("\t\t - ", pvdata2)
-                reqret = requests.post(conf.pvurl, data = pvdata1, headers = pvheader)
-                if conf.verbose :  print("\t - " + "Grott PVOutput response SM1: ") 
-                if conf.verbose : print("\t\t - ", reqret.text)
-                reqret = requests.post(conf.pvurl, data = pvdata2, headers = pvheader)
-                if conf.verbose :  print("\t - " + "Grott PVOutput response SM2: ") 
-                if conf.verbose : print("\t\t - ", reqret.text)
+                conf.pvsink.add(pvssid, "consumption", pvdata1, definedkey["pvserial"])
+                conf.pvsink.add(pvssid, "net", pvdata2, definedkey["pvserial"])
         else: 
             if conf.verbose : print("\t - " + "Grott Send data to PVOutput disabled ") 
 
     # influxDB processing 
     if conf.influx:      
         if conf.verbose :  print("\t - " + "Grott InfluxDB publihing started")
-        try:  
-            import  pytz             
-        except: 
-            if conf.verbose :  print("\t - " + "Grott PYTZ Library not installed in Python, influx processing disabled")    
-            conf.inlyx = False
-            return
-        try: 
-            local = pytz.timezone(conf.tmzone) 
-        except : 
-            if conf.verbose :  
-                if conf.tmzone ==  "local":  print("\t - " + "Timezone local specified default timezone used")
-                else : print("\t - " + "Grott unknown timezone : ",conf.tmzone,", default timezone used")
-            conf.tmzone = "local"
-            local = int(time.timezone/3600)
-            #print(local)
-
-        if conf.tmzone == "local": 
-           curtz = time.timezone 
-           utc_dt = datetime.strptime (jsondate, "%Y-%m-%dT%H:%M:%S") + timedelta(seconds=curtz) 
-        else :      
-            naive = datetime.strptime (jsondate, "%Y-%m-%dT%H:%M:%S")
-            local_dt = local.localize(naive, is_dst=None)
-            utc_dt = local_dt.astimezone(pytz.utc)
-        
-        ifdt = utc_dt.strftime ("%Y-%m-%dT%H:%M:%S")
-        if conf.verbose :  print("\t - " + "Grott original time : ",jsondate,"adjusted UTC time for influx : ",ifdt)
-    
-        # prepare influx jsonmsg dictionary    
+
+        #influx timestamp: record time converted to UTC with the configured timezone (see grotttime)
+        if conf.verbose :  print("\t - " + "Grott original time : ",jsondate,"adjusted UTC time for influx : ",time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(rectime)))
 
         # if record is a smart monitor record use datalogserial as measurement (to distinguish from solar record) 
-        if header[14:16] != "20" :
-            ifobj = {
-                        "measurement" : definedkey["pvserial"],
-                        "time" : ifdt,
-                        "fields" : {}
-                    }    
+        if rectype != "20" :
+            ifmeasurement = definedkey["pvserial"]
         else: 
-            ifobj = {
-                                "measurement" : definedkey["datalogserial"],
-                                "time" : ifdt,
-                               "fields" : {}
-                    }    
-
-        for key in definedkey : 
-            if key != "date" : 
-                ifobj["fields"][key] = definedkey[key]
-        
-        #Create list for influx
-        ifjson = [ifobj]
-
-        print("\t - " + "Grott influxdb jsonmsg: ")        
-        print(format_multi_line("\t\t\t ", str(ifjson)))   
-        #if conf.verbose :  print("\t - " + "Grott InfluxDB publihing started")
-  
-        try: 
-            if (conf.influx2):
-                if conf.verbose :  print("\t - " + "Grott write to influxdb v2") 
-                ifresult = conf.ifwrite_api.write(conf.ifbucket,conf.iforg,ifjson)   
-                #print(ifresult)
-            else: 
-                if conf.verbose :  print("\t - " + "Grott write to influxdb v1") 
-                ifresult = conf.influxclient.write_points(ifjson)
-        #except : 
-        except Exception as e:
-            # if  conf.verbose: 
-                print("\t - " + "Grott InfluxDB error ")
-                print(e) 
-                raise SystemExit("Grott Influxdb write error, grott will be stopped") 
+            ifmeasurement = definedkey["datalogserial"]
+
+        #point is encoded to line protocol (fields from the record layout) and queued, written (batched, with retry) 
+        #by the InfluxDB writer thread (grottinflux)
+        ifline = conf.ifsink.writerecord(record, ifmeasurement)
+        if conf.verbose :  
+            print("\t - " + "Grott influxdb line queued: ")        
+            print(format_multi_line("\t\t\t ", ifline.decode("utf-8")))   
             
     else: 
             if conf.verbose : print("\t - " + "Grott Send data to Influx disabled ")      
 
     if conf.extension : 
         
+        #extensions (loaded once, see grottplugin) run in their own threads, record is queued 
         if conf.verbose :  print("\t - " + "Grott extension processing started : ", conf.extname)
-        import importlib
-        try: 
-            module = importlib.import_module(conf.extname, package=None)
-        except :
-            if conf.verbose : print("\t - " + "Grott import extension failed:", conf.extname)      
-            return
-
-        try:
-            ext_result = module.grottext(conf,result_string,jsonmsg) 
-            if conf.verbose :  
-                print("\t - " + "Grott extension processing ended : ", ext_result)
-        except Exception as e:
-            print("\t - " + "Grott extension processing error:", repr(e))
-            if conf.verbose:
-                import traceback
-                print("\t - " + traceback.format_exc())
-            #print("\t - " + "Grott extension processing error ")
-            #print(e) 
-            #return
-
-        #if conf.verbose :  
-            #print("\t - " + "Grott extension processing ended : ", ext_result)
-            ##print("\t -", ext_result)
+        if dataprocessed : conf.extensions.put(record)
     else: 
             if conf.verbose : print("\t - " + "Grott extension processing disabled ")      
 
@@ -0,0 +1,235 @@
+# grottinflux.py Grott InfluxDB output (sink)
+# Updated: 2026-10-18
+#
+# Points are encoded to InfluxDB line protocol (GrottLineEncoder, one per record layout) and collected in memory.
+# They are written in batches (ifbatch points or every ifflush seconds, the lines of a batch joined into one payload)
+# by a background thread, instead of one synchronous write per record. A failed write is retried with exponential
+# backoff (up to ifbackoff seconds), the points stay queued. If more than ifqueue points are waiting the new points
+# are spilled to a file (ifspillfile, line protocol) and read back when the backlog is written. Write errors never
+# stop grott (the proxy keeps forwarding to Growatt).
+
+import atexit
+import collections
+import os
+import threading
+import time
+
+from grottmetrics import metrics
+
+
+def escapekey(name):
+    # tag and field keys: escape backslash, comma, equal sign and space
+    return name.replace("\\", "\\\\").replace(",", "\\,").replace("=", "\\=").replace(" ", "\\ ")
+
+
+def escapemeasurement(name):
+    # measurement: escape comma and space (an equal sign is not escaped in a measurement)
+    return name.replace(",", "\\,").replace(" ", "\\ ")
+
+
+def escapestr(value):
+    # string field value: quoted, escape backslash and quote (line protocol does not allow a newline)
+    return '"' + value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+
+
+class GrottLineEncoder:
+    """InfluxDB line protocol encoder for the records of one (compiled) record layout.
+
+    Escaped field keys and the divide factors are taken from the layout once, a record is encoded straight from the
+    decoded values: integers as "i" fields (or, with scaled = True, as float value / divide for fields with a divide
+    factor), floats as float fields and text as string fields.
+    """
+
+    def __init__(self, reclayout=None, scaled=False):
+        self.keys = {}
+        self.divide = {}
+        if reclayout is not None:
+            for name in reclayout.names:
+                self.keys[name] = escapekey(name) + "="
+            if scaled:
+                self.divide = {name: divide for name, divide in reclayout.divide.items() if divide != 1}
+
+    def key(self, name):
+        # fields not in the layout (e.g. pvserial from the configuration)
+        try:
+            return self.keys[name]
+        except KeyError:
+            self.keys[name] = key = escapekey(name) + "="
+            return key
+
+    def encode(self, measurement, fields, timestamp, skip=("date",)):
+        # returns line protocol bytes: measurement field=value,... timestamp (nanoseconds since epoch)
+        parts = []
+        for name, value in fields.items():
+            if name in skip or value is None:
+                continue
+            if isinstance(value, bool):
+                value = "true" if value else "false"
+            elif isinstance(value, int):
+                divide = self.divide.get(name)
+                value = repr(value / divide) if divide else str(value) + "i"
+            elif isinstance(value, float):
+                value = repr(value)
+            else:
+                value = escapestr(str(value))
+            parts.append(self.key(name) + value)
+        return (escapemeasurement(measurement) + " " + ",".join(parts) + " " + str(timestamp)).encode("utf-8")
+
+
+class GrottInflux:
+
+    def __init__(self, conf):
+        self.conf = conf
+        self.batch = conf.ifbatch
+        self.flush = conf.ifflush
+        self.maxqueue = conf.ifqueue
+        self.spillfile = conf.ifspillfile
+        self.points = collections.deque()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.spillpos = 0
+        self.spilling = self.spillsize() > 0
+        self.backoff = 0
+        self.stopped = False
+
+        self.scaled = conf.ifscaled
+        self.encoders = {}
+
+        # batch payload: the line protocol lines joined in one bytes object
+        if conf.influx2:
+            self.writer = lambda payload: conf.ifwrite_api.write(conf.ifbucket, conf.iforg, payload)
+        else:
+            self.writer = lambda payload: conf.influxclient.write_points(payload.decode("utf-8"), protocol="line")
+
+        metrics.set("influx_queue_depth", lambda: len(self.points))
+        metrics.set("influx_spill_bytes", self.spillsize)
+        if self.spilling:
+            # points left from a previous run, remove a line cut off by a crash
+            with open(self.spillfile, "r+b") as spill:
+                size = spill.seek(0, os.SEEK_END)
+                spill.seek(max(size - 65536, 0))
+                tail = spill.read()
+                if not tail.endswith(b"\n"):
+                    spill.truncate(size - len(tail) + tail.rfind(b"\n") + 1)
+            print("\t - Grott InfluxDB spilled points found, will be written:", self.spillfile)
+
+        self.thread = threading.Thread(target=self.run, name="grottinflux", daemon=True)
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def encoder(self, reclayout=None):
+        # line protocol encoder for a record layout (None: no layout, compat mode)
+        name = reclayout.name if reclayout is not None else None
+        try:
+            return self.encoders[name]
+        except KeyError:
+            self.encoders[name] = encoder = GrottLineEncoder(reclayout, self.scaled)
+            return encoder
+
+    def writerecord(self, record, measurement):
+        # encode and queue the values of a record (grottdata.GrottRecord), returns the line
+        line = self.encoder(record.reclayout).encode(measurement, record.values, record.epoch * 1000000000)
+        self.write(line)
+        return line
+
+    def write(self, point):
+        # queue point (line protocol bytes, without newline), never blocks on InfluxDB
+        with self.lock:
+            if len(self.points) >= self.maxqueue or self.spilling:
+                # backlog too large (or older points already spilled): keep order, spill to disk
+                self.spill([point])
+            else:
+                self.points.append(point)
+            if len(self.points) >= self.batch:
+                self.wakeup.notify()
+
+    def pending(self):
+        # points in memory not written yet (spilled points not included)
+        return len(self.points)
+
+    def spillsize(self):
+        try:
+            return os.path.getsize(self.spillfile)
+        except OSError:
+            return 0
+
+    def spill(self, points):
+        # append points to the spill file (lock must be held)
+        with open(self.spillfile, "ab") as spill:
+            spill.write(b"\n".join(points) + b"\n")
+        self.spilling = True
+        metrics.inc("influx_spilled", len(points))
+
+    def unspill(self):
+        # read spilled points back till the memory queue is full, empty the spill file when all are read (lock held)
+        if not self.spilling:
+            return
+        with open(self.spillfile, "rb") as spill:
+            spill.seek(self.spillpos)
+            while len(self.points) < self.maxqueue:
+                line = spill.readline()
+                if not line:
+                    break
+                line = line.rstrip(b"\n")
+                if line:
+                    self.points.append(line)
+            self.spillpos = spill.tell()
+        if self.spillpos >= self.spillsize():
+            os.remove(self.spillfile)
+            self.spillpos = 0
+            self.spilling = False
+
+    def run(self):
+        while True:
+            with self.lock:
+                if len(self.points) < self.batch:
+                    self.wakeup.wait(self.flush)
+                try:
+                    self.unspill()
+                except OSError as e:
+                    print("\t - Grott InfluxDB spill file error, spilled points skipped :", e)
+                    self.spillpos = 0
+                    self.spilling = False
+                batch = [self.points.popleft() for _ in range(min(self.batch, len(self.points)))]
+            if not batch:
+                continue
+            if self.send(batch):
+                continue
+            # write failed: put points back (in front) and wait before the next try
+            with self.lock:
+                self.points.extendleft(reversed(batch))
+            time.sleep(self.backoff)
+
+    def send(self, batch):
+        # write batch to InfluxDB, returns False if the write failed (backoff is doubled)
+        try:
+            self.writer(b"\n".join(batch))
+        except Exception as e:
+            metrics.inc("influx_errors")
+            if getattr(e, "code", None) in (400, 422) or getattr(e, "status", None) in (400, 422):
+                # points rejected by InfluxDB (e.g. field type conflict), a retry will not help
+                print("\t - Grott InfluxDB points rejected, batch dropped :", e)
+                metrics.inc("influx_rejected", len(batch))
+                return True
+            self.backoff = min(max(self.backoff * 2, 1), self.conf.ifbackoff)
+            print("\t - Grott InfluxDB write error, retry in", self.backoff, "seconds :", e)
+            return False
+        if self.conf.verbose: print("\t - Grott InfluxDB", len(batch), "points written")
+        metrics.inc("influx_written", len(batch))
+        self.backoff = 0
+        return True
+
+    def stop(self):
+        # write queued points (one try), points that can not be written are spilled for the next run
+        with self.lock:
+            if self.stopped:
+                return
+            self.stopped = True
+            points = list(self.points)
+            self.points.clear()
+        while points:
+            batch, points = points[:self.batch], points[self.batch:]
+            if not self.send(batch):
+                with self.lock:
+                    self.spill(batch + points)
+                break
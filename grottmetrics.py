@@ -0,0 +1,61 @@
+# grottmetrics.py Grott runtime metrics (counters and gauges)
+# Updated: 2026-10-18
+#
+# Thread safe registry shared by the proxy, processing queue and output sinks.
+# Metrics are printed every metricsint seconds (0 = disabled) and can be read with metrics.snapshot().
+
+import threading
+import time
+
+
+class GrottMetrics:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.reporter = None
+
+    def inc(self, name, value=1):
+        # increment counter
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set(self, name, value):
+        # set gauge, value can be a callable (evaluated when a snapshot is taken, e.g. queue.qsize)
+        with self.lock:
+            self.gauges[name] = value
+
+    def register(self, prefix, stats):
+        # export all values of a (live) statistics dict as gauges prefix_key
+        for key in stats:
+            self.set(prefix + "_" + key, lambda key=key: stats[key])
+
+    def snapshot(self):
+        # returns dict with all counters and gauges (sorted on name)
+        with self.lock:
+            values = dict(self.counters)
+            gauges = dict(self.gauges)
+        for name, value in gauges.items():
+            if callable(value):
+                try:
+                    value = value()
+                except Exception:
+                    value = None
+            values[name] = value
+        return dict(sorted(values.items()))
+
+    def start(self, conf):
+        # start periodic metrics print (metricsint in seconds, 0 = disabled)
+        if conf.metricsint <= 0 or self.reporter is not None:
+            return
+        self.reporter = threading.Thread(target=self.report, args=(conf.metricsint,), name="grottmetrics", daemon=True)
+        self.reporter.start()
+
+    def report(self, interval):
+        while True:
+            time.sleep(interval)
+            print("\t - Grott metrics: ", self.snapshot())
+
+
+metrics = GrottMetrics()
@@ -0,0 +1,111 @@
+# grottmqtt.py Grott MQTT output (sink)
+# Updated: 2026-10-18
+#
+# One long lived MQTT client with a background network loop (paho loop_start) and automatic reconnect, instead of
+# a connect / publish / disconnect (publish.single) per record. Messages are put on a bounded queue and sent by a
+# sender thread when the broker is connected, if the queue is full the oldest message is dropped.
+
+import atexit
+import os
+import queue
+import socket
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+from grottmetrics import metrics
+
+
+class GrottMqtt:
+
+    def __init__(self, conf):
+        self.conf = conf
+        self.qos = conf.mqttqos
+        self.queue = queue.Queue(maxsize=conf.mqttqueue)
+        self.connected = threading.Event()
+
+        # unique client id: several grott processes can use the same broker
+        clientid = conf.mqttclientid
+        if clientid == "auto":
+            clientid = "grott-" + socket.gethostname() + "-" + str(os.getpid())
+        try:
+            # paho-mqtt 2.x
+            self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=clientid)
+        except AttributeError:
+            self.client = mqtt.Client(client_id=clientid)
+        if conf.mqttauth:
+            self.client.username_pw_set(conf.mqttuser, conf.mqttpsw)
+        self.client.on_connect = self.on_connect
+        self.client.on_disconnect = self.on_disconnect
+        self.client.reconnect_delay_set(min_delay=1, max_delay=120)
+
+        metrics.set("mqtt_queue_depth", self.queue.qsize)
+        metrics.set("mqtt_connected", self.connected.is_set)
+
+        self.client.connect_async(conf.mqttip, conf.mqttport, keepalive=60)
+        self.client.loop_start()
+        self.sender = threading.Thread(target=self.run, name="grottmqtt", daemon=True)
+        self.sender.start()
+        atexit.register(self.stop)
+        print("\t - Grott MQTT client started, client id:", clientid)
+
+    # callbacks accept the paho-mqtt 1.x and 2.x (CallbackAPIVersion.VERSION2) arguments
+    def on_connect(self, client, userdata, flags, rc, properties=None):
+        if rc == 0:
+            if self.conf.verbose: print("\t - " + "Grott MQTT connected to", self.conf.mqttip, self.conf.mqttport)
+            self.connected.set()
+        else:
+            print("\t - " + "Grott MQTT connection refused by broker, rc:", rc)
+
+    def on_disconnect(self, client, userdata, *args):
+        rc = args[1] if len(args) > 1 else args[0]
+        self.connected.clear()
+        if rc != 0:
+            metrics.inc("mqtt_disconnects")
+            print("\t - " + "Grott MQTT connection lost, reconnecting, rc:", rc)
+
+    def publish(self, topic, payload, retain=False):
+        # queue message (called by procdata), never blocks
+        while True:
+            try:
+                self.queue.put_nowait((topic, payload, retain))
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    self.queue.task_done()
+                    metrics.inc("mqtt_dropped")
+                    if self.conf.verbose: print("\t - " + "Grott MQTT queue full, oldest message dropped")
+                except queue.Empty:
+                    pass
+
+    def pending(self):
+        # messages not sent yet
+        return self.queue.unfinished_tasks
+
+    def run(self):
+        while True:
+            topic, payload, retain = self.queue.get()
+            try:
+                while True:
+                    self.connected.wait()
+                    info = self.client.publish(topic, payload=payload, qos=self.qos, retain=retain)
+                    if info.rc == mqtt.MQTT_ERR_SUCCESS:
+                        metrics.inc("mqtt_published")
+                        break
+                    # connection lost between wait and publish (or paho queue full), retry
+                    time.sleep(1)
+            except Exception as e:
+                metrics.inc("mqtt_errors")
+                print("\t - " + "Grott MQTT send failed:", repr(e))
+            finally:
+                self.queue.task_done()
+
+    def stop(self, timeout=5):
+        # send queued messages (if connected) and disconnect
+        deadline = time.monotonic() + timeout
+        while self.queue.unfinished_tasks and self.connected.is_set() and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.client.disconnect()
+        self.client.loop_stop()
@@ -0,0 +1,139 @@
+# grottplugin.py Grott extension registry
+# Updated: 2026-10-18
+#
+# Extensions (extname: comma separated list of modules, called in this order) are imported once at startup. Every
+# extension has its own queue and thread(s), so a slow extension (e.g. a http post) does not hold up record
+# processing or the other extensions. A call running longer than exttimeout seconds is abandoned (counted as
+# timeout, the thread is freed when the call returns). While all spare threads are held by abandoned calls, records
+# are dropped instead of queued in the thread pool. With extordered = True (default) records are delivered to an
+# extension one at a time in arrival order, otherwise by extworkers threads in parallel.
+#
+# Extension API version 2 (module defines grottext_version = 2): module.grottext(conf, record), record: the processed
+# record (grottdata.GrottRecord: device, time, epoch, buffered, layout, values, scaled, json, plain).
+# Version 1 (default): module.grottext(conf, data, jsonmsg), data: plain record (hex string), jsonmsg: MQTT message.
+# conf.extvar is the extension's own extvar: extvar = {"<extname>": {...}, ...} if more than one extension is used,
+# otherwise extvar itself.
+
+import concurrent.futures
+import importlib
+import queue
+import threading
+import time
+
+from grottmetrics import metrics
+
+
+class GrottExtConf:
+    """Configuration view for one extension call: own extvar, record layout and decrypt, everything else from conf.
+
+    Attributes set by an extension are kept in the view (the shared conf is read only at runtime).
+    """
+
+    def __init__(self, conf, extvar, record):
+        self.__dict__["_conf"] = conf
+        self.__dict__["extvar"] = extvar
+        self.__dict__["layout"] = record.layout
+        self.__dict__["decrypt"] = record.decrypt
+
+    def __getattr__(self, name):
+        return getattr(self._conf, name)
+
+
+class GrottExtension:
+
+    def __init__(self, conf, name, module, extvar):
+        self.conf = conf
+        self.name = name
+        self.module = module
+        self.extvar = extvar
+        self.version = getattr(module, "grottext_version", 1)
+        self.timeout = conf.exttimeout
+        self.queue = queue.Queue(maxsize=conf.extqueue)
+        dispatchers = 1 if conf.extordered else conf.extworkers
+        # spare threads for calls that are still running after their timeout
+        self.threads = dispatchers * 2
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="grottext-" + name)
+        self.lock = threading.Lock()
+        self.running = 0                                    # calls submitted and not returned (also abandoned calls)
+        metrics.set("ext_" + name + "_queue_depth", self.queue.qsize)
+        for i in range(dispatchers):
+            threading.Thread(target=self.run, name="grottext-" + name + "-dispatch", daemon=True).start()
+
+    def put(self, record):
+        # queue record for the extension, never blocks (record dropped if the queue is full)
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.inc("ext_" + self.name + "_dropped")
+            if self.conf.verbose: print("\t - " + "Grott extension queue full, record dropped : ", self.name)
+
+    def call(self, record):
+        conf = GrottExtConf(self.conf, self.extvar, record)
+        if self.version >= 2:
+            return self.module.grottext(conf, record)
+        return self.module.grottext(conf, record.hex, record.json)
+
+    def done(self, future):
+        with self.lock:
+            self.running -= 1
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            with self.lock:
+                busy = self.running >= self.threads
+                if not busy: self.running += 1
+            if busy:
+                # every thread is held by a call that timed out: not submitted (would wait in the pool queue)
+                metrics.inc("ext_" + self.name + "_dropped")
+                print("\t - " + "Grott extension busy with timed out calls, record dropped : ", self.name)
+                continue
+            started = time.monotonic()
+            future = self.pool.submit(self.call, record)
+            future.add_done_callback(self.done)
+            try:
+                ext_result = future.result(timeout=self.timeout)
+                metrics.inc("ext_" + self.name + "_calls")
+                if self.conf.verbose:
+                    print("\t - " + "Grott extension processing ended : ", self.name, ext_result, "({:.3f}s)".format(time.monotonic() - started))
+            except concurrent.futures.TimeoutError:
+                metrics.inc("ext_" + self.name + "_timeouts")
+                print("\t - " + "Grott extension processing timeout : ", self.name, "after", self.timeout, "seconds")
+            except Exception as e:
+                metrics.inc("ext_" + self.name + "_errors")
+                print("\t - " + "Grott extension processing error:", self.name, repr(e))
+                if self.conf.verbose:
+                    import traceback
+                    print("\t - " + "".join(traceback.format_exception(type(e), e, e.__traceback__)))
+
+
+class GrottExtensions:
+    """Registry of the configured extensions (imported once, in extname order)."""
+
+    def __init__(self, conf):
+        self.extensions = []
+        names = [name.strip() for name in conf.extname.split(",") if name.strip()]
+        for name in names:
+            try:
+                module = importlib.import_module(name, package=None)
+            except Exception as e:
+                print("\t - " + "Grott import extension failed:", name, repr(e))
+                continue
+            if not hasattr(module, "grottext"):
+                print("\t - " + "Grott extension has no grottext function:", name)
+                continue
+            if len(names) > 1 and isinstance(conf.extvar, dict) and isinstance(conf.extvar.get(name), dict):
+                extvar = conf.extvar[name]
+            else:
+                extvar = conf.extvar
+            self.extensions.append(GrottExtension(conf, name, module, extvar))
+            if conf.verbose: print("\t - " + "Grott extension loaded : ", name, "api version", self.extensions[-1].version)
+
+    def pending(self):
+        # records queued for the extensions
+        return sum(extension.queue.qsize() for extension in self.extensions)
+
+    def put(self, record):
+        # queue record (grottdata.GrottRecord) for all extensions
+        for extension in self.extensions:
+            extension.put(record)
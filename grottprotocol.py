@@ -0,0 +1,217 @@
+# grottprotocol.py Growatt wire protocol helpers (shared by proxy, sniffer and grottserver)
+# Updated: 2026-10-18
+#
+# Only standard library imports here (numpy is optional), grottserver runs without the grott config/data modules.
+
+#numpy is optional, only used to unscramble large (buffered) records
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+#libscrc is optional, without it records are only validated on length (CRC's are still created, see crc16)
+try:
+    import libscrc
+except ImportError:
+    libscrc = None
+
+# Growatt records: 8 byte header (sequence, protocol, length, device, record type), payload scrambled from byte 8
+HEADER_LEN = 8
+MASK = b"Growatt"
+
+# Largest record: 6 header bytes in front of the 2 byte length field, 65535 bytes payload + 2 bytes CRC
+MAX_RECORD_LEN = 6 + 0xFFFF + 2
+
+# Largest record length the framer accepts from a header (largest record layout about 920 bytes), a header claiming
+# more is taken as corrupt: the framer resyncs instead of buffering up to MAX_RECORD_LEN bytes behind it
+FRAME_MAX_LEN = 4096
+
+# numpy only pays for its call overhead on large buffers
+NUMPY_THRESHOLD = 4096
+
+# Precomputed repeating mask, long enough for every possible record payload
+_mask = (MASK * (MAX_RECORD_LEN // len(MASK) + 1))[:MAX_RECORD_LEN]
+_npmask = numpy.frombuffer(_mask, dtype=numpy.uint8) if numpy is not None else None
+
+
+def scramble(data):
+    """XOR the payload (everything after the header) with the repeating "Growatt" mask in a single pass.
+
+    Scrambling is symmetric: the same call decrypts a received record and encrypts one to be sent.
+    Accepts any bytes-like object (bytes, bytearray, memoryview) and returns bytes.
+    """
+    ndata = len(data)
+    if ndata <= HEADER_LEN:
+        return bytes(data)
+    nbody = ndata - HEADER_LEN
+
+    if _npmask is not None and nbody >= NUMPY_THRESHOLD:
+        plain = numpy.frombuffer(data, dtype=numpy.uint8).copy()
+        numpy.bitwise_xor(plain[HEADER_LEN:], _npmask[:nbody], out=plain[HEADER_LEN:])
+        return plain.tobytes()
+
+    # one big-int XOR runs in C over the whole payload
+    body = int.from_bytes(data[HEADER_LEN:], "big") ^ int.from_bytes(_mask[:nbody], "big")
+    return bytes(data[:HEADER_LEN]) + body.to_bytes(nbody, "big")
+
+
+def decrypt(data):
+    # unscramble received record, header is left untouched
+    return scramble(data)
+
+
+def encrypt(data):
+    # scramble record to be sent, header is left untouched
+    return scramble(data)
+
+
+def decrypt_into(data, out):
+    """Unscramble data into the preallocated buffer out (bytearray), returns a memoryview on the plain record."""
+    ndata = len(data)
+    view = memoryview(out)[:ndata]
+    view[:HEADER_LEN] = data[:HEADER_LEN]
+    if ndata <= HEADER_LEN:
+        return view
+    nbody = ndata - HEADER_LEN
+
+    if _npmask is not None and nbody >= NUMPY_THRESHOLD:
+        plain = numpy.frombuffer(view, dtype=numpy.uint8)
+        numpy.bitwise_xor(numpy.frombuffer(data, dtype=numpy.uint8)[HEADER_LEN:], _npmask[:nbody], out=plain[HEADER_LEN:])
+        return view
+
+    body = int.from_bytes(data[HEADER_LEN:], "big") ^ int.from_bytes(_mask[:nbody], "big")
+    view[HEADER_LEN:] = body.to_bytes(nbody, "big")
+    return view
+
+
+def _crctable():
+    # CRC-16 Modbus (reflected polynomial 0xA001) lookup table
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+_crc16table = _crctable()
+
+
+def crc16(data):
+    # CRC-16 Modbus, libscrc if installed, otherwise (slower) table driven
+    if libscrc is not None:
+        try:
+            return libscrc.modbus(data)
+        except TypeError:
+            # libscrc only accepts read-only buffers
+            return libscrc.modbus(bytes(data))
+    crc = 0xFFFF
+    for byte in data:
+        crc = (crc >> 8) ^ _crc16table[(crc ^ byte) & 0xFF]
+    return crc
+
+
+def record_length(data):
+    # total record length from the record header (length field + 6 header bytes + CRC for "05" and "06")
+    length = 6 + int.from_bytes(data[4:6], "big")
+    if data[3] in (5, 6):
+        length += 2
+    return length
+
+
+# framer statistics (all framers): reads, records, reads with more than one record, reads ending in a
+# partial record (record completed by a next read), bytes skipped to find the next record header
+framestats = {"reads": 0, "records": 0, "multi": 0, "partial": 0, "resync": 0}
+
+
+class GrottFramer:
+    """Incremental framer: splits a TCP stream (one framer per connection and direction) into records.
+
+    The record length is taken from the length field (bytes 4-6) plus the CRC trailer for protocol 05/06, so
+    coalesced reads give multiple records and a record split over reads is returned when it is complete.
+    Returned records are memoryviews (on the received data if possible), only valid till the next feed. A header with
+    a record length above maxlength is skipped like a bad header (resync).
+    """
+
+    def __init__(self, maxlength=FRAME_MAX_LEN):
+        self.buffer = bytearray()
+        self.maxlength = maxlength
+
+    def feed(self, data):
+        # returns list with the complete records in data (plus the data buffered from previous reads)
+        framestats["reads"] += 1
+        if self.buffer:
+            self.buffer += data
+            stream = memoryview(bytes(self.buffer))
+            self.buffer.clear()
+        else:
+            stream = memoryview(data)
+
+        records = []
+        pos = 0
+        nstream = len(stream)
+        while nstream - pos >= 6:
+            # header check: protocol 00 02 / 00 05 / 00 06 and a plausible record length
+            if stream[pos + 2] != 0 or stream[pos + 3] not in (2, 5, 6):
+                framestats["resync"] += 1
+                pos += 1
+                continue
+            length = record_length(stream[pos:pos + 6])
+            if length < HEADER_LEN or length > self.maxlength:
+                framestats["resync"] += 1
+                pos += 1
+                continue
+            end = pos + length
+            if end > nstream:
+                break
+            records.append(stream[pos:end])
+            pos = end
+
+        if pos < nstream:
+            self.buffer += stream[pos:]
+            framestats["partial"] += 1
+        if len(records) > 1:
+            framestats["multi"] += 1
+        framestats["records"] += len(records)
+        return records
+
+
+def ack_record(data):
+    # response the Growatt server sends to a datalogger record, None if no response is needed
+    # ping (16): record is echoed, data records (03, 04, 50, 29, 1b, 20): ack
+    rectype = data[7]
+    if rectype == 0x16:
+        return bytes(data)
+    if rectype not in (0x03, 0x04, 0x50, 0x29, 0x1b, 0x20):
+        return None
+    header = bytes(data[0:4]) + b"\x00\x03" + bytes(data[6:8])
+    if data[3] == 2:
+        #protocol 02, unencrypted ack
+        return header + b"\x00"
+    # protocol 05/06, encrypted ack
+    ack = header + b"\x47"
+    return ack + crc16(ack).to_bytes(2, "big")
+
+
+def validate_record(data):
+    # validate data record on length and CRC (for "05" and "06" records), returns 0 if valid, 8 if not
+    # data: bytes-like (bytes, bytearray, memoryview), no conversion to hex is done
+    ldata = len(data)
+    if ldata < HEADER_LEN:
+        return 8
+    len_orgpayload = int.from_bytes(data[4:6], "big")
+    protocol = data[3]
+
+    if protocol in (5, 6):
+        lcrc = 2
+    else:
+        lcrc = 0
+    if ldata - 6 - lcrc != len_orgpayload:
+        return 8
+
+    #libscrc not installed: only validation on record length
+    if lcrc and libscrc is not None:
+        if crc16(data[0:ldata - 2]) != int.from_bytes(data[ldata - 2:ldata], "big"):
+            return 8
+
+    return 0
@@ -4,21 +4,27 @@
 # Version 2.7.5
 
 import socket
-import select
+import selectors
+import errno
+import itertools
+import os
+import queue
+import threading
 import time
 import sys
 import struct
 import textwrap
-from itertools import cycle # to support "cycling" the iterator
 import time, json, datetime, codecs
 ## to resolve errno 32: broken pipe issue (only linux)
 if sys.platform != 'win32' :
    from signal import signal, SIGPIPE, SIG_DFL
 
-from grottdata import procdata, decrypt, format_multi_line
+from grottdata import procdata, format_multi_line
+from grottprotocol import decrypt, validate_record, ack_record, GrottFramer, framestats, FRAME_MAX_LEN
+from grottmetrics import metrics
+from grottspool import GrottSpool
+from grottworker import GrottProcPool
 
-#import mqtt                       
-import paho.mqtt.publish as publish
 
 #import libscrc for additional crc checking                        
 # for compat reason (generate a message in the log) also done in proxy _init_
@@ -30,64 +36,120 @@ except:
     print("\t **********************************************************************************")
 
 
-# Changing the buffer_size and delay, you can improve the speed and bandwidth.
-# But when buffer get to high or delay go too down, you can broke things
+# Changing the buffer_size, you can improve the speed and bandwidth.
+# But when buffer get to high, you can broke things
 buffer_size = 4096
 #buffer_size = 65535
-delay = 0.0002
-
-def validate_record(xdata): 
-    # validata data record on length and CRC (for "05" and "06" records)
-    
-    data = bytes.fromhex(xdata)
-    ldata = len(data)
-    len_orgpayload = int.from_bytes(data[4:6],"big")
-    header = "".join("{:02x}".format(n) for n in data[0:8])
-    protocol = header[6:8]
-
-    if protocol in ("05","06"):
-        lcrc = 4
-        crc = int.from_bytes(data[ldata-2:ldata],"big")
-    else: 
-        lcrc = 0
-
-    len_realpayload = (ldata*2 - 12 -lcrc) / 2
-
-    if protocol != "02" :
-                
-        try: 
-            crc_calc = libscrc.modbus(data[0:ldata-2])
-        except: 
-            #liscrc is not installed yet
-            #print("\t - Grott - Validate datarecord - libscrc not installed, only validation on record length")  
-            crc_calc = crc = 0 
+# maximum reads per socket per loop iteration (a busy socket can not starve the others)
+max_drain = 16
+
+class GrottProcQueue:
+    """Bounded queue between the proxy select loop and procdata worker threads.
+
+    The select loop only validates, forwards and queues a record; MQTT, InfluxDB, PVOutput and extension
+    output (procdata) is done by procworkers threads, so a slow output does not stall datalogger traffic.
+    If the queue is full procdrop decides: oldest (drop oldest queued record), newest (drop received record)
+    or block (select loop waits). procworkers = 0 processes records inline (no queue).
+    With procprocesses > 0 worker processes are used instead (grottworker.GrottProcPool).
+    """
+
+    def __init__(self, conf):
+        self.conf = conf
+        self.drop = conf.procdrop
+        self.queue = queue.Queue(maxsize=conf.procqueue)
+        self.workers = []
+        metrics.set("proxy_queue_depth", self.queue.qsize)
+        metrics.set("proxy_queue_size", conf.procqueue)
+        metrics.set("proxy_workers", conf.procworkers)
+        for i in range(conf.procworkers):
+            worker = threading.Thread(target=self.work, name="grottproc" + str(i), daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def put(self, data, source=None):
+        # source (connection of the record) is only used by the worker processes
+        if not self.workers:
+            self.process(data)
+            return
+        # copy record, the receive buffer is reused by the select loop
+        record = bytes(data)
+        if self.drop == "block":
+            self.queue.put(record)
+        else:
+            while True:
+                try:
+                    self.queue.put_nowait(record)
+                    break
+                except queue.Full:
+                    metrics.inc("proxy_queue_dropped")
+                    if self.conf.verbose: print("\t - Grott - grottproxy - processing queue full, record dropped (" + self.drop + ")")
+                    if self.drop == "newest":
+                        return
+                    try:
+                        self.queue.get_nowait()
+                        self.queue.task_done()
+                    except queue.Empty:
+                        pass
+        metrics.inc("proxy_records_queued")
 
-    if len_realpayload == len_orgpayload :
-        returncc = 0
-        if protocol != "02" and crc != crc_calc:     
-            returncc = 8    
-    else : 
-        returncc = 8
+    def work(self):
+        while True:
+            record = self.queue.get()
+            try:
+                self.process(record)
+            finally:
+                self.queue.task_done()
 
-    return(returncc)
+    def process(self, record):
+        try:
+            procdata(self.conf, record)
+            metrics.inc("proxy_records_processed")
+        except (Exception, SystemExit) as e:
+            # keep the worker (and the proxy) running
+            metrics.inc("proxy_process_errors")
+            print("\t - Grott - grottproxy - record processing error : ", repr(e))
 
 
 class Forward:
     def __init__(self):
         self.forward = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.forward.setblocking(False)
 
     def start(self, host, port):
+        # non-blocking connect, the connection is established (or failed) when the socket becomes writable
         try:
-            self.forward.connect((host, port))
+            rc = self.forward.connect_ex((host, port))
+            if rc not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN):
+                raise OSError(rc, os.strerror(rc))
             return self.forward
         except Exception as e:
             print("\t - Grott - grottproxy forward error : ", e) 
-            #print(e)
+            self.forward.close()
             return False  
 
+class GrottProxyConn:
+    """Per connection state: one side (datalogger or Growatt server) of a proxied session."""
+
+    def __init__(self, sock, addr, side, maxrecl=FRAME_MAX_LEN):
+        self.sock = sock
+        self.addr = addr
+        self.side = side                                    # "client" (datalogger) or "server" (Growatt)
+        self.peer = None                                    # other side of the session
+        self.outbuf = bytearray()                           # data not yet accepted by the socket (or not connected yet)
+        self.closed = False
+        self.connecting = False                             # upstream connect in progress
+        self.deadline = None                                # upstream connect timeout (time.monotonic)
+        self.attempts = 0                                   # upstream connect attempts
+        self.offline = False                                # upstream not reachable, records are acked and spooled
+        self.retry = None                                   # offline: next upstream connect attempt (time.monotonic)
+        self.session = None                                 # session id (client side), used by the spool
+        self.framer = GrottFramer(maxrecl)                  # splits the received stream into records
+
+    def __repr__(self):
+        return "<" + self.side + " " + str(self.addr) + ">"
+
+
 class Proxy:
-    input_list = []
-    channel = {}
 
     def __init__(self, conf):
         print("\nGrott proxy mode started")
@@ -108,8 +170,8 @@ class Proxy:
         self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         #set default grottip address
-        if conf.grottip == "default" : conf.grottip = '0.0.0.0'
-        self.server.bind((conf.grottip, conf.grottport))
+        grottip = '0.0.0.0' if conf.grottip == "default" else conf.grottip
+        self.server.bind((grottip, conf.grottport))
         #socket.gethostbyname(socket.gethostname())
         try: 
             hostname = (socket.gethostname())    
@@ -119,74 +181,295 @@ class Proxy:
             print("IP and port information not available") 
 
         self.server.listen(200)
+        self.server.setblocking(False)
         self.forward_to = (conf.growattip, conf.growattport)
+        self.forward_addr = self.resolve(conf)
+        # epoll (linux) / kqueue / select, whatever is best on this platform
+        self.selector = selectors.DefaultSelector()
+        self.connections = set()
+        self.pending = set()                                # upstream connections being established
+        self.offline = set()                                # upstream connections in offline mode (reconnect retried)
+        metrics.register("framer", framestats)
+        metrics.set("proxy_connections", lambda: sum(1 for conn in list(self.connections) if conn.side == "client"))
+        # preallocated receive buffer, records are handled as memoryview slices of it (no copies)
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        # records are processed by the worker pool, the select loop only reads and forwards
+        self.procqueue = GrottProcPool(conf) if conf.procprocesses > 0 else GrottProcQueue(conf)
+        # store-and-forward spool for offline mode (Growatt server not reachable)
+        self.spool = GrottSpool(conf) if conf.spool else None
+        self.sessionids = itertools.count(int(time.time() * 1000))
+        metrics.start(conf)
         
+    def resolve(self, conf):
+        # resolve Growatt server address once (connect itself is non-blocking, name resolution is not)
+        try:
+            return (socket.gethostbyname(conf.growattip), conf.growattport)
+        except Exception as e:
+            print("\t - Grott - grottproxy Growatt server address resolution error : ", e)
+            return self.forward_to
+
     def main(self,conf):
-        self.input_list.append(self.server)
+        self.selector.register(self.server, selectors.EVENT_READ, None)
         while 1:
-            time.sleep(delay)
-            ss = select.select
-            inputready, outputready, exceptready = ss(self.input_list, [], [])
-            for self.s in inputready:
-                if self.s == self.server:
-                    self.on_accept(conf)
-                    break
-                try: 
-                    self.data, self.addr = self.s.recvfrom(buffer_size)
-                except: 
-                    if conf.verbose : print("\t - Grott connection error") 
-                    self.on_close(conf)   
-                    break
-                if len(self.data) == 0:
-                    self.on_close(conf)
-                    break
-                else:
-                    self.on_recv(conf)
+            self.poll(conf)
+
+    def poll(self, conf, timeout=None):
+        # one loop iteration: wait for socket events (max timeout seconds, None: no limit)
+        # wake up for the first upstream connect timeout or offline session reconnect (if any)
+        deadlines = [conn.deadline for conn in self.pending] + [conn.retry for conn in self.offline]
+        if deadlines:
+            wait = max(0, min(deadlines) - time.monotonic())
+            timeout = wait if timeout is None else min(timeout, wait)
+        for key, mask in self.selector.select(timeout):
+            conn = key.data
+            if conn is None:
+                self.on_accept(conf)
+                continue
+            if mask & selectors.EVENT_WRITE:
+                self.on_write(conf, conn)
+            if mask & selectors.EVENT_READ and not conn.closed and conn.sock is not None:
+                self.on_read(conf, conn)
+        if self.pending:
+            self.check_timeouts(conf)
+        if self.offline:
+            self.check_offline(conf)
 
     def on_accept(self,conf):
-        forward = Forward().start(self.forward_to[0], self.forward_to[1])
-        clientsock, clientaddr = self.server.accept()
-        if forward:
+        # accept all pending connections
+        while 1:
+            try:
+                clientsock, clientaddr = self.server.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                if conf.verbose: print("\t - Grott - grottproxy accept error : ", e)
+                return
             if conf.verbose: print("\t -", clientaddr, "has connected")
-            self.input_list.append(clientsock)
-            self.input_list.append(forward)
-            self.channel[clientsock] = forward
-            self.channel[forward] = clientsock
-        else:
+            # client is served right away, data received before the Growatt server is connected is queued
+            clientsock.setblocking(False)
+            client = GrottProxyConn(clientsock, clientaddr, "client", conf.maxrecl)
+            client.session = next(self.sessionids)
+            server = GrottProxyConn(None, self.forward_to, "server", conf.maxrecl)
+            client.peer = server
+            server.peer = client
+            self.selector.register(clientsock, selectors.EVENT_READ, client)
+            self.connections.add(client)
+            self.connections.add(server)
+            if not self.connect_upstream(conf, server):
+                self.upstream_failed(conf, server)
+
+    def connect_upstream(self, conf, server):
+        # start (or retry) non-blocking connect to the Growatt server
+        server.attempts += 1
+        forward = Forward().start(self.forward_addr[0], self.forward_addr[1])
+        if not forward:
+            return False
+        server.sock = forward
+        server.connecting = True
+        server.deadline = time.monotonic() + conf.growatttimeout
+        self.selector.register(forward, selectors.EVENT_WRITE, server)
+        self.pending.add(server)
+        return True
+
+    def on_connect(self, conf, server):
+        # upstream socket writable: connect finished (successful or not)
+        err = server.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err != 0:
+            self.retry_upstream(conf, server, os.strerror(err))
+            return
+        server.connecting = False
+        self.pending.discard(server)
+        if conf.verbose: print("\t - Grott - connected to Growatt server", server.addr, "for", server.peer.addr)
+        if server.offline:
+            # offline session is live again (records spooled meanwhile are replayed by the spool)
+            print("\t - Grott - Growatt server reachable again, offline mode ended for", server.peer.addr)
+            metrics.inc("proxy_online_sessions")
+            server.offline = False
+            self.offline.discard(server)
+        events = selectors.EVENT_READ
+        if server.outbuf:
+            # queued client data
+            events |= selectors.EVENT_WRITE
+        self.selector.modify(server.sock, events, server)
+
+    def retry_upstream(self, conf, server, reason):
+        print("\t - Grott - grottproxy forward error : ", reason)
+        metrics.inc("proxy_upstream_connect_errors")
+        self.pending.discard(server)
+        self.selector.unregister(server.sock)
+        server.sock.close()
+        server.sock = None
+        if server.attempts <= conf.growattretries:
+            metrics.inc("proxy_upstream_retries")
+            if self.connect_upstream(conf, server):
+                return
+        self.upstream_failed(conf, server)
+
+    def upstream_failed(self, conf, server):
+        # Growatt server not reachable: offline mode if spool enabled, otherwise close the client side
+        if self.spool is not None:
+            self.go_offline(conf, server)
+            return
+        if conf.verbose: 
+            print("\t - Can't establish connection with remote server."),
+            print("\t - Closing connection with client side", server.peer.addr)
+        server.closed = True
+        self.connections.discard(server)
+        self.on_close(conf, server.peer)
+
+    def go_offline(self, conf, server):
+        # offline mode till a reconnect (every spoolretry seconds) succeeds
+        if not server.offline:
+            print("\t - Grott - Growatt server not reachable, offline mode (records are acked and spooled) for", server.peer.addr)
+            metrics.inc("proxy_offline_sessions")
+        server.offline = True
+        server.connecting = False
+        server.retry = time.monotonic() + conf.spoolretry
+        self.offline.add(server)
+        # data queued while connecting (or not sent before the connection was lost) is spooled and acked record by
+        # record, the framer skips a record that was partly sent
+        queued = bytes(server.outbuf)
+        server.outbuf.clear()
+        for record in GrottFramer(conf.maxrecl).feed(queued):
+            self.offline_record(conf, server.peer, bytes(record))
+
+    def upstream_lost(self, conf, server):
+        # Growatt server connection lost during a session: offline mode, the datalogger connection is kept
+        print("\t - Grott - Growatt server connection lost for", server.peer.addr)
+        metrics.inc("proxy_upstream_lost")
+        self.pending.discard(server)
+        if server.sock is not None:
+            try:
+                self.selector.unregister(server.sock)
+            except (KeyError, ValueError):
+                pass
+            server.sock.close()
+            server.sock = None
+        # stream from a new connection starts with a new record
+        server.framer = GrottFramer(conf.maxrecl)
+        self.go_offline(conf, server)
+
+    def check_offline(self, conf):
+        # try the Growatt server again for the offline sessions that are due
+        now = time.monotonic()
+        for server in [conn for conn in self.offline if conn.retry <= now and not conn.connecting]:
+            server.retry = now + conf.spoolretry
+            server.attempts = 0
+            if conf.verbose: print("\t - Grott - offline mode, reconnect to Growatt server for", server.peer.addr)
+            self.connect_upstream(conf, server)
+
+    def offline_record(self, conf, client, data):
+        # spool record for replay and respond as the Growatt server would
+        self.spool.append(client.session, data)
+        response = ack_record(data)
+        if response is not None:
             if conf.verbose: 
-                print("\t - Can't establish connection with remote server."),
-                print("\t - Closing connection with client side", clientaddr)
-            clientsock.close()
+                print("\t - Grott - offline mode response: ")
+                print(format_multi_line("\t\t ", response))
+            self.send(conf, client, response)
+
+    def check_timeouts(self, conf):
+        now = time.monotonic()
+        for server in [conn for conn in self.pending if conn.deadline <= now]:
+            self.retry_upstream(conf, server, "connect timeout")
 
-    def on_close(self,conf):
+    def on_read(self, conf, conn):
+        # drain the socket (until no more data or max_drain reads)
+        for _ in range(max_drain):
+            try: 
+                nbytes = conn.sock.recv_into(self.buffer)
+            except (BlockingIOError, InterruptedError):
+                return
+            except: 
+                if conf.verbose : print("\t - Grott connection error") 
+                self.on_close(conf, conn)   
+                return
+            if nbytes == 0:
+                self.on_close(conf, conn)
+                return
+            for record in conn.framer.feed(self.view[:nbytes]):
+                if conn.closed:
+                    return
+                self.on_recv(conf, conn, record)
+
+    def on_write(self, conf, conn):
+        if conn.connecting:
+            self.on_connect(conf, conn)
+            return
+        # socket writable again: send pending data
+        try:
+            sent = conn.sock.send(conn.outbuf)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            self.on_close(conf, conn)
+            return
+        del conn.outbuf[:sent]
+        if not conn.outbuf:
+            self.selector.modify(conn.sock, selectors.EVENT_READ, conn)
+
+    def send(self, conf, conn, data):
+        # send data, what the socket does not accept now is buffered and sent when writable
+        if conn.closed:
+            return
+        if conn.connecting or conn.sock is None:
+            # Growatt server not connected (yet), queue data
+            conn.outbuf += data
+            return
+        if not conn.outbuf:
+            try:
+                sent = conn.sock.send(data)
+            except (BlockingIOError, InterruptedError):
+                sent = 0
+            except OSError:
+                self.on_close(conf, conn)
+                return
+            if sent == len(data):
+                return
+            data = data[sent:]
+            self.selector.modify(conn.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, conn)
+        conn.outbuf += data
+
+    def on_close(self, conf, conn=None, offline=True):
+        # close connection and its peer (conn None: close all connections), a lost Growatt server connection moves
+        # the session to offline mode if the spool is enabled (offline = False: always close)
+        if conn is None:
+            for conn in list(self.connections):
+                self.on_close(conf, conn, False)
+            return
+        if offline and conn.side == "server" and self.spool is not None and not conn.closed and not conn.peer.closed:
+            self.upstream_lost(conf, conn)
+            return
         if conf.verbose: 
             #try / except to resolve errno 107: Transport endpoint is not connected 
             try: 
-                print("\t -", self.s.getpeername(), "has disconnected")
+                print("\t -", conn.sock.getpeername(), "has disconnected")
             except:  
                 print("\t -", "peer has disconnected")
 
-        #remove objects from input_list
-        self.input_list.remove(self.s)
-        self.input_list.remove(self.channel[self.s])
-        out = self.channel[self.s]
-        # close the connection with client
-        self.channel[out].close()  # equivalent to do self.s.close()
-        # close the connection with remote server
-        self.channel[self.s].close()
-        # delete both objects from channel dict
-        del self.channel[out]
-        del self.channel[self.s]
-
-    def on_recv(self,conf):
-        data = self.data      
+        for side in (conn, conn.peer):
+            if side is None or side.closed:
+                continue
+            side.closed = True
+            self.connections.discard(side)
+            self.pending.discard(side)
+            self.offline.discard(side)
+            if side.sock is None:
+                continue
+            try:
+                self.selector.unregister(side.sock)
+            except (KeyError, ValueError):
+                pass
+            side.sock.close()
+
+    def on_recv(self, conf, conn, data):
         print("")
         print("\t - " + "Growatt packet received:") 
-        print("\t\t ", self.channel[self.s])
+        print("\t\t ", conn.peer.sock)
         
         #test if record is not corrupted
-        vdata = "".join("{:02x}".format(n) for n in data)
-        validatecc = validate_record(vdata)
+        validatecc = validate_record(data)
         if validatecc != 0 : 
             print(f"\t - Grott - grottproxy - Invalid data record received, processing stopped for this record")
             #Create response if needed? 
@@ -194,20 +477,20 @@ class Proxy:
             return  
 
         # FILTER!!!!!!!! Detect if configure data is sent!
-        header = "".join("{:02x}".format(n) for n in data[0:8])
         if conf.blockcmd : 
+            header = data[0:8].hex()
             #standard everything is blocked!
             print("\t - " + "Growatt command block checking started") 
             blockflag = True 
             #partly block configure Shine commands                   
             if header[14:16] == "18" :         
                 if conf.blockcmd : 
-                    if header[6:8] == "05" or header[6:8] == "06" : confdata = decrypt(data) 
+                    if header[6:8] == "05" or header[6:8] == "06" : confdata = decrypt(data)
                     else :  confdata = data
 
                     #get conf command (location depends on record type), maybe later more flexibility is needed
-                    if header[6:8] == "06" : confcmd = confdata[76:80]
-                    else: confcmd = confdata[36:40]
+                    if header[6:8] == "06" : confcmd = confdata[38:40].hex()
+                    else: confcmd = confdata[18:20].hex()
                     
                     if header[14:16] == "18" : 
                         #do not block if configure time command of configure IP (if noipf flag set)
@@ -231,11 +514,15 @@ class Proxy:
                 print(format_multi_line("\t\t ",blockeddata))
                 return
 
-        # send data to destination
-        self.channel[self.s].send(data)
+        # send data to destination (offline mode: spool and respond locally)
+        if conn.peer.offline:
+            self.offline_record(conf, conn, data)
+        else:
+            self.send(conf, conn.peer, data)
         if len(data) > conf.minrecl :
-            #process received data
-            procdata(conf,data)    
+            #queue received data for processing
+            self.procqueue.put(data, repr(conn))    
+            if conf.archivesink is not None: conf.archivesink.put(data)
         else:     
             if conf.verbose: print("\t - " + 'Data less then minimum record length, data not processed') 
                 
\ No newline at end of file
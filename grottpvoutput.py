@@ -0,0 +1,146 @@
+# grottpvoutput.py Grott PVOutput output (sink)
+# Updated: 2026-10-18
+#
+# Statuses are collected per PVOutput system id and kind (inverter status, smart meter consumption, smart meter net)
+# and sent by a background thread with the batch status API (addbatchstatus.jsp, max 30 statuses per request) over a
+# persistent HTTP session: the first status of a system right away, after that at most once per pvuplimit minutes.
+# The upload limit per inverter is kept: one status per inverter serial and kind per pvuplimit minutes is queued,
+# statuses received in between are refused.
+# Statuses for the same date/time are coalesced (last one wins). When the PVOutput rate limit is reached (HTTP 403
+# "Exceeded ..." or X-Rate-Limit-Remaining 0) sending is held till X-Rate-Limit-Reset, network and server errors are
+# retried with backoff. The statuses stay queued meanwhile (max pvqueue per system and kind, oldest dropped).
+
+import collections
+import threading
+import time
+
+#requests is only needed if PVOutput is enabled
+try:
+    import requests
+except ImportError:
+    requests = None
+
+from grottmetrics import metrics
+
+# request parameters per kind: c1 = 3 v3 is lifetime energy (day energy calculated by PVOutput), n = 1 net data
+KINDS = {"status": {}, "consumption": {"c1": 3}, "net": {"n": 1}}
+# batch status data: date, time, v1 .. v6
+BATCHFIELDS = ("v1", "v2", "v3", "v4", "v5", "v6")
+BATCHSIZE = 30
+
+
+class GrottPvOutput:
+
+    def __init__(self, conf):
+        self.conf = conf
+        if requests is None:
+            print("\t - " + "Grott requests library not installed in Python, PVOutput disabled")
+            raise SystemExit("Grott PVOutput initialisation error")
+        self.session = requests.Session()
+        self.session.headers["X-Pvoutput-Apikey"] = conf.pvapikey
+        self.interval = conf.pvuplimit * 60
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.pending = {}                                   # (systemid, kind): {(date, time): status}
+        self.sent = {}                                      # (systemid, kind): time (monotonic) of last batch
+        self.accepted = {}                                  # (serial, kind): time (monotonic) of last queued status
+        self.holdoff = 0                                    # no requests before this time (monotonic)
+        self.backoff = 0
+
+        metrics.set("pvoutput_pending", lambda: sum(len(statuses) for statuses in list(self.pending.values())))
+        self.thread = threading.Thread(target=self.run, name="grottpvoutput", daemon=True)
+        self.thread.start()
+
+    def add(self, systemid, kind, status, serial=None):
+        # queue status (dict with d, t and v1 .. v6 values) of inverter serial, called by procdata
+        now = time.monotonic()
+        with self.lock:
+            if serial is not None:
+                if now - self.accepted.get((serial, kind), -self.interval) < self.interval:
+                    metrics.inc("pvoutput_limited")
+                    if self.conf.verbose: print("\t - " + "Grott PVOutput update refused for", serial, "due to time limitation")
+                    return
+                self.accepted[(serial, kind)] = now
+            statuses = self.pending.setdefault((systemid, kind), collections.OrderedDict())
+            slot = (status["d"], status["t"])
+            statuses.pop(slot, None)
+            statuses[slot] = status
+            if len(statuses) > self.conf.pvqueue:
+                statuses.popitem(last=False)
+                metrics.inc("pvoutput_dropped")
+        self.wakeup.set()
+
+    def run(self):
+        while True:
+            self.wakeup.wait(1)
+            self.wakeup.clear()
+            now = time.monotonic()
+            if now < self.holdoff:
+                continue
+            with self.lock:
+                due = [key for key, statuses in self.pending.items() if statuses and now - self.sent.get(key, -self.interval) >= self.interval]
+            for key in due:
+                try:
+                    if not self.send(key):
+                        break
+                except Exception as e:
+                    metrics.inc("pvoutput_errors")
+                    print("\t - " + "Grott PVOutput send error :", repr(e))
+
+    def send(self, key):
+        # send (max BATCHSIZE) queued statuses of a system id and kind, returns False if sending has to be held
+        systemid, kind = key
+        with self.lock:
+            batch = list(self.pending[key].items())[:BATCHSIZE]
+        data = ";".join(self.batchline(status) for slot, status in batch)
+        params = dict(KINDS[kind], data=data)
+        if self.conf.verbose: print("\t - " + "Grott PVOutput send batch systemid:", systemid, kind, params)
+
+        try:
+            reqret = self.session.post(self.conf.pvurl, data=params, headers={"X-Pvoutput-SystemId": systemid}, timeout=self.conf.pvtimeout)
+        except requests.RequestException as e:
+            self.retry("Grott PVOutput not reachable : " + str(e))
+            return False
+        if self.conf.verbose: print("\t - " + "Grott PVOutput response:", reqret.status_code, reqret.text)
+
+        remaining = reqret.headers.get("X-Rate-Limit-Remaining")
+        reset = reqret.headers.get("X-Rate-Limit-Reset")
+        if reqret.status_code == 429 or (reqret.status_code == 403 and "Exceeded" in reqret.text):
+            metrics.inc("pvoutput_ratelimited")
+            self.retry("Grott PVOutput rate limit reached : " + reqret.text.strip(), reset)
+            return False
+        if reqret.status_code >= 500:
+            self.retry("Grott PVOutput server error : " + str(reqret.status_code))
+            return False
+
+        # sent (or rejected, e.g. invalid data or system id: not retried)
+        with self.lock:
+            for slot, status in batch:
+                self.pending[key].pop(slot, None)
+        self.sent[key] = time.monotonic()
+        self.backoff = 0
+        if reqret.status_code == 200:
+            metrics.inc("pvoutput_sent", len(batch))
+        else:
+            metrics.inc("pvoutput_rejected", len(batch))
+            print("\t - " + "Grott PVOutput statuses rejected, systemid:", systemid, reqret.status_code, reqret.text.strip())
+        if remaining == "0":
+            self.retry("Grott PVOutput rate limit reached", reset)
+            return False
+        return True
+
+    def retry(self, message, reset=None):
+        # hold sending: till the rate limit reset time (epoch seconds) if known, otherwise with doubling backoff
+        try:
+            wait = max(float(reset) - time.time(), 1)
+        except (TypeError, ValueError):
+            self.backoff = min(max(self.backoff * 2, 30), 3600)
+            wait = self.backoff
+        self.holdoff = time.monotonic() + wait
+        print("\t - " + message + ", retry in", int(wait), "seconds")
+
+    @staticmethod
+    def batchline(status):
+        # date,time,v1,v2,v3,v4,v5,v6 (trailing empty values left out)
+        values = [status["d"], status["t"]] + [str(status.get(field, "")) for field in BATCHFIELDS]
+        return ",".join(values).rstrip(",")
@@ -0,0 +1,218 @@
+# grottreplay.py Grott replay mode
+# Updated: 2026-10-18
+#
+# Replay mode (-m replay -r <file> ...) processes pcap / pcapng captures (e.g. made with tcpdump on the system that
+# runs sniff mode) like sniff mode does: the frames go through the sniffer (Ethernet, IPv4, TCP, TCP reassembly,
+# framer) and procdata, with the capture time as receive (server) time. Files are memory mapped and read frame by
+# frame. Records are processed as fast as the outputs accept them (waits if the MQTT, InfluxDB or extension queue is
+# half full), at the end the outputs are flushed and the throughput is printed. Without outputs (-nm, no InfluxDB) it
+# is a repeatable benchmark of the decode path.
+
+import mmap
+import struct
+import time
+
+from grottmetrics import metrics
+from grottprotocol import framestats
+from grottsniffer import Sniff
+
+# link types (pcap LINKTYPE_*): ethernet, raw IP, Linux cooked capture (tcpdump -i any) v1 and v2
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = (101, 228)
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_LINUX_SLL2 = 276
+# ethernet header (no MAC addresses) for frames of other link types
+ETHERNET_IPV4 = b"\x00" * 12 + b"\x08\x00"
+
+
+def waitoutputs(busy, timeout):
+    # wait while busy() returns outputs (with a half full queue), returns the outputs that did not make progress in
+    # timeout seconds (empty list: the queues are emptied)
+    pending = None
+    deadline = time.monotonic() + timeout
+    while True:
+        outputs = busy()
+        if not outputs:
+            return []
+        left = sum(output.pending() for output in outputs)
+        if left != pending:
+            pending = left
+            deadline = time.monotonic() + timeout
+        elif time.monotonic() >= deadline:
+            return outputs
+        time.sleep(0.01)
+
+
+def pcapframes(view):
+    # pcap: yields (capture time, link type, frame)
+    magic = bytes(view[:4])
+    if magic in (b"\xd4\xc3\xb2\xa1", b"\x4d\x3c\xb2\xa1"):
+        order = "<"
+    elif magic in (b"\xa1\xb2\xc3\xd4", b"\xa1\xb2\x3c\x4d"):
+        order = ">"
+    else:
+        raise ValueError("not a pcap or pcapng file")
+    # microsecond or nanosecond timestamps
+    scale = 1e-9 if magic in (b"\x4d\x3c\xb2\xa1", b"\xa1\xb2\x3c\x4d") else 1e-6
+    linktype = struct.unpack_from(order + "I", view, 20)[0] & 0x0fffffff
+    header = struct.Struct(order + "IIII")
+    pos = 24
+    end = len(view)
+    while pos + 16 <= end:
+        sec, frac, caplen, origlen = header.unpack_from(view, pos)
+        pos += 16
+        if pos + caplen > end:
+            # last frame cut off (capture still running)
+            break
+        yield sec + frac * scale, linktype, view[pos:pos + caplen]
+        pos += caplen
+
+
+def pcapngframes(view):
+    # pcapng: yields (capture time, link type, frame), time None for simple packet blocks
+    order = "<"
+    interfaces = []
+    pos = 0
+    end = len(view)
+    while pos + 12 <= end:
+        blocktype, = struct.unpack_from(order + "I", view, pos)
+        if blocktype == 0x0a0d0d0a:
+            # section header: byte order, interface ids start again
+            order = "<" if bytes(view[pos + 8:pos + 12]) == b"\x4d\x3c\x2b\x1a" else ">"
+            interfaces = []
+        blocklength, = struct.unpack_from(order + "I", view, pos + 4)
+        if blocklength < 12 or pos + blocklength > end:
+            break
+        if blocktype == 1:
+            # interface description: link type, timestamp resolution option (if_tsresol, default microseconds)
+            linktype, = struct.unpack_from(order + "H", view, pos + 8)
+            scale = 1e-6
+            option = pos + 16
+            while option + 4 <= pos + blocklength - 4:
+                code, length = struct.unpack_from(order + "HH", view, option)
+                if code == 0:
+                    break
+                if code == 9 and length >= 1:
+                    resolution = view[option + 4]
+                    scale = 2.0 ** -(resolution & 0x7f) if resolution & 0x80 else 10.0 ** -resolution
+                option += 4 + (length + 3) // 4 * 4
+            interfaces.append((linktype, scale))
+        elif blocktype == 6 and interfaces:
+            # enhanced packet: interface id, timestamp (high, low), captured length
+            interface, high, low, caplen = struct.unpack_from(order + "IIII", view, pos + 8)
+            linktype, scale = interfaces[interface]
+            yield ((high << 32) | low) * scale, linktype, view[pos + 28:pos + 28 + caplen]
+        elif blocktype == 3 and interfaces:
+            # simple packet: original length only, no timestamp
+            origlen, = struct.unpack_from(order + "I", view, pos + 8)
+            yield None, interfaces[0][0], view[pos + 12:pos + 12 + min(origlen, blocklength - 16)]
+        pos += blocklength
+
+
+def readcapture(path):
+    # yields (capture time, link type, frame) of a pcap or pcapng file, frames are memoryviews on the mapped file
+    with open(path, "rb") as capture:
+        try:
+            mapped = mmap.mmap(capture.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty file
+            return
+    view = memoryview(mapped)
+    if bytes(view[:4]) == b"\x0a\x0d\x0d\x0a":
+        yield from pcapngframes(view)
+    else:
+        yield from pcapframes(view)
+
+
+class Replay(Sniff):
+
+    def capture(self, conf):
+        # no packet socket: frames are read from the capture files
+        self.files = conf.replayfiles
+        self.conf = conf
+        self.stats = {"files": 0, "frames": 0, "bytes": 0, "skipped": 0}
+        self.stalled = False
+        print("\nGrott replay mode started, files:", " ".join(self.files))
+
+    def frames(self):
+        for path in self.files:
+            if self.conf.verbose: print("\t - Grott replay file:", path)
+            try:
+                for received, linktype, frame in readcapture(path):
+                    self.stats["frames"] += 1
+                    self.stats["bytes"] += len(frame)
+                    if linktype == LINKTYPE_ETHERNET:
+                        pass
+                    elif linktype == LINKTYPE_LINUX_SLL:
+                        frame = ETHERNET_IPV4[:12] + frame[14:16] + frame[16:]
+                    elif linktype == LINKTYPE_LINUX_SLL2:
+                        frame = ETHERNET_IPV4[:12] + frame[0:2] + frame[20:]
+                    elif linktype in LINKTYPE_RAW:
+                        frame = ETHERNET_IPV4 + frame
+                    else:
+                        self.stats["skipped"] += 1
+                        continue
+                    self.received = received
+                    yield frame
+                    self.throttle()
+                self.stats["files"] += 1
+            except (OSError, ValueError) as e:
+                print("\t - Grott replay file can not be read:", path, e)
+
+    def busy(self):
+        # outputs with a half full queue that are connected and writing (a disconnected MQTT client or an InfluxDB
+        # writer in backoff does not empty its queue, it drops or spills)
+        conf = self.conf
+        busy = []
+        if conf.mqttsink is not None and conf.mqttsink.connected.is_set() and conf.mqttsink.pending() * 2 > conf.mqttqueue > 0:
+            busy.append(conf.mqttsink)
+        if conf.ifsink is not None and conf.ifsink.backoff == 0 and conf.ifsink.pending() * 2 > conf.ifqueue:
+            busy.append(conf.ifsink)
+        if conf.extensions is not None and conf.extensions.pending() * 2 > conf.extqueue:
+            busy.append(conf.extensions)
+        return busy
+
+    def throttle(self, timeout=10):
+        # wait while an output queue is half full (process as fast as the outputs accept the records), stop waiting
+        # for the rest of the replay if the outputs do not make progress
+        if self.stalled:
+            return
+        busy = waitoutputs(self.busy, timeout)
+        if busy:
+            self.stalled = True
+            print("\t - Grott replay output queue not emptied in", timeout, "seconds, replay continues without waiting:",
+                  ", ".join(type(sink).__name__ for sink in busy))
+
+    def flush(self, timeout=60):
+        # process records held by the TCP reassembly, wait till the outputs are done (or do not make progress)
+        for tcpflow in self.flows.values():
+            records = []
+            while tcpflow.pending:
+                tcpflow.skipgap(records)
+            self.process(self.conf, records)
+        sinks = [sink for sink in (self.conf.mqttsink, self.conf.ifsink, self.conf.extensions) if sink is not None]
+        pending = None
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            left = sum(sink.pending() for sink in sinks)
+            if left == 0:
+                break
+            if left != pending:
+                pending = left
+                deadline = time.monotonic() + timeout
+            time.sleep(0.1)
+        if self.conf.ifsink is not None:
+            self.conf.ifsink.stop()
+
+    def main(self, conf):
+        started = time.monotonic()
+        records = framestats["records"]
+        super().main(conf)
+        self.flush()
+        elapsed = max(time.monotonic() - started, 1e-6)
+        records = framestats["records"] - records
+        print("\nGrott replay ready: {} files, {} frames ({} skipped), {:.1f} MB, {} records in {:.1f} s".format(
+            self.stats["files"], self.stats["frames"], self.stats["skipped"], self.stats["bytes"] / 1e6, records, elapsed))
+        print("\t - throughput: {:.0f} frames/s, {:.0f} records/s, {:.1f} MB/s".format(
+            self.stats["frames"] / elapsed, records / elapsed, self.stats["bytes"] / 1e6 / elapsed))
+        if conf.verbose: print("\t - Grott metrics: ", metrics.snapshot())
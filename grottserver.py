@@ -7,12 +7,13 @@ import threading
 import time
 import http.server
 import json, codecs 
-from itertools import cycle
 from io import BytesIO
 from datetime import datetime
 from urllib.parse import urlparse, parse_qs, parse_qsl  
 from collections import defaultdict
 
+from grottprotocol import encrypt, decrypt_into, validate_record, ack_record, GrottFramer, MAX_RECORD_LEN
+
 # grottserver.py emulates the server.growatt.com website and is initial developed for debugging and testing grott.
 # Updated: 2023-01-20
 # Version:
@@ -31,63 +32,13 @@ sendseq = 1
 # Formats multi-line data
 def format_multi_line(prefix, string, size=80):
     size -= len(prefix)
-    if isinstance(string, bytes):
+    if isinstance(string, (bytes, bytearray, memoryview)):
         string = ''.join(r'\x{:02x}'.format(byte) for byte in string)
         if size % 2:
             size -= 1
     return '\n'.join([prefix + line for line in textwrap.wrap(string, size)])
 
 
-# encrypt / decrypt data.
-def decrypt(decdata):
-
-    ndecdata = len(decdata)
-
-    # Create mask and convert to hexadecimal
-    mask = "Growatt"
-    hex_mask = ['{:02x}'.format(ord(x)) for x in mask]
-    nmask = len(hex_mask)
-
-    # start decrypt routine
-    unscrambled = list(decdata[0:8])  # take unscramble header
-
-    for i, j in zip(range(0, ndecdata-8), cycle(range(0, nmask))):
-        unscrambled = unscrambled + [decdata[i+8] ^ int(hex_mask[j], 16)]
-
-    result_string = "".join("{:02x}".format(n) for n in unscrambled)
-
-    print("\t - " + "Grott - data decrypted V2")
-    return result_string
-
-def validate_record(xdata): 
-    # validata data record on length and CRC (for "05" and "06" records)
-    
-    data = bytes.fromhex(xdata)
-    ldata = len(data)
-    len_orgpayload = int.from_bytes(data[4:6],"big")
-    header = "".join("{:02x}".format(n) for n in data[0:8])
-    protocol = header[6:8]
-
-    if protocol in ("05","06"):
-        lcrc = 4
-        crc = int.from_bytes(data[ldata-2:ldata],"big")
-    else: 
-        lcrc = 0
-
-    len_realpayload = (ldata*2 - 12 -lcrc) / 2
-
-    if protocol != "02" :
-                crc_calc = libscrc.modbus(data[0:ldata-2])
-
-    if len_realpayload == len_orgpayload :
-        returncc = 0
-        if protocol != "02" and crc != crc_calc:     
-            returncc = 8    
-    else : 
-        returncc = 8
-
-    return(returncc)
-
 def htmlsendresp(self, responserc, responseheader,  responsetxt) : 
         #send response
         self.send_response(responserc)
@@ -124,9 +75,9 @@ def createtimecommand(protocol,loggerid,sequenceno) :
 
         if protocol != "02" :
             #encrypt message 
-            body = decrypt(body) 
-            crc16 = libscrc.modbus(bytes.fromhex(body))
-            body = bytes.fromhex(body) + crc16.to_bytes(2, "big")
+            body = encrypt(body)
+            crc16 = libscrc.modbus(body)
+            body = body + crc16.to_bytes(2, "big")
         
         if verbose:
             print("\t - Grottserver - Time command created :")
@@ -327,9 +278,9 @@ class GrottHttpRequestHandler(http.server.BaseHTTPRequestHandler):
 
                 if loggerreg[dataloggerid]["protocol"] != "02" :
                     #encrypt message 
-                    body = decrypt(body) 
-                    crc16 = libscrc.modbus(bytes.fromhex(body))
-                    body = bytes.fromhex(body) + crc16.to_bytes(2, "big")
+                    body = encrypt(body)
+                    crc16 = libscrc.modbus(body)
+                    body = body + crc16.to_bytes(2, "big")
 
                 # add header
                 if verbose:
@@ -663,9 +614,9 @@ class GrottHttpRequestHandler(http.server.BaseHTTPRequestHandler):
                 
                 if loggerreg[dataloggerid]["protocol"] != "02" :
                     #encrypt message 
-                    body = decrypt(body) 
-                    crc16 = libscrc.modbus(bytes.fromhex(body))
-                    body = bytes.fromhex(body) + crc16.to_bytes(2, "big")
+                    body = encrypt(body)
+                    crc16 = libscrc.modbus(body)
+                    body = body + crc16.to_bytes(2, "big")
 
                 # queue command 
                 qname = loggerreg[dataloggerid]["ip"] + "_" + str(loggerreg[dataloggerid]["port"])
@@ -754,6 +705,12 @@ class sendrecvserver:
         self.inputs = [self.server]
         self.outputs = []
         self.send_queuereg = send_queuereg
+        # preallocated receive and decrypt buffers, records are processed as memoryview slices (no copies)
+        self.buffer = bytearray(1024)
+        self.view = memoryview(self.buffer)
+        self.scratch = bytearray(MAX_RECORD_LEN)
+        # one framer per connection (records can be split over / coalesced in reads)
+        self.framers = {}
         
         print(f"\t - Grottserver - Ready to listen at: {host}:{port}")
 
@@ -780,9 +737,10 @@ class sendrecvserver:
             else:
                 # Existing connection
                 try:
-                    data = s.recv(1024)
-                    if data:
-                        self.process_data(s, data)
+                    nbytes = s.recv_into(self.buffer)
+                    if nbytes:
+                        for record in self.framers[s].feed(self.view[:nbytes]):
+                            self.process_data(s, record)
                     else:
                         # Empty read means connection is closed, perform cleanup
                         self.close_connection(s)
@@ -837,6 +795,7 @@ class sendrecvserver:
         try: 
             connection, client_address = s.accept()
             connection.setblocking(0)
+            self.framers[connection] = GrottFramer()
             self.inputs.append(connection)
             self.outputs.append(connection)
             print(f"\t - Grottserver - Socket connection received from {client_address}")
@@ -860,6 +819,7 @@ class sendrecvserver:
             if s in self.outputs:
                 self.outputs.remove(s)
             self.inputs.remove(s)
+            self.framers.pop(s, None)
             client_address, client_port = s.getpeername() 
             qname = client_address + "_" + str(client_port)
             del send_queuereg[qname]
@@ -900,84 +860,62 @@ class sendrecvserver:
                 print("\t - " + "Grottserver - Original Data:")
                 print(format_multi_line("\t\t ", data))
             
-            #validate data (Length + CRC for 05/06)
-            #join gebeurt nu meerdere keren! Stroomlijnen!!!! 
-            vdata = "".join("{:02x}".format(n) for n in data)
-            validatecc = validate_record(vdata)
+            #validate data (Length + CRC for 05/06), data is a memoryview on the receive buffer
+            validatecc = validate_record(data)
             if validatecc != 0 : 
                 print(f"\t - Grottserver - Invalid data record received, processing stopped for this record")
                 #Create response if needed? 
                 #self.send_queuereg[qname].put(response)
                 return  
 
-            # Create header
-            header = "".join("{:02x}".format(n) for n in data[0:8])
-            protocol = header[6:8]
-            sequencenumber = header[0:4]
-            protocol = header[6:8]
-            command = header[14:16]
+            # Create header (copy, the receive buffer is reused)
+            header = bytes(data[0:8])
+            protocol = "{:02x}".format(header[3])
+            command = "{:02x}".format(header[7])
+            devrec = header[6:8].hex()
             if protocol in ("05","06") :
-                result_string = decrypt(data) 
+                plain = decrypt_into(data, self.scratch)
             else :         
-                result_string = "".join("{:02x}".format(n) for n in data)
+                plain = data
             if verbose:
                 print("\t - Grottserver - Plain record: ")
-                print(format_multi_line("\t\t ", result_string))
-            loggerid = result_string[16:36]
-            loggerid = codecs.decode(loggerid, "hex").decode('utf-8') 
+                print(format_multi_line("\t\t ", plain.hex()))
+            loggerid = bytes(plain[8:18]).decode('utf-8') 
 
             # Prepare response
-            if header[14:16] in ("16"):
+            if command == "16":
                 # if ping send data as reply
-                response = data
+                response = ack_record(data)
                 if verbose:
                     print("\t - Grottserver - 16 - Ping response: ")
                     print(format_multi_line("\t\t ", response))
             
 
-            elif header[14:16] in ("03", "04", "50", "29", "1b", "20"):
+            elif command in ("03", "04", "50", "29", "1b", "20"):
                 # if datarecord send ack.
-                print("\t - Grottserver - " + header[12:16] + " data record received")
+                print("\t - Grottserver - " + devrec + " data record received")
                 
-                # create ack response
-                if header[6:8] == '02': 
-                    #protocol 02, unencrypted ack
-                    response = bytes.fromhex(header[0:8] + '0003' + header[12:16] + '00')
-                else: 
-                    # protocol 05/06, encrypted ack
-                    headerackx = bytes.fromhex(header[0:8] + '0003' + header[12:16] + '47')
-                    # Create CRC 16 Modbus
-                    crc16 = libscrc.modbus(headerackx)
-                    # create response
-                    response = headerackx + crc16.to_bytes(2, "big")
+                # create ack response (protocol 02 unencrypted, 05/06 encrypted with CRC)
+                response = ack_record(data)
                 if verbose:
                     print("\t - Grottserver - Response: ")
                     print(format_multi_line("\t\t", response))
 
-                if header[14:16] == "03" : 
+                if command == "03" : 
                 # init record register logger/inverter id (including sessionid?)
-                # decrypt body. 
-                    if header[6:8] in ("05","06") :
-                        #print("header1 : ", header[6:8])
-                        result_string = decrypt(data) 
-                    else :         
-                        result_string = data.hex()   
-            
-                    loggerid = result_string[16:36]
-                    loggerid = codecs.decode(loggerid, "hex").decode('utf-8')
-                    if header[6:8] in ("02","05") :                    
-                        inverterid = result_string[36:56]
+                    if protocol in ("02","05") :                    
+                        inverterid = plain[18:28]
                     else : 
-                        inverterid = result_string[76:96]
-                    inverterid = codecs.decode(inverterid, "hex").decode('utf-8')
+                        inverterid = plain[38:48]
+                    inverterid = bytes(inverterid).decode('utf-8')
 
                     try:
-                        loggerreg[loggerid].update({"ip" : client_address, "port" : client_port, "protocol" : header[6:8]})
+                        loggerreg[loggerid].update({"ip" : client_address, "port" : client_port, "protocol" : protocol})
                     except: 
-                        loggerreg[loggerid] = {"ip" : client_address, "port" : client_port, "protocol" : header[6:8]}
+                        loggerreg[loggerid] = {"ip" : client_address, "port" : client_port, "protocol" : protocol}
                         
                     #add invertid
-                    loggerreg[loggerid].update({inverterid : {"inverterno" : header[12:14], "power" : 0}} ) 
+                    loggerreg[loggerid].update({inverterid : {"inverterno" : "{:02x}".format(header[6]), "power" : 0}} ) 
                     #send response
                     self.send_queuereg[qname].put(response) 
                     #wait some time before response is processed 
@@ -986,27 +924,27 @@ class sendrecvserver:
                     response = createtimecommand(protocol,loggerid,"0001")
                     if verbose: print("\t - Grottserver 03 announce data record processed") 
 
-            elif header[14:16] in ("19","05","06","18"):
-                if verbose: print("\t - Grottserver - " + header[12:16] + " record received, no response needed")
+            elif command in ("19","05","06","18"):
+                if verbose: print("\t - Grottserver - " + devrec + " record received, no response needed")
                 
+                # byte offsets in the plain record
                 offset = 0
-                if protocol in ("06") : 
-                    offset = 40
+                if protocol == "06" : 
+                    offset = 20
 
-                register = int(result_string[36+offset:40+offset],16) 
+                register = int.from_bytes(plain[18+offset:20+offset],"big") 
                 if command == "05" : 
-                    #value = result_string[40+offset:44+offset]
-                    value = result_string[44+offset:48+offset]
+                    value = plain[22+offset:24+offset].hex()
                 elif command == "06" : 
-                    result = result_string[40+offset:42+offset] 
+                    result = plain[20+offset:21+offset].hex() 
                     #print("06 response result :", result)
-                    value = result_string[42+offset:46+offset]      
+                    value = plain[21+offset:23+offset].hex()      
                 elif command == "18" : 
-                    result = result_string[40+offset:42+offset] 
+                    result = plain[20+offset:21+offset].hex() 
                 else : 
                     # "19" response take length into account 
-                    valuelen = int(result_string[40+offset:44+offset],16)
-                    value = codecs.decode(result_string[44+offset:44+offset+valuelen*2], "hex").decode('utf-8') 
+                    valuelen = int.from_bytes(plain[20+offset:22+offset],"big")
+                    value = bytes(plain[22+offset:22+offset+valuelen]).decode('utf-8') 
                 
                 regkey = "{:04x}".format(register)
                 if command == "06" : 
@@ -1021,12 +959,12 @@ class sendrecvserver:
 
                 response = None
 
-            elif header[14:16] in ("10") :
-                if verbose: print("\t - Grottserver - " + header[12:16] + " record received, no response needed")
+            elif command == "10" :
+                if verbose: print("\t - Grottserver - " + devrec + " record received, no response needed")
 
-                startregister = int(result_string[76:80],16)
-                endregister = int(result_string[80:84],16)
-                value = result_string[84:86]
+                startregister = int.from_bytes(plain[38:40],"big")
+                endregister = int.from_bytes(plain[40:42],"big")
+                value = plain[42:43].hex()
                 
                 regkey = "{:04x}".format(startregister) + "{:04x}".format(endregister)
                 commandresponse[command][regkey] = {"value" : value} 
@@ -3,24 +3,256 @@ import socket
 #import time
 import sys
 import struct
+import ctypes
+import mmap
+import select
+import time
 #import textwrap
 #from itertools import cycle # to support "cycling" the iterator
 #import time, json, datetime, codecs
 
 from grottdata import procdata
+from grottprotocol import GrottFramer, framestats, validate_record, FRAME_MAX_LEN
+from grottmetrics import metrics
+
+# setsockopt option to attach a classic BPF program (linux/filter.h), not defined in all python versions
+SO_ATTACH_FILTER = getattr(socket, "SO_ATTACH_FILTER", 26)
+
+def bpf_program(ip, port):
+    # classic BPF (struct sock_filter: code, jt, jf, k) for: IPv4, TCP, destination ip and port, not a fragment
+    # (same as tcpdump "tcp and dst host <ip> and dst port <port>"), accepted frames are passed complete
+    target = struct.unpack("!I", socket.inet_aton(ip))[0]
+    program = [
+        (0x28, 0, 0, 12),                   # ldh [12]              ethernet type
+        (0x15, 0, 10, 0x0800),              # jeq #0x800            IPv4 (else reject)
+        (0x30, 0, 0, 23),                   # ldb [23]              IP protocol
+        (0x15, 0, 8, 6),                    # jeq #6                TCP
+        (0x20, 0, 0, 30),                   # ld [30]               destination ip
+        (0x15, 0, 6, target),               # jeq #ip
+        (0x28, 0, 0, 20),                   # ldh [20]              fragment offset
+        (0x45, 4, 0, 0x1fff),               # jset #0x1fff          no TCP header in a fragment
+        (0xb1, 0, 0, 14),                   # ldxb 4*([14]&0xf)     IP header length
+        (0x48, 0, 0, 16),                   # ldh [x + 16]          TCP destination port
+        (0x15, 0, 1, port),                 # jeq #port
+        (0x06, 0, 0, 0x40000),              # ret #262144           accept
+        (0x06, 0, 0, 0),                    # ret #0                reject
+    ]
+    return b"".join(struct.pack("HBBI", *instruction) for instruction in program)
+
+def attach_filter(sock, program):
+    # struct sock_fprog: number of instructions and pointer to the program (copied by the kernel)
+    buffer = ctypes.create_string_buffer(program)
+    fprog = struct.pack("HL", len(program) // 8, ctypes.addressof(buffer))
+    sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+
+# packet socket ring (linux/if_packet.h)
+SOL_PACKET = 263
+PACKET_RX_RING = 5
+PACKET_VERSION = 10
+TPACKET_V3 = 2
+TP_STATUS_KERNEL = 0
+TP_STATUS_USER = 1
+RING_BLOCKSIZE = 1 << 20
+RING_FRAMESIZE = 2048
+RING_TIMEOUT = 100                          # ms, a block is passed to grott when full or after this time
+
+class GrottRing:
+    """TPACKET_V3 receive ring: the kernel fills blocks of frames in memory shared with grott (mmap), frames are read
+    from a block without a receive call per frame and handed over as memoryviews into the ring."""
+
+    def __init__(self, sock, blocks):
+        self.blocks = blocks
+        sock.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V3)
+        # struct tpacket_req3: block size, block nr, frame size, frame nr, retire block timeout, sizeof priv, features
+        req = struct.pack("7I", RING_BLOCKSIZE, blocks, RING_FRAMESIZE, RING_BLOCKSIZE * blocks // RING_FRAMESIZE, RING_TIMEOUT, 0, 0)
+        sock.setsockopt(SOL_PACKET, PACKET_RX_RING, req)
+        self.ring = mmap.mmap(sock.fileno(), RING_BLOCKSIZE * blocks, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+        self.view = memoryview(self.ring)
+        self.poll = select.poll()
+        self.poll.register(sock, select.POLLIN | select.POLLERR)
+
+    def frames(self):
+        # yields the frames (memoryview, valid till the next frame is asked) block by block
+        block = 0
+        while True:
+            offset = block * RING_BLOCKSIZE
+            # struct tpacket_block_desc: version, offset to priv, block status, number of packets, offset to first packet
+            status, npackets, first = struct.unpack_from("III", self.ring, offset + 8)
+            if not status & TP_STATUS_USER:
+                self.poll.poll(1000)
+                continue
+            pos = offset + first
+            for i in range(npackets):
+                # struct tpacket3_hdr: next offset, sec, nsec, snaplen, len, status, mac offset
+                nextoffset, snaplen, mac = struct.unpack_from("I 8x I 8x H", self.ring, pos)
+                yield self.view[pos + mac:pos + mac + snaplen]
+                pos += nextoffset
+            # block done: return it to the kernel
+            struct.pack_into("I", self.ring, offset + 8, TP_STATUS_KERNEL)
+            block = (block + 1) % self.blocks
+
+# TCP reassembly: out of order data per flow (bytes), hole in the sequence skipped after (s), idle flow removed
+# after (s), max flows (the longest idle flows are removed first)
+FLOW_BUFFER = 65536
+FLOW_GAPTIMEOUT = 5
+FLOW_IDLE = 600
+FLOW_MAX = 10000
+
+# reassembly statistics (all flows): active flows, duplicate (retransmitted) and out of order segments, sequence holes
+# skipped (data lost, e.g. not captured), flows removed (idle or flow table full)
+flowstats = {"flows": 0, "duplicate": 0, "reordered": 0, "gaps": 0, "evicted": 0}
+
+class GrottFlow:
+    """TCP reassembly for one flow (datalogger to Growatt server): segments are put in sequence order, duplicates and
+    overlaps are dropped, the in order stream is fed to the framer (returns the complete Growatt records)."""
+
+    __slots__ = ("next", "pending", "pendingsize", "gapsince", "framer", "seen")
+
+    def __init__(self, seq=None, maxrecl=FRAME_MAX_LEN):
+        self.next = seq                                     # next expected sequence number (None: not known yet)
+        self.pending = {}                                   # out of order segments: sequence number: bytes
+        self.pendingsize = 0
+        self.gapsince = None                                # time (monotonic) the first out of order segment arrived
+        self.framer = GrottFramer(maxrecl)
+        self.seen = time.monotonic()
+
+    def feed(self, seq, data):
+        # returns the records completed by this segment (memoryviews, valid till the next frame)
+        self.seen = time.monotonic()
+        if self.next is None:
+            # flow joined after the SYN (e.g. grott restarted): start at this segment
+            self.next = seq
+        records = []
+        distance = (seq - self.next + 0x80000000) % 0x100000000 - 0x80000000
+        if distance + len(data) <= 0:
+            flowstats["duplicate"] += 1
+        elif distance > 0:
+            # data missing before this segment: keep it till the hole is filled (or skipped)
+            flowstats["reordered"] += 1
+            if seq not in self.pending:
+                self.pending[seq] = bytes(data)
+                self.pendingsize += len(data)
+            if self.gapsince is None:
+                self.gapsince = self.seen
+        else:
+            self.deliver(data[-distance:], records)
+        self.drain(records)
+        self.checkgap(self.seen, records)
+        return records
+
+    def checkgap(self, now, records):
+        # skip a hole that is not filled in time or if the out of order data does not fit in the buffer
+        if self.pending and (now - self.gapsince >= FLOW_GAPTIMEOUT or self.pendingsize > FLOW_BUFFER):
+            self.skipgap(records)
+
+    def first(self):
+        # pending segment with the lowest sequence number (relative to the next expected)
+        return min(self.pending, key=lambda seq: (seq - self.next + 0x80000000) % 0x100000000)
+
+    def deliver(self, data, records):
+        self.next = (self.next + len(data)) % 0x100000000
+        records.extend(self.framer.feed(data))
+
+    def drain(self, records):
+        # deliver pending segments that are in order now
+        while self.pending:
+            seq = self.first()
+            distance = (seq - self.next + 0x80000000) % 0x100000000 - 0x80000000
+            if distance > 0:
+                return
+            data = self.pending.pop(seq)
+            self.pendingsize -= len(data)
+            if distance + len(data) > 0:
+                self.deliver(data[-distance:], records)
+        self.gapsince = None
+
+    def skipgap(self, records):
+        # data in the hole will not come (not captured): continue after it, a record cut by the hole is lost
+        flowstats["gaps"] += 1
+        self.framer.buffer.clear()
+        self.next = self.first()
+        self.gapsince = time.monotonic()
+        self.drain(records)
 
 class Sniff:
     def __init__(self,conf):
+        self.capture(conf)
+        # receive time of the current frame (epoch seconds), None: now (live capture)
+        self.received = None
+        # TCP reassembly per flow (records can be split over / coalesced in segments, segments can be retransmitted)
+        self.flows = {}
+        self.flowsweep = time.monotonic()
+        metrics.register("framer", framestats)
+        metrics.register("sniff", flowstats)
+        metrics.start(conf)
+
+    def capture(self, conf):
+        # open the packet socket (frame source, replaced in replay mode)
         self.conn = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.ntohs(3))
+        # kernel filter: only Growatt TCP segments are passed to grott (not with trace, trace shows all frames)
+        if not conf.trace: 
+            try: 
+                attach_filter(self.conn, bpf_program(socket.gethostbyname(conf.growattip), conf.growattport))
+                if conf.verbose: print("\t - Grott sniff kernel filter attached for", conf.growattip, conf.growattport)
+            except Exception as e: 
+                print("\t - Grott sniff kernel filter not attached, all frames are checked by grott :", e)
+        # mmap ring capture (optional)
+        self.ring = None
+        if conf.sniffring: 
+            try: 
+                self.ring = GrottRing(self.conn, conf.sniffringblocks)
+                if conf.verbose: print("\t - Grott sniff TPACKET_V3 ring used, blocks:", conf.sniffringblocks)
+            except Exception as e: 
+                print("\t - Grott sniff ring capture not available, frames are received one by one :", e)
         # if conf.verbose: print("\nGrott monitoring started\n")
         if conf.verbose: 
             print("")
             print("\nGrott sniff mode started\n")
+        # preallocated frame buffer, frames and the protocol layers are memoryview slices of it (no copies)
+        self.buffer = bytearray(65535)
+        self.view = memoryview(self.buffer)
 
+    def process(self, conf, records):
+        for record in records:
+            # test if record is not corrupted (like the proxy), only valid records are processed and archived
+            if validate_record(record) != 0:
+                print("\t - Grott - grottsniffer - Invalid data record received, processing stopped for this record")
+                continue
+            if len(record) > conf.minrecl :
+                procdata(conf,record,self.received)    
+                if conf.archivesink is not None: conf.archivesink.put(record, self.received)
+            else:     
+                if conf.verbose: print("\t - " + 'Data less then minimum record length, data not processed') 
 
-    def main(self,conf):        
+    def sweep(self, conf):
+        # remove idle flows (and the longest idle flows if the flow table is full), skip holes not filled in time
+        now = self.flowsweep = time.monotonic()
+        for flow, tcpflow in list(self.flows.items()):
+            if now - tcpflow.seen > FLOW_IDLE:
+                del self.flows[flow]
+                flowstats["evicted"] += 1
+            else:
+                records = []
+                tcpflow.checkgap(now, records)
+                self.process(conf, records)
+        if len(self.flows) > FLOW_MAX:
+            # remove 10% more, the table is not sorted for every new flow
+            for flow, tcpflow in sorted(self.flows.items(), key=lambda item: item[1].seen)[:len(self.flows) - FLOW_MAX * 9 // 10]:
+                del self.flows[flow]
+                flowstats["evicted"] += 1
+
+    def receive(self):
+        # yields the frames received one by one (memoryview on the frame buffer)
         while True:
-            self.raw_data, self.addr = self.conn.recvfrom(65535)
+            nbytes = self.conn.recv_into(self.buffer)
+            yield self.view[:nbytes]
+
+    def frames(self):
+        return self.ring.frames() if self.ring is not None else self.receive()
+
+    def main(self,conf):        
+        for raw_data in self.frames():
+            self.raw_data = raw_data
             self.eth = Ethernet(self.raw_data)
             if conf.trace:     
                 print("\n" + "\t - " + 'Ethernet Frame:')
@@ -52,10 +284,20 @@ class Sniff:
                             print("\t\t\t - " + 'URG: {}, ACK: {}, PSH: {}'.format(self.tcp.flag_urg, self.tcp.flag_ack, self.tcp.flag_psh))
                             print("\t\t\t - " + 'RST: {}, SYN: {}, FIN:{}'.format(self.tcp.flag_rst, self.tcp.flag_syn, self.tcp.flag_fin))
 
-                        if len(self.tcp.data) > conf.minrecl :
-                            procdata(conf,self.tcp.data)    
-                        else:     
-                            if conf.verbose: print("\t - " + 'Data less then minimum record length, data not processed') 
+                        flow = (self.ipv4.src, self.tcp.src_port, self.ipv4.target, self.tcp.dest_port)
+                        if self.tcp.flag_syn:
+                            # new connection (the data starts after the SYN sequence number)
+                            self.flows[flow] = GrottFlow((self.tcp.sequence + 1) % 0x100000000, conf.maxrecl)
+                        elif len(self.tcp.data) > 0:
+                            tcpflow = self.flows.get(flow)
+                            if tcpflow is None:
+                                tcpflow = self.flows[flow] = GrottFlow(maxrecl=conf.maxrecl)
+                            self.process(conf, tcpflow.feed(self.tcp.sequence, self.tcp.data))
+                        if self.tcp.flag_fin or self.tcp.flag_rst:
+                            self.flows.pop(flow, None)
+                        if len(self.flows) > FLOW_MAX or time.monotonic() - self.flowsweep > 60:
+                            self.sweep(conf)
+                        flowstats["flows"] = len(self.flows)
                             
                         
     # Other IPv4 Not used 
@@ -79,13 +321,21 @@ def get_mac_addr(mac_raw):
 class Ethernet:
     def __init__(self, raw_data):
 
-        dest, src, prototype = struct.unpack('! 6s 6s H', raw_data[:14])
+        prototype, = struct.unpack_from('! H', raw_data, 12)
 
-        self.dest_mac = get_mac_addr(dest)
-        self.src_mac = get_mac_addr(src)
+        self.raw_data = raw_data
         self.proto = socket.htons(prototype)
         self.data = raw_data[14:]
 
+    # MAC addresses are only formatted when used (trace)
+    @property
+    def dest_mac(self):
+        return get_mac_addr(self.raw_data[:6])
+
+    @property
+    def src_mac(self):
+        return get_mac_addr(self.raw_data[6:12])
+
 #Unpacks IPV4 packet
 class IPv4:
 
@@ -93,10 +343,12 @@ class IPv4:
         version_header_length = raw_data[0]
         self.version = version_header_length >> 4
         self.header_length = (version_header_length & 15) * 4
-        self.ttl, self.proto, src, target = struct.unpack('! 8x B B 2x 4s 4s', raw_data[:20])
+        self.total_length, self.ttl, self.proto, src, target = struct.unpack('! 2x H 4x B B 2x 4s 4s', raw_data[:20])
         self.src = self.ipv4addr(src)
         self.target = self.ipv4addr(target)
-        self.data = raw_data[self.header_length:]
+        # total length excludes ethernet padding (short frames), it can be 0 for segmentation offloaded packets
+        end = self.total_length if self.total_length > self.header_length else len(raw_data)
+        self.data = raw_data[self.header_length:end]
 
 # Returns properly formatted IPv4 address
     def ipv4addr(self, addr):
@@ -0,0 +1,127 @@
+# grottspool.py Grott store-and-forward spool (proxy offline mode)
+# Updated: 2026-10-18
+#
+# When the Growatt server can not be reached the proxy acks the datalogger records itself and appends the raw
+# (still scrambled) records to an append-only spool file. A background thread replays the spool to the Growatt
+# server at spoolrate records per second once it is reachable again, records of one datalogger session are
+# replayed over one connection. The replay position is kept in <spoolfile>.pos, so a restart continues where
+# the replay stopped.
+#
+# Spool file: per record a header (capture time, session id, record length) followed by the raw record.
+
+import os
+import select
+import socket
+import struct
+import threading
+import time
+
+from grottmetrics import metrics
+
+SPOOLHEADER = struct.Struct(">dQI")
+
+
+class GrottSpool:
+
+    def __init__(self, conf):
+        self.conf = conf
+        self.file = conf.spoolfile
+        self.posfile = conf.spoolfile + ".pos"
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.spool = open(self.file, "ab")
+        metrics.set("spool_bytes", lambda: os.path.getsize(self.file))
+        print("\t - Grott - spool file:", self.file)
+        if os.path.getsize(self.file) > self.readpos():
+            # records left from a previous run
+            self.wakeup.set()
+        self.thread = threading.Thread(target=self.run, name="grottspool", daemon=True)
+        self.thread.start()
+
+    def append(self, session, data):
+        # append raw record to the spool (called by the proxy loop)
+        with self.lock:
+            self.spool.write(SPOOLHEADER.pack(time.time(), session, len(data)))
+            self.spool.write(data)
+            self.spool.flush()
+            self.wakeup.set()
+        metrics.inc("spool_records")
+
+    def readpos(self):
+        try:
+            with open(self.posfile) as posfile:
+                return int(posfile.read())
+        except (OSError, ValueError):
+            return 0
+
+    def writepos(self, pos):
+        with open(self.posfile, "w") as posfile:
+            posfile.write(str(pos))
+
+    def reset(self):
+        # everything replayed: empty the spool (lock must be held)
+        self.spool.truncate(0)
+        self.writepos(0)
+        self.wakeup.clear()
+
+    def run(self):
+        while True:
+            self.wakeup.wait()
+            try:
+                if self.replay():
+                    continue
+            except Exception as e:
+                print("\t - Grott - grottspool replay error : ", repr(e))
+            # Growatt server (still) not reachable
+            time.sleep(self.conf.spoolretry)
+
+    def connect(self):
+        sock = socket.create_connection((self.conf.growattip, self.conf.growattport), timeout=self.conf.growatttimeout)
+        if self.conf.verbose: print("\t - Grott - grottspool connected to Growatt server, replay started")
+        return sock
+
+    def discard(self, session, conns):
+        # read (and ignore) Growatt server responses, returns False if the server closed the connection
+        sock = conns[session]
+        try:
+            while select.select([sock], [], [], 0)[0]:
+                if not sock.recv(4096):
+                    raise OSError("connection closed by Growatt server")
+        except OSError:
+            sock.close()
+            del conns[session]
+            return False
+        return True
+
+    def replay(self):
+        # replay spooled records at spoolrate records per second, returns True if the spool is empty
+        pos = self.readpos()
+        conns = {}
+        try:
+            with open(self.file, "rb") as spool:
+                while True:
+                    with self.lock:
+                        spool.seek(pos)
+                        header = spool.read(SPOOLHEADER.size)
+                        stamp, session, length = SPOOLHEADER.unpack(header) if len(header) == SPOOLHEADER.size else (0, 0, 0)
+                        record = spool.read(length)
+                        if len(header) < SPOOLHEADER.size or len(record) < length:
+                            # end of spool (an incomplete record can only be left by a crash)
+                            self.reset()
+                            return True
+
+                    if session not in conns:
+                        conns[session] = self.connect()
+                    conns[session].sendall(record)
+                    self.discard(session, conns)
+
+                    pos += SPOOLHEADER.size + length
+                    self.writepos(pos)
+                    metrics.inc("spool_replayed")
+                    time.sleep(1 / self.conf.spoolrate)
+        except OSError as e:
+            print("\t - Grott - grottspool Growatt server not reachable, replay postponed : ", e)
+            return False
+        finally:
+            for sock in conns.values():
+                sock.close()
@@ -0,0 +1,84 @@
+# grotttime.py Grott record time handling
+# Updated: 2026-10-18
+#
+# The configured timezone (Generic timezone, default local) is resolved once. Record date/time values (local time
+# of the inverter) are converted to epoch seconds with calendar arithmetic and a per day UTC offset cache; days with
+# a DST transition are converted per timestamp. Used for all outputs (MQTT, PVOutput, InfluxDB), so every output
+# gets the same record time.
+
+import calendar
+import time
+from datetime import datetime
+
+#zoneinfo (python 3.9+) is used for named timezones, pytz if zoneinfo is not available
+try:
+    import zoneinfo
+except ImportError:
+    zoneinfo = None
+try:
+    import pytz
+except ImportError:
+    pytz = None
+
+
+class GrottTimezone:
+
+    def __init__(self, name="local", verbose=False):
+        self.name = name
+        self.tz = None                                      # None: local (system) timezone
+        self.offsets = {}                                   # (year, month, day): UTC offset in seconds
+
+        if name != "local":
+            try:
+                if zoneinfo is not None:
+                    self.tz = zoneinfo.ZoneInfo(name)
+                elif pytz is not None:
+                    self.tz = pytz.timezone(name)
+                else:
+                    raise ValueError("zoneinfo or pytz not installed")
+            except Exception as e:
+                print("\t - " + "Grott unknown timezone : ", name, ", local timezone used :", e)
+                self.name = "local"
+        if verbose: print("\t - " + "Grott timezone used : ", self.name)
+
+    def utcoffset(self, year, month, day, hour, minute, second):
+        # UTC offset (seconds) of a local date/time, ambiguous (repeated hour) and skipped times (DST change) use the
+        # offset before the transition (zoneinfo and local: fold = 0, pytz: is_dst chosen to match)
+        if self.tz is None:
+            return calendar.timegm((year, month, day, hour, minute, second)) - int(datetime(year, month, day, hour, minute, second).timestamp())
+        if hasattr(self.tz, "localize"):
+            # pytz: repeated hour (DST end) is_dst = True, skipped hour (DST start) is_dst = False
+            local = datetime(year, month, day, hour, minute, second)
+            try:
+                return int(self.tz.localize(local, is_dst=None).utcoffset().total_seconds())
+            except pytz.AmbiguousTimeError:
+                return int(self.tz.localize(local, is_dst=True).utcoffset().total_seconds())
+            except pytz.NonExistentTimeError:
+                return int(self.tz.localize(local, is_dst=False).utcoffset().total_seconds())
+        return int(datetime(year, month, day, hour, minute, second, tzinfo=self.tz).utcoffset().total_seconds())
+
+    def epoch(self, year, month, day, hour, minute, second):
+        # epoch seconds of a local (record) date/time
+        key = (year, month, day)
+        offset = self.offsets.get(key)
+        if offset is None:
+            offset = self.utcoffset(year, month, day, 0, 0, 0)
+            if offset == self.utcoffset(year, month, day, 23, 59, 59):
+                # no DST transition on this day: offset valid for the whole day
+                if len(self.offsets) >= 64:
+                    self.offsets.clear()
+                self.offsets[key] = offset
+            else:
+                offset = self.utcoffset(year, month, day, hour, minute, second)
+        return calendar.timegm((year, month, day, hour, minute, second)) - offset
+
+    def localtime(self, epoch):
+        # local (naive) datetime of epoch seconds
+        if self.tz is None:
+            return datetime.fromtimestamp(epoch)
+        return datetime.fromtimestamp(epoch, self.tz).replace(tzinfo=None)
+
+    def now(self, epoch=None):
+        # current (or given receive) time: (epoch seconds, local datetime), used for records without (valid) date
+        epoch = int(time.time() if epoch is None else epoch)
+        return epoch, self.localtime(epoch)
@@ -0,0 +1,166 @@
+# grottworker.py Grott decode worker processes
+# Updated: 2026-10-18
+#
+# With procprocesses > 0 the proxy hands the validated records to worker processes instead of threads, so record
+# processing (decode, MQTT, InfluxDB, PVOutput, extensions) is not bound to one CPU core. Records are sharded on the
+# datalogger serial (crc32), every worker has its own queue, so the records of a datalogger are processed in order.
+# A worker builds its own configuration (same command line, environment and ini file) and outputs, except PVOutput:
+# statuses are sent to the main process, its PVOutput sender keeps the upload limit for all workers together. Workers
+# report their metrics (records processed, errors, records per second, output metrics) every second, they are
+# exported as procpool_worker<n> gauges. A worker that stops is restarted.
+
+import atexit
+import multiprocessing
+import queue
+import threading
+import time
+import zlib
+
+from grottmetrics import metrics
+
+# seconds between worker metrics reports
+REPORTINT = 1.0
+
+
+class GrottPvOutputForward:
+    """PVOutput sink of a worker process: statuses are handed to the PVOutput sender of the main process."""
+
+    def __init__(self, reports):
+        self.reports = reports
+
+    def add(self, systemid, kind, data, serial=None):
+        self.reports.put(("pvoutput", systemid, kind, data, serial))
+
+
+def work(verrel, index, records, reports):
+    # worker process main: process records till None is received
+    from grottconf import Conf
+    from grottdata import procdata
+
+    conf = Conf(verrel, worker=index)
+    if conf.pvoutput: conf.pvsink = GrottPvOutputForward(reports)
+    conf.freeze()
+    processed = 0
+    reported = (time.monotonic(), 0)
+    try:
+        while True:
+            try:
+                item = records.get(timeout=REPORTINT)
+            except queue.Empty:
+                item = False
+            if item is None:
+                break
+            if item:
+                data, source = item
+                if conf.verbose: print("\t - Grott worker", index, "processing record from", source)
+                try:
+                    procdata(conf, data)
+                    processed += 1
+                    metrics.inc("worker_records_processed")
+                except (Exception, SystemExit) as e:
+                    metrics.inc("worker_process_errors")
+                    print("\t - Grott worker", index, "record processing error : ", repr(e))
+            now = time.monotonic()
+            if now - reported[0] >= REPORTINT:
+                metrics.set("worker_records_per_sec", round((processed - reported[1]) / (now - reported[0]), 1))
+                reported = (now, processed)
+                reports.put(("stats", index, metrics.snapshot()))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # atexit is not run in a worker process: write queued output now
+        if conf.ifsink is not None: conf.ifsink.stop()
+        if conf.mqttsink is not None: conf.mqttsink.stop()
+
+
+class GrottProcPool:
+    """Decode worker processes, records sharded on datalogger serial (same interface as grottproxy.GrottProcQueue)."""
+
+    def __init__(self, conf):
+        self.conf = conf
+        self.drop = conf.procdrop
+        # spawn: a worker does not inherit the threads and connections of the proxy
+        self.context = multiprocessing.get_context("spawn")
+        # worker reports: metrics and PVOutput statuses
+        self.reports = self.context.Queue()
+        self.queues = []
+        self.processes = []
+        self.workerstats = []
+        for index in range(conf.procprocesses):
+            self.queues.append(self.context.Queue(maxsize=conf.procqueue))
+            self.processes.append(None)
+            self.workerstats.append({})
+            self.start(index)
+            metrics.set("procpool_worker" + str(index) + "_queue_depth", self.queues[index].qsize)
+            metrics.set("procpool_worker" + str(index), lambda index=index: self.workerstats[index])
+        metrics.set("procpool_workers_alive", lambda: sum(1 for process in self.processes if process.is_alive()))
+        self.stopped = False
+        threading.Thread(target=self.collect, name="grottprocpool", daemon=True).start()
+        atexit.register(self.stop)
+
+    def start(self, index):
+        process = self.context.Process(target=work, args=(self.conf.verrel, index, self.queues[index], self.reports),
+                                       name="grottworker" + str(index), daemon=True)
+        process.start()
+        self.processes[index] = process
+        if self.conf.verbose: print("\t - Grott decode worker started:", index, "pid", process.pid)
+
+    def shard(self, data):
+        # datalogger serial (bytes 8-18), the encrypted bytes map one to one on the plain serial for a given header
+        return zlib.crc32(data[8:18]) % len(self.queues)
+
+    def put(self, data, source=None):
+        # copy record (the receive buffer is reused by the select loop), source: connection of the record
+        record = bytes(data)
+        records = self.queues[self.shard(record)]
+        item = (record, source)
+        if self.drop == "block":
+            records.put(item)
+        else:
+            while True:
+                try:
+                    records.put_nowait(item)
+                    break
+                except queue.Full:
+                    metrics.inc("proxy_queue_dropped")
+                    if self.conf.verbose: print("\t - Grott - grottproxy - worker queue full, record dropped (" + self.drop + ")")
+                    if self.drop == "newest":
+                        return
+                    try:
+                        records.get_nowait()
+                    except queue.Empty:
+                        pass
+        metrics.inc("proxy_records_queued")
+
+    def collect(self):
+        # store worker metrics reports, send worker PVOutput statuses, restart stopped workers
+        while not self.stopped:
+            try:
+                report = self.reports.get(timeout=REPORTINT)
+                if report[0] == "stats":
+                    self.workerstats[report[1]] = report[2]
+                elif self.conf.pvsink is not None:
+                    self.conf.pvsink.add(*report[1:])
+            except queue.Empty:
+                pass
+            for index, process in enumerate(self.processes):
+                if not self.stopped and not process.is_alive():
+                    metrics.inc("procpool_restarts")
+                    print("\t - Grott decode worker stopped (exit code " + str(process.exitcode) + "), restarted:", index)
+                    self.start(index)
+
+    def stop(self, timeout=10):
+        # let the workers process their queue and write their output, then stop them
+        if self.stopped:
+            return
+        self.stopped = True
+        for records in self.queues:
+            try:
+                records.put(None, timeout=timeout)
+            except queue.Full:
+                pass
+        deadline = time.monotonic() + timeout
+        for process in self.processes:
+            process.join(max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                process.terminate()
@@ -0,0 +1,107 @@
+import time
+import types
+
+import pytest
+
+from grottarchive import GrottArchive, GrottArchiveReader, loggerserial
+from grottconf import Conf
+from test_grottprotocol import RECORD
+
+# protocol 02 (not scrambled) data record of another datalogger
+PLAIN = bytes.fromhex("00010002001a0104") + b"DLG1234567" + bytes(10)
+
+
+def archiveconf(path, compat=True):
+    conf = types.SimpleNamespace(archivedir=str(path), archivesegment=0, archiveflush=0.05, archivequeue=100,
+                                 compat=compat, verbose=False, invtype="default", invtypemap={}, includeall=False)
+    if not compat:
+        Conf.set_reclayouts(conf)
+    return conf
+
+
+def written(archive, timeout=5):
+    "Wait till the archive writer has taken the queued records (records put after this go to a next block)"
+    deadline = time.monotonic() + timeout
+    while archive.pending() and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def test_loggerserial():
+    "Test the datalogger serial of a scrambled (06) and a plain (02) record"
+    assert loggerserial(RECORD) == b"JPC281833B"
+    assert loggerserial(memoryview(RECORD)) == b"JPC281833B"
+    assert loggerserial(PLAIN) == b"DLG1234567"
+
+
+def test_archive_roundtrip(tmp_path):
+    "Test that archived records are read back with receive time, serial, record type and layout"
+    archive = GrottArchive(archiveconf(tmp_path, compat=False))
+    archive.put(RECORD, 1000.5)
+    archive.put(memoryview(PLAIN), 1001.0)
+    written(archive)
+    # segment size 0: the next block starts a new segment
+    archive.put(bytearray(RECORD), 2000.0)
+    archive.stop()
+
+    reader = GrottArchiveReader(str(tmp_path))
+    assert len(reader.segments) == 2
+    entries = list(reader.read())
+    assert [entry.data for entry in entries] == [RECORD, PLAIN, RECORD]
+    assert [entry.received for entry in entries] == [1000.5, 1001.0, 2000.0]
+    assert [entry.device for entry in entries] == ["JPC281833B", "DLG1234567", "JPC281833B"]
+    assert [entry.rectype for entry in entries] == [4, 4, 4]
+    assert entries[0].layout == "T06NNNN"
+    assert entries[1].layout == "T02NNNN"
+
+
+def test_archive_compat(tmp_path):
+    "Test that without layouts (compat) records are archived with layout none"
+    archive = GrottArchive(archiveconf(tmp_path))
+    archive.put(RECORD, 1.0)
+    archive.stop()
+    assert [(entry.device, entry.layout) for entry in GrottArchiveReader(str(tmp_path)).read()] == [("JPC281833B", "none")]
+
+
+def test_archive_select(tmp_path):
+    "Test reading by datalogger and receive time range"
+    archive = GrottArchive(archiveconf(tmp_path))
+    for received in range(10):
+        archive.put(RECORD if received % 2 else PLAIN, 1000.0 + received)
+        if received == 4:
+            written(archive)
+    archive.stop()
+
+    reader = GrottArchiveReader(str(tmp_path))
+    assert [entry.received for entry in reader.read(["JPC281833B"])] == [1001.0, 1003.0, 1005.0, 1007.0, 1009.0]
+    assert [entry.received for entry in reader.read(start=1003.0, end=1006.0)] == [1003.0, 1004.0, 1005.0, 1006.0]
+    assert [entry.received for entry in reader.read(["DLG1234567"], 1003.0, 1006.0)] == [1004.0, 1006.0]
+    assert list(reader.read(["UNKNOWN"])) == []
+    # blocks: only the second block has records after 1005
+    assert len(reader.blocks()) == 2
+    assert len(reader.blocks(start=1005.0)) == 1
+
+
+def test_archive_queue_full(tmp_path):
+    "Test that records are not queued when the archive queue is full"
+    conf = archiveconf(tmp_path)
+    conf.archivequeue = 2
+    conf.archiveflush = 60
+    archive = GrottArchive(conf)
+    for received in range(5):
+        archive.put(RECORD, received)
+    assert archive.pending() == 2
+    archive.stop()
+    assert len(list(GrottArchiveReader(str(tmp_path)).read())) == 2
+
+
+def test_reader_errors(tmp_path):
+    "Test a directory without archive and an offset that is not a block"
+    with pytest.raises(FileNotFoundError):
+        GrottArchiveReader(str(tmp_path))
+    archive = GrottArchive(archiveconf(tmp_path))
+    archive.put(RECORD, 1.0)
+    archive.stop()
+    reader = GrottArchiveReader(str(tmp_path))
+    segment, offset = reader.blocks()[0]
+    with pytest.raises(ValueError):
+        reader.readblock(segment, offset + 1)
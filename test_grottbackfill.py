@@ -0,0 +1,52 @@
+import threading
+
+from grottbackfill import influxbusy
+from grottreplay import waitoutputs
+
+
+class Writer:
+    "InfluxDB writer stand-in: points queued (pending) and backoff"
+
+    def __init__(self, pending, backoff=0):
+        self.left = pending
+        self.backoff = backoff
+
+    def pending(self):
+        return self.left
+
+
+def test_influxbusy():
+    "Test that the writer is waited for with more than maxpending points queued, not while in backoff"
+    assert influxbusy(Writer(600), 500) != []
+    assert influxbusy(Writer(500), 500) == []
+    assert influxbusy(Writer(600, backoff=4), 500) == []
+
+
+def test_wait_progress():
+    "Test that the wait continues while the writer makes progress"
+    writer = Writer(900)
+
+    def write():
+        while writer.left > 400:
+            writer.left -= 50
+            threading.Event().wait(0.02)
+    worker = threading.Thread(target=write)
+    worker.start()
+    assert waitoutputs(lambda: influxbusy(writer, 500), 0.5) == []
+    worker.join()
+    assert writer.left <= 500
+
+
+def test_wait_stalled():
+    "Test that the wait ends with the writer that did not make progress within the timeout"
+    writer = Writer(900)
+    assert waitoutputs(lambda: influxbusy(writer, 500), 0.1) == [writer]
+
+
+def test_wait_backoff():
+    "Test that the wait ends when the writer goes in backoff (points are spilled)"
+    writer = Writer(900)
+    timer = threading.Timer(0.1, setattr, (writer, "backoff", 1))
+    timer.start()
+    assert waitoutputs(lambda: influxbusy(writer, 500), 10) == []
+    timer.join()
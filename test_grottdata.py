@@ -0,0 +1,251 @@
+import calendar
+import codecs
+import struct
+import types
+from datetime import datetime
+
+import pytest
+
+from grottconf import Conf
+from grottdata import GrottLayout, GrottLayoutCache
+from grottprotocol import decrypt, encrypt
+from grotttime import GrottTimezone
+from test_grottprotocol import RECORD
+
+
+@pytest.fixture(scope="module")
+def recorddict():
+    "Built-in record layouts (Conf.set_reclayouts without the rest of the configuration)"
+    conf = types.SimpleNamespace(includeall=False, verbose=False)
+    Conf.set_reclayouts(conf)
+    return conf.recorddict
+
+
+def olddecode(layout, plain, includeall=False):
+    "Reference: the hex string decode of grott 2.7.8"
+    result_string = plain.hex()
+    values = {}
+    for keyword, field in layout.items():
+        if keyword in ("decrypt", "date", "logstart", "device"):
+            continue
+        if field.get("incl") == "no" and not includeall:
+            continue
+        keytype = field.get("type", "num")
+        hexval = result_string[field["value"]:field["value"] + field["length"] * 2]
+        if keytype == "num":
+            values[keyword] = int(hexval, 16)
+        elif keytype == "numx":
+            value = int(hexval, 16)
+            values[keyword] = value - (1 << len(hexval) * 4) if value >= 1 << (len(hexval) * 4 - 1) else value
+        elif keytype == "text":
+            values[keyword] = codecs.decode(hexval, "hex").decode("utf-8")
+    return values
+
+
+def test_layout_record(recorddict):
+    "Test the decode of the example record against the hex string decode"
+    plain = decrypt(RECORD)
+    values = GrottLayout("T06NNNN", recorddict["T06NNNN"]).decode(plain)
+    assert values == olddecode(recorddict["T06NNNN"], plain)
+    assert list(values) == list(olddecode(recorddict["T06NNNN"], plain))
+    assert values["datalogserial"] == "JPC281833B"
+    assert values["pvserial"] == "QMB2823261"
+    assert values["pvgridvoltage"] == 2373
+    assert "recortype1" not in values
+
+
+def test_layout_includeall(recorddict):
+    "Test that includeall decodes the incl = no fields too"
+    plain = decrypt(RECORD)
+    values = GrottLayout("T06NNNN", recorddict["T06NNNN"], includeall=True).decode(plain)
+    assert values == olddecode(recorddict["T06NNNN"], plain, includeall=True)
+    assert "recortype1" in values
+
+
+def test_layouts_compile(recorddict):
+    "Test that every built-in layout compiles without errors"
+    for name, layout in recorddict.items():
+        assert GrottLayout(name, layout).error is None, name
+
+
+SYNTHETIC = {
+    "decrypt"   : {"value" :"False"},
+    "date"      : {"value" :0},
+    "text"      : {"value" :16, "length" : 4, "type" : "text"},
+    "word"      : {"value" :24, "length" : 2, "type" : "num", "divide" : 10},
+    "overlap"   : {"value" :26, "length" : 2, "type" : "num"},
+    "long"      : {"value" :24, "length" : 4, "type" : "num"},
+    "signed"    : {"value" :32, "length" : 2, "type" : "numx"},
+    "signed8"   : {"value" :36, "length" : 1, "type" : "numx"},
+    "odd"       : {"value" :39, "length" : 2, "type" : "num"},
+    "oddtext"   : {"value" :45, "length" : 2, "type" : "text"},
+    "three"     : {"value" :52, "length" : 3, "type" : "num"},
+    "threex"    : {"value" :58, "length" : 3, "type" : "numx"},
+    "excluded"  : {"value" :64, "length" : 2, "type" : "num", "incl" : "no"},
+    "other"     : {"value" :64, "length" : 2, "type" : "other"},
+}
+
+
+def synthetic():
+    plain = bytearray(range(40))
+    plain[8:12] = b"GROT"
+    plain[16:18] = (-2).to_bytes(2, "big", signed=True)
+    plain[18] = 0x80
+    # hex offset 45: half bytes of "AB" shifted by one hex digit
+    plain[22:25] = bytes.fromhex("0" + b"AB".hex() + "0")
+    plain[29:32] = (-3).to_bytes(3, "big", signed=True)
+    return bytes(plain)
+
+
+def test_layout_synthetic():
+    "Test overlapping, signed, odd offset and uncommon length fields against the hex string decode"
+    layout = GrottLayout("TEST", SYNTHETIC)
+    plain = synthetic()
+    values = layout.decode(plain)
+    assert values == olddecode(SYNTHETIC, plain)
+    assert list(values) == ["text", "word", "overlap", "long", "signed", "signed8", "odd", "oddtext", "three", "threex"]
+    assert values["text"] == "GROT"
+    assert values["long"] >> 16 == values["word"]
+    assert values["long"] >> 8 & 0xFFFF == values["overlap"]
+    assert values["signed"] == -2
+    assert values["signed8"] == -128
+    assert values["oddtext"] == "AB"
+    assert values["threex"] == -3
+    assert layout.divide == {"word": 10}
+    assert layout.decrypt is False
+    # overlapping fields go to a next struct pass
+    assert len(layout.structs) == 3
+
+
+def test_layout_outside_record():
+    "Test that a field after the end of the record is not decoded"
+    layout = GrottLayout("TEST", SYNTHETIC)
+    with pytest.raises((struct.error, ValueError)):
+        layout.decode(synthetic()[:20])
+    with pytest.raises(ValueError):
+        GrottLayout.hexfield(synthetic()[:26], 51, 3, "num")
+
+
+def test_layout_invalid():
+    "Test that a layout with an invalid field compiles the other fields and refuses to decode"
+    layout = GrottLayout("TEST", {"good": {"value" :0, "length" : 2}, "bad": {"value" :4}})
+    assert layout.names == ["good"]
+    assert layout.error is not None
+    with pytest.raises(ValueError):
+        layout.decode(synthetic())
+
+
+def test_layout_log():
+    "Test the comma separated log fields (smart meter records)"
+    layout = GrottLayout("TEST", {
+        "logstart"  : {"value" :16},
+        "voltage"   : {"type" : "log", "pos" : 1},
+        "powerpos"  : {"type" : "logpos", "pos" : 2},
+        "powerneg"  : {"type" : "logneg", "pos" : 2},
+    })
+    plain = bytes(8) + b"230.1,-12.5" + b"\x00\x00"
+    assert layout.decode(plain) == {"voltage": "230.1", "powerpos": 0, "powerneg": "-12.5"}
+
+
+DATELAYOUT = GrottLayout("TEST", {"date": {"value" :0}})
+DATELAYOUTODD = GrottLayout("TEST", {"date": {"value" :1}})
+
+
+def test_recorddate_record(recorddict):
+    "Test the date of the example record"
+    layout = GrottLayout("T06NNNN", recorddict["T06NNNN"])
+    recdate, epoch = layout.recorddate(decrypt(RECORD), GrottTimezone("UTC"))
+    assert recdate == datetime(2021, 2, 9, 12, 14, 10)
+    assert epoch == calendar.timegm((2021, 2, 9, 12, 14, 10))
+
+
+@pytest.mark.parametrize("date", [(21, 2, 9, 12, 14, 10), (0, 1, 1, 0, 0, 0), (99, 12, 31, 23, 59, 59), (24, 2, 29, 0, 0, 0), (0, 2, 29, 0, 0, 0)])
+def test_recorddate_valid(date):
+    "Test valid dates (leap years included), also at an odd hex offset"
+    expected = datetime(date[0] + 2000, *date[1:])
+    tz = GrottTimezone("UTC")
+    assert DATELAYOUT.recorddate(bytes(date), tz) == (expected, calendar.timegm(expected.timetuple()))
+    # hex offset 1: date bytes shifted by one hex digit
+    shifted = bytes.fromhex("0" + bytes(date).hex() + "0")
+    assert DATELAYOUTODD.recorddate(shifted, tz) == (expected, calendar.timegm(expected.timetuple()))
+
+
+@pytest.mark.parametrize("date", [(100, 1, 1, 0, 0, 0), (21, 0, 1, 0, 0, 0), (21, 13, 1, 0, 0, 0), (21, 1, 0, 0, 0, 0),
+                                  (21, 1, 32, 0, 0, 0), (21, 4, 31, 0, 0, 0), (21, 2, 30, 0, 0, 0), (21, 2, 29, 0, 0, 0),
+                                  (21, 1, 1, 24, 0, 0), (21, 1, 1, 0, 60, 0), (21, 1, 1, 0, 0, 60), (0, 0, 0, 0, 0, 0)])
+def test_recorddate_invalid(date):
+    "Test that an invalid date/time (no leap year included) gives None"
+    assert DATELAYOUT.recorddate(bytes(date), GrottTimezone("UTC")) is None
+
+
+def test_recorddate_short():
+    "Test that a record too short for the date gives None"
+    assert DATELAYOUT.recorddate(bytes((21, 1, 1)), GrottTimezone("UTC")) is None
+    assert DATELAYOUTODD.recorddate(bytes((21, 1, 1, 0, 0, 0)), GrottTimezone("UTC")) is None
+
+
+def cacheconf(recorddict, invtype="default", invtypemap=None):
+    "Configuration with the compiled built-in layouts"
+    return types.SimpleNamespace(verbose=False, invtype=invtype, invtypemap=invtypemap or {},
+                                 layouts={name: GrottLayout(name, layout) for name, layout in recorddict.items()})
+
+
+def withserial(serial):
+    "Example record with another inverter serial (scrambled again)"
+    plain = bytearray(decrypt(RECORD))
+    plain[38:48] = serial
+    return encrypt(bytes(plain))
+
+
+def test_layoutcache_hits(recorddict):
+    "Test that records with the same header resolve from the cache (hit and miss counters)"
+    conf = cacheconf(recorddict)
+    cache = GrottLayoutCache(conf)
+    layout, reclayout, serial, invtype = cache.resolve(RECORD)
+    assert (layout, serial, invtype) == ("T06NNNN", None, "default")
+    assert reclayout is conf.layouts["T06NNNN"]
+    assert (cache.hits, cache.misses) == (0, 1)
+    # another record with the same header, the inverter serial is not part of the key without invtypemap
+    assert cache.resolve(memoryview(withserial(b"ABC1234567")))[0] == "T06NNNN"
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert len(cache.cache) == 1
+
+
+def test_layoutcache_key(recorddict):
+    "Test that protocol, device byte, record type and the extended flag (record length) are part of the key"
+    cache = GrottLayoutCache(cacheconf(recorddict))
+    assert cache.resolve(RECORD)[0] == "T06NNNN"
+    # extended: longer than 375 bytes
+    assert cache.resolve(RECORD + bytes(376 - len(RECORD)))[0] == "T06NNNNX"
+    assert cache.resolve(RECORD + bytes(375 - len(RECORD)))[0] == "T06NNNN"
+    # device byte and record type with an own layout
+    assert cache.resolve(RECORD[:6] + b"\x01\x20" + RECORD[8:])[0] == "T060120"
+    # record type without layout (no generic layout for 03)
+    assert cache.resolve(RECORD[:7] + b"\x03" + RECORD[8:])[:2] == ("T060103", None)
+    assert (cache.hits, cache.misses) == (1, 4)
+
+
+def test_layoutcache_invtype(recorddict):
+    "Test that the configured inverter type selects the layout"
+    cache = GrottLayoutCache(cacheconf(recorddict, invtype="spf"))
+    assert cache.resolve(RECORD)[0] == "T06NNNNSPF"
+
+
+def test_layoutcache_invtypemap(recorddict):
+    "Test the inverter type per inverter serial (invtypemap), the serial is part of the key"
+    cache = GrottLayoutCache(cacheconf(recorddict, invtypemap={"QMB2823261": "spf", "XYZ1234567": "xyz"}))
+    assert cache.resolve(RECORD)[0::2] == ("T06NNNNSPF", "QMB2823261")
+    assert cache.resolve(RECORD)[3] == "spf"
+    assert cache.resolve(withserial(b"ABC1234567"))[0::2] == ("T06NNNN", "ABC1234567")
+    # inverter type without a layout: generic layout
+    assert cache.resolve(withserial(b"XYZ1234567"))[0::2] == ("T06NNNN", "XYZ1234567")
+    assert (cache.hits, cache.misses) == (1, 3)
+
+
+def test_layoutcache_maxsize(recorddict):
+    "Test that a full cache is cleared"
+    cache = GrottLayoutCache(cacheconf(recorddict, invtypemap={"QMB2823261": "spf"}), maxsize=2)
+    for serial in (b"ABC0000001", b"ABC0000002", b"ABC0000003"):
+        cache.resolve(withserial(serial))
+    assert len(cache.cache) == 1
+    assert cache.misses == 3
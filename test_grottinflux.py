@@ -0,0 +1,195 @@
+import os
+import threading
+import time
+import types
+
+import pytest
+
+from grottdata import GrottLayout
+from grottmetrics import metrics
+from grottinflux import GrottInflux, GrottLineEncoder, escapekey, escapemeasurement, escapestr
+
+LAYOUT = GrottLayout("TEST", {
+    "pvstatus"      : {"value" :0, "length" : 2, "type" : "num"},
+    "pvpowerin"     : {"value" :4, "length" : 4, "type" : "num", "divide" : 10},
+    "pvfrequentie"  : {"value" :12, "length" : 2, "type" : "num", "divide" : 100},
+    "faultcode"     : {"value" :16, "length" : 2, "type" : "num", "divide" : 1},
+})
+
+
+@pytest.mark.parametrize("name, escaped", [("pvpower", "pvpower"), ("a b", "a\\ b"), ("a,b", "a\\,b"),
+                                           ("a=b", "a\\=b"), ("a\\b", "a\\\\b")])
+def test_escapekey(name, escaped):
+    "Test the escaping of tag and field keys"
+    assert escapekey(name) == escaped
+
+
+@pytest.mark.parametrize("name, escaped", [("grottdb", "grottdb"), ("a b", "a\\ b"), ("a,b", "a\\,b"),
+                                           ("a=b", "a=b"), ("a\\b", "a\\b")])
+def test_escapemeasurement(name, escaped):
+    "Test the escaping of measurement names (equal sign and backslash not escaped)"
+    assert escapemeasurement(name) == escaped
+
+
+@pytest.mark.parametrize("value, escaped", [("QMB2823261", '"QMB2823261"'), ('a "b"', '"a \\"b\\""'),
+                                            ("a\\b", '"a\\\\b"'), ("a\nb", '"a\\nb"'), ("a,b c=d", '"a,b c=d"')])
+def test_escapestr(value, escaped):
+    "Test the quoting and escaping of string field values"
+    assert escapestr(value) == escaped
+
+
+def test_encode():
+    "Test the line of a record: int, float, bool and string fields, date and None skipped"
+    encoder = GrottLineEncoder(LAYOUT)
+    fields = {"date": "2021-02-09T12:14:10", "pvserial": "QMB2823261", "pvstatus": 1, "pvpowerin": 5490,
+              "pvfrequentie": 5001, "faultcode": 0, "ratio": 0.5, "buffered": False, "empty": None}
+    line = encoder.encode("grott", fields, 1612872850000000000)
+    assert line == (b'grott pvserial="QMB2823261",pvstatus=1i,pvpowerin=5490i,pvfrequentie=5001i,faultcode=0i,'
+                    b'ratio=0.5,buffered=false 1612872850000000000')
+
+
+def test_encode_scaled():
+    "Test that scaled writes fields with a divide factor (not 1) as float"
+    encoder = GrottLineEncoder(LAYOUT, scaled=True)
+    line = encoder.encode("grott", {"pvstatus": 1, "pvpowerin": 5490, "pvfrequentie": 5001, "faultcode": 3}, 1)
+    assert line == b"grott pvstatus=1i,pvpowerin=549.0,pvfrequentie=50.01,faultcode=3i 1"
+
+
+def test_encode_escaped():
+    "Test escaping of the measurement and of field keys not in the layout"
+    encoder = GrottLineEncoder()
+    line = encoder.encode("grott db,1", {"field one": 1, "a=b": True}, 1)
+    assert line == b"grott\\ db\\,1 field\\ one=1i,a\\=b=true 1"
+    # escaped key is kept
+    assert encoder.keys["field one"] == "field\\ one="
+
+
+class Client:
+    "Stand-in for the InfluxDB 1.x client: keeps the written payloads, fails while failures > 0"
+
+    def __init__(self, failures=0, error=OSError):
+        self.payloads = []
+        self.attempts = 0
+        self.failures = failures
+        self.error = error
+        self.release = threading.Event()
+        self.release.set()
+
+    def write_points(self, payload, protocol):
+        assert protocol == "line"
+        self.release.wait(5)
+        self.attempts += 1
+        if self.failures:
+            self.failures -= 1
+            raise self.error("InfluxDB not reachable")
+        self.payloads.append(payload)
+
+
+class Rejected(Exception):
+    code = 400
+
+
+def influxconf(path, client, **settings):
+    conf = types.SimpleNamespace(ifbatch=2, ifflush=0.05, ifqueue=100, ifspillfile=str(path / "grottinflux.dat"),
+                                 ifscaled=False, influx2=False, influxclient=client, ifbackoff=1, verbose=False)
+    conf.__dict__.update(settings)
+    return conf
+
+
+def wait(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def counter(name):
+    return metrics.snapshot().get(name, 0)
+
+
+def test_influx_batch(tmp_path):
+    "Test that points are written in batches of ifbatch points, the rest after ifflush seconds"
+    client = Client()
+    sink = GrottInflux(influxconf(tmp_path, client, ifflush=0.3))
+    for point in (b"p1", b"p2", b"p3"):
+        sink.write(point)
+    assert wait(lambda: client.payloads)
+    assert client.payloads == ["p1\np2"]
+    assert sink.pending() == 1
+    assert wait(lambda: len(client.payloads) == 2)
+    assert client.payloads == ["p1\np2", "p3"]
+    sink.stop()
+
+
+def test_influx_backoff(tmp_path):
+    "Test that a failed write is retried after the backoff, the points stay queued in order"
+    client = Client(failures=1)
+    errors = counter("influx_errors")
+    sink = GrottInflux(influxconf(tmp_path, client))
+    sink.write(b"p1")
+    sink.write(b"p2")
+    assert wait(lambda: sink.backoff == 1)
+    assert sink.pending() == 2
+    sink.write(b"p3")
+    assert wait(lambda: len(client.payloads) == 2)
+    assert client.payloads == ["p1\np2", "p3"]
+    assert sink.backoff == 0
+    assert counter("influx_errors") == errors + 1
+    sink.stop()
+
+
+def test_influx_rejected(tmp_path):
+    "Test that a batch rejected by InfluxDB (400) is dropped, not retried"
+    client = Client(failures=1, error=Rejected)
+    rejected = counter("influx_rejected")
+    sink = GrottInflux(influxconf(tmp_path, client))
+    for point in (b"p1", b"p2", b"p3", b"p4"):
+        sink.write(point)
+    assert wait(lambda: client.payloads)
+    assert client.payloads == ["p3\np4"]
+    assert sink.backoff == 0
+    assert counter("influx_rejected") == rejected + 2
+    sink.stop()
+
+
+def test_influx_spill(tmp_path):
+    "Test that points above ifqueue are spilled to disk and written in order when InfluxDB keeps up again"
+    client = Client()
+    client.release.clear()
+    conf = influxconf(tmp_path, client, ifqueue=2)
+    spilled = counter("influx_spilled")
+    sink = GrottInflux(conf)
+    sink.write(b"p1")
+    sink.write(b"p2")
+    # p1, p2 are being written (InfluxDB slow)
+    assert wait(lambda: sink.pending() == 0)
+    for point in (b"p3", b"p4", b"p5", b"p6"):
+        sink.write(point)
+    assert sink.pending() == 2
+    assert counter("influx_spilled") == spilled + 2
+    assert open(conf.ifspillfile, "rb").read() == b"p5\np6\n"
+    client.release.set()
+    assert wait(lambda: len(client.payloads) == 3)
+    assert client.payloads == ["p1\np2", "p3\np4", "p5\np6"]
+    assert wait(lambda: not os.path.exists(conf.ifspillfile))
+    sink.stop()
+
+
+def test_influx_stop_spill(tmp_path):
+    "Test that points not written at stop are spilled and written by the next run (a cut off line is removed)"
+    client = Client(failures=1)
+    conf = influxconf(tmp_path, client, ifbatch=10, ifflush=60)
+    sink = GrottInflux(conf)
+    sink.write(b"p1")
+    sink.write(b"p2")
+    sink.stop()
+    assert open(conf.ifspillfile, "rb").read() == b"p1\np2\n"
+    # crash while spilling
+    with open(conf.ifspillfile, "ab") as spill:
+        spill.write(b"p3 cut")
+    client = Client()
+    sink = GrottInflux(influxconf(tmp_path, client, ifbatch=10))
+    assert wait(lambda: client.payloads)
+    assert client.payloads == ["p1\np2"]
+    assert wait(lambda: not os.path.exists(conf.ifspillfile))
+    sink.stop()
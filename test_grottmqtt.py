@@ -0,0 +1,115 @@
+import socket
+import time
+import types
+
+import pytest
+
+import paho.mqtt.client as mqtt
+
+from grottmetrics import metrics
+from grottmqtt import GrottMqtt
+
+
+class Client:
+    "Stand-in for the paho client: publish succeeds (or fails with rc)"
+
+    def __init__(self):
+        self.published = []
+        self.rc = mqtt.MQTT_ERR_SUCCESS
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        if self.rc == mqtt.MQTT_ERR_SUCCESS:
+            self.published.append((topic, payload, retain))
+        return types.SimpleNamespace(rc=self.rc)
+
+    def disconnect(self):
+        pass
+
+    def loop_stop(self):
+        pass
+
+
+def wait(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def counter(name):
+    return metrics.snapshot().get(name, 0)
+
+
+@pytest.fixture
+def sink():
+    "MQTT sink with a queue of 3 messages, the broker is not reachable (paho client replaced after start)"
+    refused = socket.socket()
+    refused.bind(("127.0.0.1", 0))
+    port = refused.getsockname()[1]
+    refused.close()
+    conf = types.SimpleNamespace(mqttqos=0, mqttqueue=3, mqttclientid="grott-test", mqttauth=False, mqttip="127.0.0.1",
+                                 mqttport=port, verbose=False)
+    sink = GrottMqtt(conf)
+    sink.client.loop_stop()
+    sink.client = Client()
+    return sink
+
+
+def test_mqtt_queue_full(sink):
+    "Test that a full queue drops the oldest message while the broker is not connected"
+    dropped = counter("mqtt_dropped")
+    sink.publish("energy/growatt", "m0")
+    # m0 is taken by the sender (waits for the connection), the queue is empty
+    assert wait(lambda: sink.queue.qsize() == 0)
+    for message in ("m1", "m2", "m3", "m4", "m5"):
+        sink.publish("energy/growatt", message)
+    assert sink.queue.qsize() == 3
+    assert sink.pending() == 4
+    assert counter("mqtt_dropped") == dropped + 2
+    assert sink.client.published == []
+    # connected: queued messages are sent in order
+    sink.on_connect(sink.client, None, {}, 0)
+    assert wait(lambda: sink.pending() == 0)
+    assert [payload for topic, payload, retain in sink.client.published] == ["m0", "m3", "m4", "m5"]
+
+
+def test_mqtt_reconnect(sink):
+    "Test that messages wait while the connection is lost and are sent after the reconnect"
+    disconnects = counter("mqtt_disconnects")
+    sink.on_connect(sink.client, None, {}, 0)
+    sink.publish("energy/growatt", "m1", retain=True)
+    assert wait(lambda: sink.pending() == 0)
+    # paho 2.x arguments: client, userdata, flags, reason code, properties
+    sink.on_disconnect(sink.client, None, {}, 7, None)
+    assert not sink.connected.is_set()
+    assert counter("mqtt_disconnects") == disconnects + 1
+    sink.publish("energy/growatt", "m2")
+    time.sleep(0.1)
+    assert sink.pending() == 1
+    # connection refused by the broker: still not connected
+    sink.on_connect(sink.client, None, {}, 5)
+    assert not sink.connected.is_set()
+    sink.on_connect(sink.client, None, {}, 0)
+    assert wait(lambda: sink.pending() == 0)
+    assert sink.client.published == [("energy/growatt", "m1", True), ("energy/growatt", "m2", False)]
+
+
+def test_mqtt_disconnect_v1(sink):
+    "Test the paho 1.x on_disconnect arguments (client, userdata, rc), a clean disconnect is not counted"
+    disconnects = counter("mqtt_disconnects")
+    sink.on_connect(sink.client, None, {}, 0)
+    sink.on_disconnect(sink.client, None, 0)
+    assert not sink.connected.is_set()
+    assert counter("mqtt_disconnects") == disconnects
+
+
+def test_mqtt_publish_retry(sink):
+    "Test that a publish that fails (connection lost after the wait) is retried"
+    sink.client.rc = mqtt.MQTT_ERR_NO_CONN
+    sink.on_connect(sink.client, None, {}, 0)
+    sink.publish("energy/growatt", "m1")
+    time.sleep(0.1)
+    assert sink.pending() == 1
+    sink.client.rc = mqtt.MQTT_ERR_SUCCESS
+    assert wait(lambda: sink.pending() == 0)
+    assert sink.client.published == [("energy/growatt", "m1", False)]
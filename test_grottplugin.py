@@ -0,0 +1,173 @@
+import threading
+import time
+import types
+
+import pytest
+
+import grottplugin
+from grottmetrics import metrics
+from grottplugin import GrottExtensions
+
+
+def extconf(extname, **settings):
+    conf = types.SimpleNamespace(extname=extname, extvar={"none": "none"}, exttimeout=5.0, extordered=True, extworkers=2,
+                                 extqueue=100, verbose=False)
+    conf.__dict__.update(settings)
+    return conf
+
+
+def record(value):
+    "Processed record stand-in (grottdata.GrottRecord)"
+    return types.SimpleNamespace(value=value, layout="T06NNNN", decrypt=True, hex="0001", json='{"value": %d}' % value)
+
+
+def extension(name, grottext, version=2):
+    "Extension module"
+    module = types.ModuleType(name)
+    module.grottext = grottext
+    module.grottext_version = version
+    return module
+
+
+@pytest.fixture
+def modules(monkeypatch):
+    "Extension modules by name, import_module calls are counted"
+    modules = {}
+    imports = []
+
+    def import_module(name, package=None):
+        imports.append(name)
+        if name not in modules:
+            raise ImportError("No module named " + repr(name))
+        return modules[name]
+    monkeypatch.setattr(grottplugin.importlib, "import_module", import_module)
+    return modules, imports
+
+
+def wait(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def counters(name):
+    snapshot = metrics.snapshot()
+    return {kind: snapshot.get("ext_" + name + "_" + kind, 0) for kind in ("calls", "errors", "timeouts", "dropped")}
+
+
+def test_ext_load_once(modules):
+    "Test that extensions are imported once (in extname order), not per record, and failing extensions are skipped"
+    modules, imports = modules
+    called = []
+    modules["extfirst"] = extension("extfirst", lambda conf, rec: called.append(("extfirst", rec.value)))
+    modules["extsecond"] = extension("extsecond", lambda conf, data, jsonmsg: called.append(("extsecond", data, jsonmsg)), 1)
+    modules["extnone"] = types.ModuleType("extnone")
+    extensions = GrottExtensions(extconf("extfirst, extmissing,extnone, extsecond"))
+    assert [ext.name for ext in extensions.extensions] == ["extfirst", "extsecond"]
+    for value in range(3):
+        extensions.put(record(value))
+    assert wait(lambda: len(called) == 6)
+    assert imports == ["extfirst", "extmissing", "extnone", "extsecond"]
+    assert [call for call in called if call[0] == "extfirst"] == [("extfirst", 0), ("extfirst", 1), ("extfirst", 2)]
+    assert ("extsecond", "0001", '{"value": 1}') in called
+
+
+def test_ext_extvar(modules):
+    "Test that every extension gets its own extvar and the layout of the record"
+    modules, imports = modules
+    seen = {}
+    modules["extvara"] = extension("extvara", lambda conf, rec: seen.setdefault("extvara", (conf.extvar, conf.layout, conf.verbose)))
+    modules["extvarb"] = extension("extvarb", lambda conf, rec: seen.setdefault("extvarb", (conf.extvar, conf.layout, conf.verbose)))
+    extvar = {"extvara": {"url": "a"}, "extvarb": {"url": "b"}}
+    extensions = GrottExtensions(extconf("extvara,extvarb", extvar=extvar))
+    extensions.put(record(1))
+    assert wait(lambda: len(seen) == 2)
+    assert seen == {"extvara": ({"url": "a"}, "T06NNNN", False), "extvarb": ({"url": "b"}, "T06NNNN", False)}
+
+
+def test_ext_ordered(modules):
+    "Test that with extordered records are delivered one at a time in arrival order"
+    modules, imports = modules
+    called = []
+    active = []
+
+    def grottext(conf, rec):
+        active.append(rec.value)
+        assert len(active) == 1
+        time.sleep(0.01 * (rec.value % 3))
+        called.append(rec.value)
+        active.remove(rec.value)
+    modules["extordered"] = extension("extordered", grottext)
+    before = counters("extordered")
+    extensions = GrottExtensions(extconf("extordered"))
+    for value in range(10):
+        extensions.put(record(value))
+    assert wait(lambda: len(called) == 10)
+    assert called == list(range(10))
+    assert wait(lambda: counters("extordered")["calls"] == before["calls"] + 10)
+    assert counters("extordered")["errors"] == before["errors"]
+
+
+def test_ext_unordered(modules):
+    "Test that without extordered extworkers calls run in parallel"
+    modules, imports = modules
+    release = threading.Event()
+    running = []
+    modules["extparallel"] = extension("extparallel", lambda conf, rec: (running.append(rec.value), release.wait(5)))
+    extensions = GrottExtensions(extconf("extparallel", extordered=False, extworkers=3))
+    for value in range(3):
+        extensions.put(record(value))
+    assert wait(lambda: len(running) == 3)
+    release.set()
+
+
+def test_ext_timeout(modules):
+    "Test that a call running longer than exttimeout is abandoned, the next record is processed"
+    modules, imports = modules
+    called = []
+
+    def grottext(conf, rec):
+        if rec.value == 0:
+            time.sleep(0.5)
+        called.append(rec.value)
+    modules["extslow"] = extension("extslow", grottext)
+    before = counters("extslow")
+    extensions = GrottExtensions(extconf("extslow", exttimeout=0.1))
+    extensions.put(record(0))
+    extensions.put(record(1))
+    assert wait(lambda: called == [1])
+    assert counters("extslow")["timeouts"] == before["timeouts"] + 1
+    # abandoned call finishes in its own thread
+    assert wait(lambda: called == [1, 0])
+    assert wait(lambda: extensions.extensions[0].running == 0)
+
+
+def test_ext_busy(modules):
+    "Test that records are dropped (not queued in the thread pool) while all spare threads are held by timed out calls"
+    modules, imports = modules
+    release = threading.Event()
+    called = []
+
+    def grottext(conf, rec):
+        called.append(rec.value)
+        release.wait(5)
+    modules["extsleep"] = extension("extsleep", grottext)
+    before = counters("extsleep")
+    extensions = GrottExtensions(extconf("extsleep", exttimeout=0.05))
+    ext = extensions.extensions[0]
+    for value in range(5):
+        extensions.put(record(value))
+    # ordered: one dispatcher, two threads; record 0 and 1 time out, 2 .. 4 are dropped
+    assert wait(lambda: extensions.pending() == 0)
+    assert wait(lambda: counters("extsleep")["dropped"] == before["dropped"] + 3)
+    assert counters("extsleep")["timeouts"] == before["timeouts"] + 2
+    assert called == [0, 1]
+    assert ext.running == 2
+    assert ext.pool._work_queue.qsize() == 0
+    # threads freed: records are submitted again
+    release.set()
+    assert wait(lambda: ext.running == 0)
+    extensions.put(record(5))
+    assert wait(lambda: called == [0, 1, 5])
+    assert wait(lambda: counters("extsleep")["calls"] == before["calls"] + 1)
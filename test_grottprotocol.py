@@ -0,0 +1,162 @@
+import random
+from itertools import cycle
+
+import pytest
+
+import grottprotocol
+from grottprotocol import scramble, decrypt, encrypt, decrypt_into, crc16, HEADER_LEN, GrottFramer, framestats
+
+
+# protocol 06 data record (examples/grotttest.py)
+RECORD = bytes.fromhex(
+    "00320006010101040d222c4559454c74412d7761747447726f7761747447726f7761747447723e3a23464c75415d4150747447726f7761"
+    "747447726f7761747447726f7774767d4b7c65756174746b726e776161064e776f6061746135726f7761747447726f7772cf67ce7b2a77"
+    "74747454c96f7761747447726f7761747447726f7761747452726fd0d97796a77e6e7a61747447726f7761747447726f77617474477ce9"
+    "77617474475f6f2e2f547447726f776174624772df4161747447726f77617474f7446f7761747447726f7761747447726f776174744772"
+    "6f7761747447786f776b287d457a9777607eb407066ef46ff376527ce87762747747656f7761747447726f6d03")
+
+
+def olddecrypt(data):
+    "Reference: the list based decrypt of grott 2.7.8 (returns bytes instead of a hex string)"
+    mask = b"Growatt"
+    unscrambled = list(data[0:8])
+    for i, j in zip(range(0, len(data) - 8), cycle(range(0, len(mask)))):
+        unscrambled = unscrambled + [data[i + 8] ^ mask[j]]
+    return bytes(unscrambled)
+
+
+def test_decrypt_record():
+    "Test that the record decrypts as with the old decrypt, the header is not changed"
+    plain = decrypt(RECORD)
+    assert plain == olddecrypt(RECORD)
+    assert plain[:HEADER_LEN] == RECORD[:HEADER_LEN]
+    # datalogger serial in plain text
+    assert plain[8:18] == b"JPC281833B"
+    # inverter serial
+    assert plain[38:48] == b"QMB2823261"
+
+
+@pytest.mark.parametrize("length", [0, 1, 8, 9, 15, 16, 100, 265, 1000])
+def test_scramble_lengths(length):
+    "Test scramble against the old decrypt for short, mask aligned and odd lengths"
+    data = bytes(random.Random(length).getrandbits(8) for _ in range(length))
+    assert scramble(data) == olddecrypt(data)
+
+
+def test_scramble_roundtrip():
+    "Test that encrypt and decrypt are symmetric"
+    assert encrypt(decrypt(RECORD)) == RECORD
+
+
+@pytest.mark.parametrize("data", [bytearray(RECORD), memoryview(RECORD), memoryview(b"xx" + RECORD)[2:]])
+def test_scramble_bytes_like(data):
+    "Test that bytearray and memoryview (slice) input give bytes"
+    plain = scramble(data)
+    assert isinstance(plain, bytes)
+    assert plain == olddecrypt(RECORD)
+
+
+def test_decrypt_into():
+    "Test that decrypt_into writes the plain record into the buffer and returns a view on it"
+    out = bytearray(4096)
+    view = decrypt_into(memoryview(RECORD), out)
+    assert len(view) == len(RECORD)
+    assert bytes(view) == olddecrypt(RECORD)
+    assert view.obj is out
+
+
+def test_decrypt_into_reused_buffer():
+    "Test that a shorter record in a reused buffer is not mixed with the previous record"
+    out = bytearray(4096)
+    decrypt_into(RECORD, out)
+    short = RECORD[:40]
+    assert bytes(decrypt_into(short, out)) == olddecrypt(short)
+
+
+@pytest.mark.skipif(grottprotocol.numpy is None, reason="numpy not installed")
+def test_scramble_numpy():
+    "Test the numpy path (large buffers) against the old decrypt"
+    data = bytes(random.Random(1).getrandbits(8) for _ in range(grottprotocol.NUMPY_THRESHOLD + 100))
+    assert scramble(data) == olddecrypt(data)
+    assert bytes(decrypt_into(data, bytearray(len(data)))) == olddecrypt(data)
+
+
+def test_crc16():
+    "Test CRC-16 Modbus against the check value and the record CRC"
+    assert crc16(b"123456789") == 0x4B37
+    assert crc16(RECORD[:-2]) == int.from_bytes(RECORD[-2:], "big")
+
+
+# protocol 02 record (no CRC): header + 2 bytes
+SHORT = bytes.fromhex("0001000200040116abcd")
+
+
+def feedall(framer, *chunks):
+    "Feed chunks, returns the records (as bytes) and the framestats changes"
+    before = dict(framestats)
+    records = []
+    for chunk in chunks:
+        records.extend(bytes(record) for record in framer.feed(chunk))
+    return records, {key: framestats[key] - before[key] for key in framestats}
+
+
+def test_framer_record():
+    "Test that a complete record is returned as is"
+    records, stats = feedall(GrottFramer(), RECORD)
+    assert records == [RECORD]
+    assert stats == {"reads": 1, "records": 1, "multi": 0, "partial": 0, "resync": 0}
+
+
+@pytest.mark.parametrize("split", [1, 5, 6, 8, 100, len(RECORD) - 1])
+def test_framer_split(split):
+    "Test that a record split over two reads is returned after the second read"
+    framer = GrottFramer()
+    assert framer.feed(RECORD[:split]) == []
+    assert [bytes(record) for record in framer.feed(RECORD[split:])] == [RECORD]
+    assert not framer.buffer
+
+
+def test_framer_bytewise():
+    "Test a record received one byte per read"
+    records, stats = feedall(GrottFramer(), *(RECORD[i:i + 1] for i in range(len(RECORD))))
+    assert records == [RECORD]
+    assert stats["resync"] == 0
+
+
+def test_framer_coalesced():
+    "Test that coalesced records are returned separately, a trailing partial record is kept"
+    framer = GrottFramer()
+    records, stats = feedall(framer, RECORD + SHORT + RECORD + SHORT[:3])
+    assert records == [RECORD, SHORT, RECORD]
+    assert stats["multi"] == 1 and stats["partial"] == 1
+    records, stats = feedall(framer, SHORT[3:] + SHORT)
+    assert records == [SHORT, SHORT]
+
+
+def test_framer_resync():
+    "Test that garbage in front of a record is skipped byte by byte"
+    records, stats = feedall(GrottFramer(), b"\xff" * 5 + RECORD)
+    assert records == [RECORD]
+    assert stats["resync"] == 5
+
+
+def test_framer_maxlength():
+    "Test that a header with a record length above maxlength is skipped (resync)"
+    # protocol 06 header claiming a 65535 byte payload
+    bad = bytes.fromhex("00010006ffff0104")
+    framer = GrottFramer()
+    records, stats = feedall(framer, bad + RECORD)
+    assert records == [RECORD]
+    assert stats["resync"] == len(bad)
+    assert not framer.buffer
+    # a lower maxlength rejects the example record
+    records, stats = feedall(GrottFramer(maxlength=len(RECORD) - 1), RECORD + SHORT)
+    assert records == [SHORT]
+    assert stats["resync"] == len(RECORD)
+
+
+def test_framer_short_length():
+    "Test that a length field below the header length is skipped (resync)"
+    records, stats = feedall(GrottFramer(), bytes.fromhex("000100020000") + SHORT)
+    assert records == [SHORT]
+    assert stats["resync"] == 6
@@ -0,0 +1,307 @@
+import selectors
+import socket
+import threading
+import time
+import types
+
+import pytest
+
+import grottproxy
+from grottmetrics import metrics
+from grottproxy import GrottProcQueue, Proxy
+from grottprotocol import ack_record
+from test_grottprotocol import RECORD
+
+
+def counters(*names):
+    snapshot = metrics.snapshot()
+    return {name: snapshot.get(name, 0) for name in names}
+
+
+def changes(before):
+    after = counters(*before)
+    return {name: after[name] - before[name] for name in before}
+
+
+def wait(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.005)
+    return condition()
+
+
+@pytest.fixture
+def procqueue(monkeypatch):
+    "Processing queue (size 2, one worker) with a worker that waits till released, records processed in order"
+    processed = []
+    release = threading.Event()
+
+    def procdata(conf, record):
+        release.wait(5)
+        processed.append(record)
+    monkeypatch.setattr(grottproxy, "procdata", procdata)
+
+    def make(drop):
+        conf = types.SimpleNamespace(procdrop=drop, procqueue=2, procworkers=1, verbose=False)
+        procs = GrottProcQueue(conf)
+        # first record is taken by the worker (waits), the queue is empty
+        procs.put(b"r0")
+        assert wait(lambda: procs.queue.qsize() == 0)
+        return procs
+    yield make, processed, release
+    release.set()
+
+
+METRICS = ("proxy_queue_dropped", "proxy_records_queued", "proxy_records_processed")
+
+
+def test_procqueue_oldest(procqueue):
+    "Test that a full queue drops the oldest queued record (procdrop = oldest)"
+    make, processed, release = procqueue
+    procs = make("oldest")
+    before = counters(*METRICS)
+    for record in (b"r1", b"r2", b"r3", b"r4"):
+        procs.put(memoryview(record))
+    assert metrics.snapshot()["proxy_queue_depth"] == 2
+    assert metrics.snapshot()["proxy_queue_size"] == 2
+    release.set()
+    procs.queue.join()
+    assert processed == [b"r0", b"r3", b"r4"]
+    # every received record is queued, r1 and r2 are dropped from the queue
+    assert changes(before) == {"proxy_queue_dropped": 2, "proxy_records_queued": 4, "proxy_records_processed": 3}
+
+
+def test_procqueue_newest(procqueue):
+    "Test that a full queue drops the received record (procdrop = newest)"
+    make, processed, release = procqueue
+    procs = make("newest")
+    before = counters(*METRICS)
+    for record in (b"r1", b"r2", b"r3", b"r4"):
+        procs.put(record)
+    release.set()
+    procs.queue.join()
+    assert processed == [b"r0", b"r1", b"r2"]
+    assert changes(before) == {"proxy_queue_dropped": 2, "proxy_records_queued": 2, "proxy_records_processed": 3}
+
+
+def test_procqueue_copy(procqueue):
+    "Test that the queued record is a copy (the receive buffer is reused)"
+    make, processed, release = procqueue
+    procs = make("oldest")
+    buffer = bytearray(b"r1")
+    procs.put(memoryview(buffer))
+    buffer[:] = b"xx"
+    release.set()
+    procs.queue.join()
+    assert processed == [b"r0", b"r1"]
+
+
+def test_procqueue_inline(monkeypatch):
+    "Test that without workers records are processed in the caller, a processing error is counted"
+    processed = []
+
+    def procdata(conf, record):
+        if record == b"bad":
+            raise ValueError("bad record")
+        processed.append(bytes(record))
+    monkeypatch.setattr(grottproxy, "procdata", procdata)
+    procs = GrottProcQueue(types.SimpleNamespace(procdrop="oldest", procqueue=2, procworkers=0, verbose=False))
+    before = counters("proxy_process_errors", "proxy_records_processed")
+    procs.put(b"r1")
+    procs.put(b"bad")
+    assert processed == [b"r1"]
+    assert changes(before) == {"proxy_process_errors": 1, "proxy_records_processed": 1}
+
+
+def refusedport():
+    "Local port nobody listens on"
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def proxyconf(port, **settings):
+    conf = types.SimpleNamespace(grottip="127.0.0.1", grottport=0, growattip="127.0.0.1", growattport=port, verbose=False,
+                                 blockcmd=False, noipf=False, recwl=[], minrecl=100, procqueue=100, procdrop="block",
+                                 procworkers=0, procprocesses=0, metricsint=0, growatttimeout=5, growattretries=2,
+                                 spool=False, spoolfile=None, spoolrate=100, spoolretry=60, maxrecl=4096, archivesink=None)
+    conf.__dict__.update(settings)
+    return conf
+
+
+@pytest.fixture
+def proxy(monkeypatch):
+    "Proxy factory (records processed inline into a list), the proxy loop is run with poll"
+    processed = []
+    monkeypatch.setattr(grottproxy, "procdata", lambda conf, record: processed.append(bytes(record)))
+    # keep the python SIGPIPE handling of the test process
+    monkeypatch.setattr(grottproxy, "signal", lambda signum, handler: None)
+    proxies = []
+
+    def make(conf):
+        proxy = Proxy(conf)
+        proxy.processed = processed
+        proxy.selector.register(proxy.server, selectors.EVENT_READ, None)
+        proxies.append((proxy, conf))
+        return proxy
+    yield make
+    for proxy, conf in proxies:
+        proxy.on_close(conf)
+        proxy.server.close()
+        proxy.selector.close()
+
+
+def pump(proxy, conf, condition, timeout=5):
+    "Run the proxy loop till condition() is true"
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        proxy.poll(conf, 0.02)
+    return condition()
+
+
+def datalogger(proxy):
+    "Connect a datalogger to the proxy"
+    client = socket.create_connection(proxy.server.getsockname())
+    client.settimeout(5)
+    return client
+
+
+def closed(sock):
+    "Test if the other side closed the connection"
+    sock.settimeout(0.01)
+    try:
+        return sock.recv(1) == b""
+    except socket.timeout:
+        return False
+    except OSError:
+        return True
+
+
+UPSTREAM = ("proxy_upstream_connect_errors", "proxy_upstream_retries")
+
+
+def test_connect_refused(proxy):
+    "Test that a refused connect is retried growattretries times, then the datalogger connection is closed"
+    conf = proxyconf(refusedport(), growattretries=2)
+    grott = proxy(conf)
+    before = counters(*UPSTREAM)
+    client = datalogger(grott)
+    assert pump(grott, conf, lambda: grott.connections)
+    server = [conn for conn in grott.connections if conn.side == "server"][0]
+    assert pump(grott, conf, lambda: closed(client))
+    assert server.attempts == 3
+    assert server.closed and server.peer.closed
+    assert not grott.connections and not grott.pending
+    assert changes(before) == {"proxy_upstream_connect_errors": 3, "proxy_upstream_retries": 2}
+
+
+def test_connect_timeout(proxy):
+    "Test that a connect not finished within growatttimeout is retried, then the datalogger connection is closed"
+    upstream = socket.socket()
+    upstream.bind(("127.0.0.1", 0))
+    upstream.listen(5)
+    conf = proxyconf(upstream.getsockname()[1], growattretries=1)
+    grott = proxy(conf)
+    before = counters(*UPSTREAM)
+    client = datalogger(grott)
+    assert pump(grott, conf, lambda: grott.pending)
+    server = next(iter(grott.pending))
+    # connect did not finish in time (not polled)
+    server.deadline = 0
+    grott.check_timeouts(conf)
+    assert server.attempts == 2 and server.connecting and server.deadline > time.monotonic()
+    server.deadline = 0
+    grott.check_timeouts(conf)
+    assert server.closed and server.peer.closed
+    assert closed(client)
+    assert changes(before) == {"proxy_upstream_connect_errors": 2, "proxy_upstream_retries": 1}
+    upstream.close()
+
+
+def test_connect_forward(proxy):
+    "Test that queued datalogger data is forwarded once the Growatt server is connected"
+    upstream = socket.socket()
+    upstream.bind(("127.0.0.1", 0))
+    upstream.listen(5)
+    conf = proxyconf(upstream.getsockname()[1])
+    grott = proxy(conf)
+    client = datalogger(grott)
+    client.sendall(RECORD)
+    assert pump(grott, conf, lambda: grott.processed)
+    growatt, addr = upstream.accept()
+    growatt.settimeout(5)
+    received = b""
+    assert pump(grott, conf, lambda: not grott.pending and not any(conn.outbuf for conn in grott.connections))
+    while len(received) < len(RECORD):
+        received += growatt.recv(4096)
+    assert received == RECORD
+    growatt.close()
+    upstream.close()
+
+
+def recvall(sock, length):
+    "Receive length bytes (less if the connection is closed)"
+    data = b""
+    while len(data) < length:
+        chunk = sock.recv(length - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def test_offline_ack(proxy, tmp_path):
+    "Test that with the Growatt server down the proxy acks and spools the datalogger records (offline mode)"
+    conf = proxyconf(refusedport(), growattretries=0, spool=True, spoolfile=str(tmp_path / "spool.dat"), spoolretry=0.2)
+    grott = proxy(conf)
+    before = counters("proxy_offline_sessions", "spool_records")
+    client = datalogger(grott)
+    # record received while the connect is in progress is queued, acked when offline mode starts
+    client.sendall(RECORD)
+    assert pump(grott, conf, lambda: grott.offline)
+    assert recvall(client, len(ack_record(RECORD))) == ack_record(RECORD)
+    client.sendall(RECORD)
+    assert pump(grott, conf, lambda: len(grott.processed) == 2)
+    assert recvall(client, len(ack_record(RECORD))) == ack_record(RECORD)
+    assert grott.processed == [RECORD, RECORD]
+    # reconnect attempts (spoolretry) fail, the session stays offline
+    time.sleep(0.3)
+    assert not pump(grott, conf, lambda: not grott.offline, timeout=0.3)
+    assert changes(before) == {"proxy_offline_sessions": 1, "spool_records": 2}
+    assert not closed(client)
+
+
+def test_offline_reconnect(proxy, tmp_path):
+    "Test that an offline session goes live again when the Growatt server is back, the spool replays the acked records"
+    port = refusedport()
+    conf = proxyconf(port, growattretries=0, spool=True, spoolfile=str(tmp_path / "spool.dat"), spoolretry=0.2)
+    grott = proxy(conf)
+    before = counters("proxy_online_sessions", "spool_replayed")
+    client = datalogger(grott)
+    assert pump(grott, conf, lambda: grott.offline)
+    client.sendall(RECORD)
+    assert pump(grott, conf, lambda: grott.processed)
+    assert recvall(client, len(ack_record(RECORD))) == ack_record(RECORD)
+
+    upstream = socket.socket()
+    upstream.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    upstream.bind(("127.0.0.1", port))
+    upstream.listen(5)
+    assert pump(grott, conf, lambda: not grott.offline)
+    # live again: the record is forwarded, not acked by the proxy
+    client.sendall(RECORD)
+    assert pump(grott, conf, lambda: len(grott.processed) == 2 and not any(conn.outbuf for conn in grott.connections))
+    received = []
+    upstream.settimeout(5)
+    for i in range(2):
+        conn, addr = upstream.accept()
+        conn.settimeout(5)
+        received.append(recvall(conn, len(RECORD)))
+        conn.close()
+    # one connection of the proxy session, one of the spool replay
+    assert received == [RECORD, RECORD]
+    assert wait(lambda: counters("spool_replayed")["spool_replayed"] > before["spool_replayed"])
+    assert changes(before) == {"proxy_online_sessions": 1, "spool_replayed": 1}
+    upstream.close()
@@ -0,0 +1,141 @@
+import threading
+import time
+import types
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+pytest.importorskip("requests")
+
+from grottmetrics import metrics
+from grottpvoutput import GrottPvOutput
+
+
+class PvOutput(BaseHTTPRequestHandler):
+    "Stand-in for the PVOutput batch status API: requests are recorded, replies taken from server.replies"
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"])).decode()
+        params = {name: values[0] for name, values in urllib.parse.parse_qs(body).items()}
+        self.server.received.append((self.headers["X-Pvoutput-SystemId"], self.headers["X-Pvoutput-Apikey"], params))
+        status, text, headers = self.server.replies.pop(0) if self.server.replies else (200, "OK", {})
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(text)))
+        self.end_headers()
+        self.wfile.write(text.encode())
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def pvoutput():
+    "PVOutput stand-in, returns the server (received requests, replies) and the url"
+    server = ThreadingHTTPServer(("127.0.0.1", 0), PvOutput)
+    server.received = []
+    server.replies = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server, "http://127.0.0.1:%d/service/r2/addbatchstatus.jsp" % server.server_address[1]
+    server.shutdown()
+    server.server_close()
+
+
+def pvconf(url, **settings):
+    conf = types.SimpleNamespace(pvapikey="testkey", pvurl=url, pvuplimit=5, pvtimeout=5, pvqueue=100, verbose=False)
+    conf.__dict__.update(settings)
+    return conf
+
+
+def wait(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def counter(name):
+    return metrics.snapshot().get(name, 0)
+
+
+def status(t, v2, **values):
+    return dict(d="20210209", t=t, v2=v2, **values)
+
+
+def test_pvoutput_batch(pvoutput):
+    "Test that the first status is sent right away, statuses received after it are sent in one batch per interval"
+    server, url = pvoutput
+    sink = GrottPvOutput(pvconf(url))
+    sink.add("12345", "status", status("12:00", 100.5, v1=2000, v6=230.1))
+    assert wait(lambda: len(server.received) == 1)
+    assert server.received[0] == ("12345", "testkey", {"data": "20210209,12:00,2000,100.5,,,,230.1"})
+
+    sink.interval = 0.5
+    sink.add("12345", "status", status("12:05", 200))
+    sink.add("12345", "status", status("12:10", 300))
+    sink.add("12345", "status", status("12:15", 400, v5=25.0))
+    assert wait(lambda: len(server.received) == 2)
+    assert server.received[1][2] == {"data": "20210209,12:05,,200;20210209,12:10,,300;20210209,12:15,,400,,,25.0"}
+    assert wait(lambda: sink.pending[("12345", "status")] == {})
+
+
+def test_pvoutput_coalesce(pvoutput):
+    "Test that statuses for the same date/time are coalesced per system id and kind, one request per system and kind"
+    server, url = pvoutput
+    sink = GrottPvOutput(pvconf(url))
+    # hold sending till all statuses are queued
+    sink.holdoff = time.monotonic() + 60
+    sink.add("12345", "status", status("12:00", 100))
+    sink.add("12345", "status", status("12:00", 150))
+    sink.add("67890", "status", status("12:00", 200))
+    sink.add("12345", "consumption", dict(d="20210209", t="12:00", v3=5000, v6=231.0))
+    sink.add("12345", "net", dict(d="20210209", t="12:00", v4=-300.0, v6=231.0))
+    sink.holdoff = 0
+    sink.wakeup.set()
+    assert wait(lambda: len(server.received) == 4)
+    assert sorted(server.received, key=lambda request: (request[0], request[2]["data"])) == [
+        ("12345", "testkey", {"data": "20210209,12:00,,,,-300.0,,231.0", "n": "1"}),
+        ("12345", "testkey", {"c1": "3", "data": "20210209,12:00,,,5000,,,231.0"}),
+        ("12345", "testkey", {"data": "20210209,12:00,,150"}),
+        ("67890", "testkey", {"data": "20210209,12:00,,200"}),
+    ]
+
+
+def test_pvoutput_ratelimit(pvoutput):
+    "Test that a 403 Exceeded reply holds sending till X-Rate-Limit-Reset, the statuses are kept and sent after it"
+    server, url = pvoutput
+    reset = time.time() + 1.5
+    server.replies.append((403, "Forbidden 403: Exceeded 60 requests per hour", {"X-Rate-Limit-Reset": "%.0f" % reset}))
+    ratelimited = counter("pvoutput_ratelimited")
+    sink = GrottPvOutput(pvconf(url))
+    sink.add("12345", "status", status("12:00", 100))
+    assert wait(lambda: len(server.received) == 1)
+    assert wait(lambda: sink.holdoff > time.monotonic())
+    assert counter("pvoutput_ratelimited") == ratelimited + 1
+    assert len(sink.pending[("12345", "status")]) == 1
+    # held: no request before the reset time
+    time.sleep(0.3)
+    assert len(server.received) == 1
+    assert wait(lambda: len(server.received) == 2)
+    assert time.time() >= reset - 1
+    assert server.received[1] == server.received[0]
+    assert wait(lambda: sink.pending[("12345", "status")] == {})
+
+
+def test_pvoutput_limit(pvoutput):
+    "Test the upload limit: one status per inverter serial and kind per pvuplimit minutes"
+    server, url = pvoutput
+    limited = counter("pvoutput_limited")
+    sink = GrottPvOutput(pvconf(url))
+    sink.holdoff = time.monotonic() + 60
+    sink.add("12345", "status", status("12:00", 100), "QMB2823261")
+    sink.add("12345", "status", status("12:01", 110), "QMB2823261")
+    sink.add("12345", "status", status("12:01", 200), "QMB2823262")
+    sink.add("12345", "consumption", dict(d="20210209", t="12:01", v3=5000), "QMB2823261")
+    assert counter("pvoutput_limited") == limited + 1
+    assert list(sink.pending[("12345", "status")]) == [("20210209", "12:00"), ("20210209", "12:01")]
+    assert sink.pending[("12345", "status")][("20210209", "12:01")]["v2"] == 200
+    assert len(sink.pending[("12345", "consumption")]) == 1
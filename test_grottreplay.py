@@ -0,0 +1,210 @@
+import struct
+import threading
+import types
+
+import pytest
+
+from grottreplay import Replay, pcapframes, pcapngframes, readcapture, ETHERNET_IPV4
+from test_grottprotocol import SHORT
+
+# frames of a synthetic capture: (seconds, fraction, frame)
+FRAMES = [(1612872850, 250000, b"frame one"), (1612872851, 0, b"frame two!"), (1612872852, 999999, b"")]
+
+
+def pcap(order=b"<", nano=False, linktype=1, frames=FRAMES):
+    "pcap file: global header and a record per frame"
+    order = order.decode()
+    magic = 0xa1b23c4d if nano else 0xa1b2c3d4
+    data = struct.pack(order + "IHHiIII", magic, 2, 4, 0, 0, 65535, linktype)
+    for sec, frac, frame in frames:
+        data += struct.pack(order + "IIII", sec, frac, len(frame), len(frame)) + frame
+    return data
+
+
+def block(order, blocktype, body):
+    "pcapng block: type, length, body (padded to 32 bits), length"
+    body += b"\x00" * (-len(body) % 4)
+    length = len(body) + 12
+    return struct.pack(order + "II", blocktype, length) + body + struct.pack(order + "I", length)
+
+
+def option(order, code, value):
+    return struct.pack(order + "HH", code, len(value)) + value + b"\x00" * (-len(value) % 4)
+
+
+def pcapng(order="<", tsresol=None, linktype=1, frames=FRAMES, scale=1000000):
+    "pcapng file: section header, interface description (optional if_tsresol) and an enhanced packet per frame"
+    data = block(order, 0x0a0d0d0a, struct.pack(order + "IHHq", 0x1a2b3c4d, 1, 0, -1))
+    options = b""
+    if tsresol is not None:
+        options = option(order, 9, bytes([tsresol])) + option(order, 0, b"")
+    data += block(order, 1, struct.pack(order + "HHI", linktype, 0, 65535) + options)
+    for sec, frac, frame in frames:
+        timestamp = sec * scale + frac
+        data += block(order, 6, struct.pack(order + "IIIII", 0, timestamp >> 32, timestamp & 0xffffffff, len(frame),
+                                            len(frame)) + frame)
+    return data
+
+
+def frames(reader, data):
+    return [(received, linktype, bytes(frame)) for received, linktype, frame in reader(memoryview(data))]
+
+
+@pytest.mark.parametrize("order", [b"<", b">"])
+def test_pcap_micro(order):
+    "Test pcap with microsecond timestamps (both byte orders)"
+    result = frames(pcapframes, pcap(order))
+    assert [frame for received, linktype, frame in result] == [frame for sec, frac, frame in FRAMES]
+    assert [linktype for received, linktype, frame in result] == [1, 1, 1]
+    assert [received for received, linktype, frame in result] == pytest.approx([sec + frac / 1e6 for sec, frac, frame in FRAMES])
+
+
+@pytest.mark.parametrize("order", [b"<", b">"])
+def test_pcap_nano(order):
+    "Test pcap with nanosecond timestamps (both byte orders) and the link type"
+    nanoframes = [(1612872850, 250000000, b"frame")]
+    result = frames(pcapframes, pcap(order, nano=True, linktype=113, frames=nanoframes))
+    assert result == [(pytest.approx(1612872850.25), 113, b"frame")]
+
+
+def test_pcap_truncated():
+    "Test that a cut off last frame (capture still running) is not returned"
+    data = pcap()
+    # last frame is empty: its record header only
+    for cut in (1, 5, 15, 16):
+        result = frames(pcapframes, data[:-cut])
+        assert [frame for received, linktype, frame in result] == [b"frame one", b"frame two!"]
+    # cut in the data of the second frame
+    assert [frame for received, linktype, frame in frames(pcapframes, data[:-17])] == [b"frame one"]
+    assert frames(pcapframes, data[:24]) == []
+
+
+def test_pcap_invalid():
+    "Test that a file without pcap magic is refused"
+    with pytest.raises(ValueError):
+        frames(pcapframes, b"not a capture file at all")
+
+
+@pytest.mark.parametrize("order", ["<", ">"])
+def test_pcapng(order):
+    "Test pcapng enhanced packets (both byte orders), default microsecond timestamps"
+    result = frames(pcapngframes, pcapng(order))
+    assert [frame for received, linktype, frame in result] == [frame for sec, frac, frame in FRAMES]
+    assert [received for received, linktype, frame in result] == pytest.approx([sec + frac / 1e6 for sec, frac, frame in FRAMES])
+
+
+@pytest.mark.parametrize("tsresol, scale", [(6, 10 ** 6), (9, 10 ** 9), (0x80 | 20, 2 ** 20)])
+def test_pcapng_tsresol(tsresol, scale):
+    "Test the if_tsresol option: decimal and binary timestamp resolution"
+    result = frames(pcapngframes, pcapng(tsresol=tsresol, linktype=101, frames=[(1612872850, scale // 4, b"frame")], scale=scale))
+    assert result == [(pytest.approx(1612872850.25), 101, b"frame")]
+
+
+def test_pcapng_simple():
+    "Test simple packet blocks: no timestamp, snapped to the block"
+    data = pcapng(frames=[])
+    data += block("<", 3, struct.pack("<I", 5) + b"frame")
+    # original length longer than the captured data
+    data += block("<", 3, struct.pack("<I", 100) + b"cut")
+    result = frames(pcapngframes, data)
+    assert result == [(None, 1, b"frame"), (None, 1, b"cut\x00")]
+
+
+def test_pcapng_truncated():
+    "Test that unknown blocks are skipped and a cut off last block is not returned"
+    first = pcapng(frames=FRAMES[:1])
+    second = pcapng(frames=FRAMES[:2])[len(first):]
+    result = frames(pcapngframes, first + block("<", 5, b"statistics") + second)
+    assert [frame for received, linktype, frame in result] == [b"frame one", b"frame two!"]
+    for cut in (1, 4, len(second) - 8, len(second) - 1):
+        result = frames(pcapngframes, first + second[:-cut])
+        assert [frame for received, linktype, frame in result] == [b"frame one"]
+
+
+def test_readcapture(tmp_path):
+    "Test file type detection and an empty file"
+    (tmp_path / "a.pcap").write_bytes(pcap())
+    (tmp_path / "a.pcapng").write_bytes(pcapng())
+    (tmp_path / "empty.pcap").write_bytes(b"")
+    assert [bytes(frame) for received, linktype, frame in readcapture(tmp_path / "a.pcap")] == [frame for sec, frac, frame in FRAMES]
+    assert [bytes(frame) for received, linktype, frame in readcapture(tmp_path / "a.pcapng")] == [frame for sec, frac, frame in FRAMES]
+    assert list(readcapture(tmp_path / "empty.pcap")) == []
+
+
+def replayconf(files=(), **sinks):
+    conf = types.SimpleNamespace(replayfiles=list(files), verbose=False, metricsint=0, mqttsink=None, ifsink=None,
+                                 extensions=None, mqttqueue=1000, ifqueue=1000, extqueue=1000)
+    conf.__dict__.update(sinks)
+    return conf
+
+
+def test_replay_linktypes(tmp_path):
+    "Test that frames of other link types get an ethernet header, unknown link types are skipped"
+    ip = b"\x45" + bytes(19)
+    sll = bytes(14) + b"\x08\x00" + ip
+    sll2 = b"\x08\x00" + bytes(18) + ip
+    for name, linktype, frame in (("eth", 1, ETHERNET_IPV4 + ip), ("raw", 101, ip), ("raw228", 228, ip), ("sll", 113, sll),
+                                  ("sll2", 276, sll2), ("other", 147, ip)):
+        (tmp_path / name).write_bytes(pcap(linktype=linktype, frames=[(1, 0, frame)]))
+    replay = Replay(replayconf(sorted(str(path) for path in tmp_path.iterdir())))
+    result = [bytes(frame) for frame in replay.frames()]
+    assert result == [ETHERNET_IPV4 + ip] * 5
+    assert replay.stats["frames"] == 6 and replay.stats["skipped"] == 1 and replay.stats["files"] == 6
+    assert replay.received == 1
+
+
+def test_replay_unreadable(tmp_path, capsys):
+    "Test that a file that is not a capture is reported and skipped"
+    (tmp_path / "text.pcap").write_bytes(SHORT * 3)
+    replay = Replay(replayconf([str(tmp_path / "text.pcap"), str(tmp_path / "missing.pcap")]))
+    assert list(replay.frames()) == []
+    assert capsys.readouterr().out.count("can not be read") == 2
+
+
+class Sink:
+    "Output with a queue that does not empty (pending) and a connected state"
+
+    def __init__(self, pending, connected=True):
+        self.left = pending
+        self.backoff = 0
+        self.connected = threading.Event()
+        if connected: self.connected.set()
+
+    def pending(self):
+        return self.left
+
+
+def test_replay_throttle_progress():
+    "Test that throttle waits while an output makes progress"
+    sink = Sink(900)
+    replay = Replay(replayconf(extensions=sink))
+
+    def drain():
+        while sink.left > 400:
+            sink.left -= 50
+            threading.Event().wait(0.02)
+    worker = threading.Thread(target=drain)
+    worker.start()
+    replay.throttle(timeout=1)
+    worker.join()
+    assert sink.left <= 500
+    assert not replay.stalled
+
+
+def test_replay_throttle_stalled(capsys):
+    "Test that throttle gives up on outputs without progress and does not wait again"
+    replay = Replay(replayconf(ifsink=Sink(900)))
+    replay.throttle(timeout=0.1)
+    assert replay.stalled
+    assert "not emptied in 0.1 seconds" in capsys.readouterr().out
+    replay.throttle(timeout=10)
+
+
+def test_replay_throttle_disconnected():
+    "Test that a disconnected MQTT client or an InfluxDB writer in backoff is not waited for"
+    influx = Sink(900)
+    influx.backoff = 5
+    replay = Replay(replayconf(mqttsink=Sink(900, connected=False), ifsink=influx))
+    assert replay.busy() == []
+    replay.throttle(timeout=10)
+    assert not replay.stalled
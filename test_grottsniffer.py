@@ -0,0 +1,285 @@
+import mmap
+import socket
+import struct
+import time
+
+import pytest
+
+import grottsniffer
+from grottsniffer import (GrottFlow, GrottRing, RING_BLOCKSIZE, TP_STATUS_KERNEL, TP_STATUS_USER, attach_filter, bpf_program,
+                          flowstats)
+from test_grottprotocol import RECORD, SHORT
+
+# stream of three records, segments are cut from it
+STREAM = RECORD + SHORT + RECORD
+
+
+def segments(seq, *cuts):
+    "TCP segments (sequence number, data) of STREAM cut at the positions"
+    bounds = [0] + list(cuts) + [len(STREAM)]
+    return [((seq + start) % 0x100000000, STREAM[start:end]) for start, end in zip(bounds, bounds[1:])]
+
+
+def feedall(flow, segs):
+    "Feed segments, returns the records (as bytes) and the flowstats changes"
+    before = dict(flowstats)
+    records = []
+    for seq, data in segs:
+        records.extend(bytes(record) for record in flow.feed(seq, data))
+    return records, {key: flowstats[key] - before[key] for key in flowstats}
+
+
+def test_flow_inorder():
+    "Test that in order segments give the records"
+    flow = GrottFlow(1000)
+    records, stats = feedall(flow, segments(1000, 100, 270, 400))
+    assert records == [RECORD, SHORT, RECORD]
+    assert stats["reordered"] == stats["duplicate"] == stats["gaps"] == 0
+    assert flow.next == 1000 + len(STREAM)
+
+
+def test_flow_joined():
+    "Test that a flow without known sequence number starts at the first segment"
+    flow = GrottFlow()
+    records, stats = feedall(flow, segments(5, 100)[1:])
+    assert flow.next == 5 + len(STREAM)
+    # the first record is cut, the framer resyncs on the next record
+    assert records == [SHORT, RECORD]
+
+
+def test_flow_reorder():
+    "Test that out of order segments are kept till the hole is filled"
+    flow = GrottFlow(1000)
+    first, second, third, fourth = segments(1000, 100, 270, 400)
+    records, stats = feedall(flow, [first, fourth, third])
+    assert records == []
+    assert stats["reordered"] == 2
+    assert flow.pendingsize == len(third[1]) + len(fourth[1])
+    assert flow.gapsince is not None
+    records, stats = feedall(flow, [second])
+    assert records == [RECORD, SHORT, RECORD]
+    assert not flow.pending and flow.pendingsize == 0
+    assert flow.gapsince is None
+
+
+def test_flow_duplicate():
+    "Test that retransmitted segments are dropped and overlapping segments are trimmed"
+    flow = GrottFlow(1000)
+    first, second = segments(1000, 100)
+    records, stats = feedall(flow, [first, first, (1050, STREAM[50:100])])
+    assert stats["duplicate"] == 2
+    # overlap: segment starting before the next expected byte
+    records, stats = feedall(flow, [(1080, STREAM[80:])])
+    assert records == [RECORD, SHORT, RECORD]
+    assert stats["duplicate"] == 0
+
+
+def test_flow_pending_duplicate():
+    "Test that an out of order segment received twice is kept once"
+    flow = GrottFlow(1000)
+    first, second, third = segments(1000, 100, 270)
+    feedall(flow, [first, third, third])
+    assert flow.pendingsize == len(third[1])
+    records, stats = feedall(flow, [second])
+    assert records == [RECORD, SHORT, RECORD]
+
+
+def test_flow_gap_timeout():
+    "Test that a hole not filled in time is skipped, the record cut by the hole is lost"
+    flow = GrottFlow(1000)
+    first, second, third = segments(1000, 100, len(RECORD) + len(SHORT))
+    records, stats = feedall(flow, [first, third])
+    assert records == []
+    gaps = flowstats["gaps"]
+    records = []
+    flow.checkgap(flow.gapsince + grottsniffer.FLOW_GAPTIMEOUT - 0.1, records)
+    assert records == [] and flow.pending
+    flow.checkgap(flow.gapsince + grottsniffer.FLOW_GAPTIMEOUT, records)
+    assert [bytes(record) for record in records] == [RECORD]
+    assert not flow.pending
+    assert flowstats["gaps"] == gaps + 1
+    assert flow.next == 1000 + len(STREAM)
+
+
+def test_flow_gap_buffer(monkeypatch):
+    "Test that a hole is skipped if the out of order data does not fit in the buffer"
+    monkeypatch.setattr(grottsniffer, "FLOW_BUFFER", 100)
+    flow = GrottFlow(1000)
+    first, second, third = segments(1000, 100, len(RECORD) + len(SHORT))
+    records, stats = feedall(flow, [first, third])
+    assert stats["gaps"] == 1
+    assert records == [RECORD]
+
+
+@pytest.mark.parametrize("start", [0xFFFFFFFF - 150, 0xFFFFFFFF, 0xFFFFFFFF - len(STREAM) + 1])
+def test_flow_wraparound(start):
+    "Test reordering and duplicates around the sequence number wrap"
+    flow = GrottFlow(start)
+    first, second, third, fourth = segments(start, 100, 270, 400)
+    records, stats = feedall(flow, [first, third, fourth, first, second])
+    assert records == [RECORD, SHORT, RECORD]
+    assert stats["duplicate"] == 1 and stats["reordered"] == 2
+    assert flow.next == (start + len(STREAM)) % 0x100000000
+
+
+def test_flow_seen():
+    "Test that feed updates the last seen time (idle flow removal)"
+    flow = GrottFlow(0)
+    flow.seen = 0
+    flow.feed(0, SHORT)
+    assert flow.seen > time.monotonic() - 10
+
+
+# tcpdump -dd style program for 192.168.1.10 port 5279 (code, jt, jf, k)
+BPF_GROWATT = [
+    (0x28, 0, 0, 0x0000000c),
+    (0x15, 0, 10, 0x00000800),
+    (0x30, 0, 0, 0x00000017),
+    (0x15, 0, 8, 0x00000006),
+    (0x20, 0, 0, 0x0000001e),
+    (0x15, 0, 6, 0xc0a8010a),
+    (0x28, 0, 0, 0x00000014),
+    (0x45, 4, 0, 0x00001fff),
+    (0xb1, 0, 0, 0x0000000e),
+    (0x48, 0, 0, 0x00000010),
+    (0x15, 0, 1, 0x0000149f),
+    (0x06, 0, 0, 0x00040000),
+    (0x06, 0, 0, 0x00000000),
+]
+
+
+def runbpf(program, frame):
+    "Run a classic BPF program (the instructions used by bpf_program) on a frame, returns the accepted length"
+    instructions = [struct.unpack_from("HBBI", program, offset) for offset in range(0, len(program), 8)]
+    a = x = pc = 0
+    while True:
+        code, jt, jf, k = instructions[pc]
+        pc += 1
+        try:
+            if code == 0x28:
+                a = struct.unpack_from("!H", frame, k)[0]
+            elif code == 0x30:
+                a = frame[k]
+            elif code == 0x20:
+                a = struct.unpack_from("!I", frame, k)[0]
+            elif code == 0xb1:
+                x = 4 * (frame[k] & 0xf)
+            elif code == 0x48:
+                a = struct.unpack_from("!H", frame, x + k)[0]
+            elif code == 0x15:
+                pc += jt if a == k else jf
+            elif code == 0x45:
+                pc += jt if a & k else jf
+            elif code == 0x06:
+                return k
+            else:
+                raise ValueError("instruction not supported: %#x" % code)
+        except (IndexError, struct.error):
+            # load outside the frame: rejected
+            return 0
+
+
+def frame(dst="192.168.1.10", dport=5279, protocol=6, ethertype=0x0800, fragment=0, options=b""):
+    "Ethernet frame with an IPv4 header and a TCP header"
+    ip = struct.pack("!BBHHHBBH4s4s", 0x45 + len(options) // 4, 0, 20 + len(options) + 20, 1, fragment, 64, protocol, 0,
+                     socket.inet_aton("192.168.1.20"), socket.inet_aton(dst)) + options
+    tcp = struct.pack("!HHIIBBHHH", 5279 if dport != 5279 else 40000, dport, 1, 0, 0x50, 0x18, 1024, 0, 0)
+    return struct.pack("!6s6sH", bytes(6), bytes(6), ethertype) + ip + tcp
+
+
+def test_bpf_program():
+    "Test the kernel filter program against the known-good program for a host and port"
+    assert bpf_program("192.168.1.10", 5279) == b"".join(struct.pack("HBBI", *instruction) for instruction in BPF_GROWATT)
+    assert len(bpf_program("10.0.0.1", 80)) == 13 * 8
+
+
+@pytest.mark.parametrize("packet, accepted", [
+    (frame(), True),
+    (frame(options=bytes(8)), True),
+    # first fragment (more fragments flag): has the TCP header
+    (frame(fragment=0x2000), True),
+    (frame(fragment=0x2000 + 185), False),
+    (frame(dport=5280), False),
+    (frame(dst="192.168.1.11"), False),
+    (frame(protocol=17), False),
+    (frame(ethertype=0x86dd), False),
+    (frame()[:36], False),
+], ids=["match", "ipoptions", "firstfragment", "fragment", "port", "ip", "udp", "ipv6", "short"])
+def test_bpf_filter(packet, accepted):
+    "Test that the program passes only (complete) TCP segments to the Growatt server ip and port"
+    assert runbpf(bpf_program("192.168.1.10", 5279), packet) == (0x40000 if accepted else 0)
+
+
+def test_bpf_attach():
+    "Test that the kernel accepts the program (checked when attached, also on a non packet socket)"
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        attach_filter(sock, bpf_program("192.168.1.10", 5279))
+    finally:
+        sock.close()
+
+
+def ringblock(ring, block, packets, status=TP_STATUS_USER):
+    "Fill a ring block as the kernel does: block descriptor and the packets (tpacket3_hdr, frame at the mac offset)"
+    offset = block * RING_BLOCKSIZE
+    first, mac = 48, 80
+    pos = offset + first
+    for i, packet in enumerate(packets):
+        nextoffset = (mac + len(packet) + 15) // 16 * 16 if i < len(packets) - 1 else 0
+        struct.pack_into("IIIIIIHH", ring, pos, nextoffset, 1000, 0, len(packet), len(packet), TP_STATUS_USER, mac, mac + 14)
+        ring[pos + mac:pos + mac + len(packet)] = packet
+        pos += nextoffset
+    # struct tpacket_block_desc: version, offset to priv, block status, number of packets, offset to first packet
+    struct.pack_into("IIIII", ring, offset, 1, 0, status, len(packets), first)
+
+
+class Poll:
+    "poll stand-in: the kernel fills the next block while grott waits"
+
+    def __init__(self, ring, fills):
+        self.ring = ring
+        self.fills = fills
+
+    def poll(self, timeout):
+        if not self.fills:
+            raise TimeoutError("no more blocks")
+        ringblock(self.ring, *self.fills.pop(0))
+
+
+def mapring(blocks, fills=()):
+    "GrottRing on an anonymous mmap (no packet socket)"
+    ring = GrottRing.__new__(GrottRing)
+    ring.blocks = blocks
+    ring.ring = mmap.mmap(-1, RING_BLOCKSIZE * blocks)
+    ring.view = memoryview(ring.ring)
+    ring.poll = Poll(ring.ring, list(fills))
+    return ring
+
+
+def test_ring_frames():
+    "Test that the frames of a TPACKET_V3 block are read in order and the block is returned to the kernel"
+    packets = [frame(), frame(dport=5280) + RECORD, frame(options=bytes(4)) + SHORT]
+    ring = mapring(2)
+    ringblock(ring.ring, 0, packets)
+    frames = ring.frames()
+    assert [bytes(next(frames)) for packet in packets] == packets
+    # block 1 not filled yet: grott waits (poll), the kernel fills it
+    ring.poll.fills = [(1, [RECORD])]
+    assert bytes(next(frames)) == RECORD
+    assert struct.unpack_from("I", ring.ring, 8)[0] == TP_STATUS_KERNEL
+    # ring wraps to block 0
+    ring.poll.fills = [(0, [SHORT, SHORT])]
+    assert [bytes(next(frames)), bytes(next(frames))] == [SHORT, SHORT]
+    assert struct.unpack_from("I", ring.ring, RING_BLOCKSIZE + 8)[0] == TP_STATUS_KERNEL
+
+
+def test_ring_wait():
+    "Test that a block still owned by the kernel (or empty) is not read"
+    ring = mapring(2, [(0, [], TP_STATUS_KERNEL), (0, [])])
+    ring.poll.fills.append((1, [SHORT]))
+    frames = ring.frames()
+    # empty block skipped, frame of the next block
+    assert bytes(next(frames)) == SHORT
+    assert not ring.poll.fills
+    with pytest.raises(TimeoutError):
+        next(frames)
@@ -0,0 +1,103 @@
+import os
+import socket
+import time
+import types
+
+from grottspool import GrottSpool, SPOOLHEADER
+from test_grottprotocol import RECORD, SHORT
+
+
+def spoolconf(path, port, **settings):
+    conf = types.SimpleNamespace(spoolfile=str(path / "grottspool.dat"), spoolrate=1000, spoolretry=60, growattip="127.0.0.1",
+                                 growattport=port, growatttimeout=2, verbose=False)
+    conf.__dict__.update(settings)
+    return conf
+
+
+def receive(upstream, connections, timeout=5):
+    "Accept the replay connections, returns the data received per connection (till closed)"
+    upstream.settimeout(timeout)
+    data = []
+    for i in range(connections):
+        conn, addr = upstream.accept()
+        conn.settimeout(timeout)
+        received = b""
+        while True:
+            chunk = conn.recv(4096)
+            if not chunk:
+                break
+            received += chunk
+        conn.close()
+        data.append(received)
+    return data
+
+
+def writespool(conf, records):
+    "Spool file with (session, record) entries"
+    with open(conf.spoolfile, "wb") as spoolfile:
+        for session, data in records:
+            spoolfile.write(SPOOLHEADER.pack(0, session, len(data)) + data)
+
+
+def wait(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_spool_replay(tmp_path):
+    "Test that spooled records are replayed in order, one connection per datalogger session, and the spool is emptied"
+    upstream = socket.socket()
+    upstream.bind(("127.0.0.1", 0))
+    upstream.listen(5)
+    conf = spoolconf(tmp_path, upstream.getsockname()[1])
+    # records spooled before the replay starts (a replay in between would open a new connection)
+    writespool(conf, [(1, RECORD), (1, SHORT), (2, SHORT)])
+    spool = GrottSpool(conf)
+    assert receive(upstream, 2) == [RECORD + SHORT, SHORT]
+    assert wait(lambda: os.path.getsize(conf.spoolfile) == 0)
+    assert spool.readpos() == 0
+    upstream.close()
+
+
+def test_spool_unreachable(tmp_path):
+    "Test that records stay spooled while the Growatt server is not reachable and are replayed after a restart"
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    conf = spoolconf(tmp_path, port)
+    spool = GrottSpool(conf)
+    spool.append(1, RECORD)
+    spool.append(1, SHORT)
+    # replay attempt failed, next attempt after spoolretry
+    time.sleep(0.2)
+    assert spool.readpos() == 0
+    assert os.path.getsize(conf.spoolfile) == 2 * SPOOLHEADER.size + len(RECORD) + len(SHORT)
+
+    # grott restarted, Growatt server reachable again
+    upstream = socket.socket()
+    upstream.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    upstream.bind(("127.0.0.1", port))
+    upstream.listen(5)
+    GrottSpool(conf)
+    assert receive(upstream, 1) == [RECORD + SHORT]
+    assert wait(lambda: os.path.getsize(conf.spoolfile) == 0)
+    upstream.close()
+
+
+def test_spool_position(tmp_path):
+    "Test that a restart continues the replay at the saved position"
+    conf = spoolconf(tmp_path, 0)
+    writespool(conf, [(1, RECORD), (1, SHORT)])
+    with open(conf.spoolfile + ".pos", "w") as posfile:
+        posfile.write(str(SPOOLHEADER.size + len(RECORD)))
+
+    upstream = socket.socket()
+    upstream.bind(("127.0.0.1", 0))
+    upstream.listen(5)
+    conf.growattport = upstream.getsockname()[1]
+    GrottSpool(conf)
+    assert receive(upstream, 1) == [SHORT]
+    upstream.close()
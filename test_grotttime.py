@@ -0,0 +1,71 @@
+import calendar
+
+import pytest
+
+import grotttime
+from grotttime import GrottTimezone
+
+
+@pytest.fixture(params=["zoneinfo", "pytz"])
+def timezone(request, monkeypatch):
+    "GrottTimezone factory for the zoneinfo and the pytz backend"
+    if request.param == "pytz":
+        if grotttime.pytz is None:
+            pytest.skip("pytz not installed")
+        monkeypatch.setattr(grotttime, "zoneinfo", None)
+    elif grotttime.zoneinfo is None:
+        pytest.skip("zoneinfo not available")
+
+    def make(name):
+        tz = GrottTimezone(name)
+        if tz.name != name:
+            pytest.skip("timezone database not installed")
+        return tz
+    return make
+
+
+@pytest.mark.parametrize("date, offset", [
+    ((2021, 1, 15, 12, 0, 0), 3600),
+    ((2021, 7, 1, 12, 0, 0), 7200),
+    # DST start: 02:00-03:00 does not exist, offset before the transition
+    ((2021, 3, 28, 1, 59, 59), 3600),
+    ((2021, 3, 28, 2, 30, 0), 3600),
+    ((2021, 3, 28, 3, 0, 0), 7200),
+    # DST end: 02:00-03:00 twice, offset before the transition
+    ((2021, 10, 31, 1, 59, 59), 7200),
+    ((2021, 10, 31, 2, 30, 0), 7200),
+    ((2021, 10, 31, 3, 0, 0), 3600),
+])
+def test_utcoffset(timezone, date, offset):
+    "Test the UTC offset around the DST transitions, the same for both backends"
+    tz = timezone("Europe/Amsterdam")
+    assert tz.utcoffset(*date) == offset
+    assert tz.epoch(*date) == calendar.timegm(date) - offset
+
+
+def test_epoch_cache(timezone):
+    "Test that the offset is cached per day, except for days with a DST transition"
+    tz = timezone("Europe/Amsterdam")
+    tz.epoch(2021, 7, 1, 12, 0, 0)
+    tz.epoch(2021, 10, 31, 2, 30, 0)
+    assert tz.offsets == {(2021, 7, 1): 7200}
+    # DST day: converted per time
+    assert tz.epoch(2021, 10, 31, 0, 0, 0) == calendar.timegm((2021, 10, 31, 0, 0, 0)) - 7200
+    assert tz.epoch(2021, 10, 31, 12, 0, 0) == calendar.timegm((2021, 10, 31, 12, 0, 0)) - 3600
+
+
+def test_southern(timezone):
+    "Test a southern hemisphere timezone (DST from october till april)"
+    tz = timezone("Australia/Sydney")
+    assert tz.utcoffset(2021, 1, 15, 12, 0, 0) == 39600
+    # DST end 2021-04-04 03:00 -> 02:00, 02:30 twice
+    assert tz.utcoffset(2021, 4, 4, 2, 30, 0) == 39600
+    # DST start 2021-10-03 02:00 -> 03:00, 02:30 does not exist
+    assert tz.utcoffset(2021, 10, 3, 2, 30, 0) == 36000
+
+
+def test_unknown_timezone(capsys):
+    "Test that an unknown timezone falls back to the local timezone"
+    tz = GrottTimezone("Nowhere/Unknown")
+    assert tz.name == "local" and tz.tz is None
+    assert "unknown timezone" in capsys.readouterr().out
@@ -0,0 +1,137 @@
+import queue
+import threading
+import time
+import types
+import zlib
+
+import pytest
+
+import grottconf
+import grottdata
+from grottworker import GrottProcPool, GrottPvOutputForward, work
+from test_grottprotocol import RECORD
+
+
+class Process:
+    "Worker process stand-in (not started)"
+
+    def __init__(self):
+        self.pid = 0
+        self.exitcode = None
+
+    def is_alive(self):
+        return True
+
+    def join(self, timeout=None):
+        pass
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    "Worker pool factory, worker processes are not started"
+    monkeypatch.setattr(GrottProcPool, "start", lambda self, index: self.processes.__setitem__(index, Process()))
+    pools = []
+
+    def make(workers, **settings):
+        conf = types.SimpleNamespace(procprocesses=workers, procqueue=100, procdrop="block", pvsink=None, verrel="test",
+                                     verbose=False)
+        conf.__dict__.update(settings)
+        pools.append(GrottProcPool(conf))
+        return pools[-1]
+    yield make
+    for procpool in pools:
+        procpool.stopped = True
+        # wake up the collect thread, so it ends before the report queue is closed
+        procpool.reports.put(("stats", 0, {}))
+    for thread in threading.enumerate():
+        if thread.name == "grottprocpool":
+            thread.join(5)
+
+
+def plainrecord(serial, value):
+    "Protocol 02 (not scrambled) data record"
+    return bytes.fromhex("00010002001a0104") + serial + bytes([value]) * 10
+
+
+def queued(procpool):
+    "Records queued per worker"
+    records = []
+    for index, workqueue in enumerate(procpool.queues):
+        items = []
+        while True:
+            try:
+                items.append(workqueue.get(timeout=0.5)[0])
+            except queue.Empty:
+                break
+        records.append(items)
+    return records
+
+
+def test_shard_serial(pool):
+    "Test that the records of a datalogger are handed to one worker (crc32 of the serial), in order"
+    procpool = pool(3)
+    serials = [b"DLG000000" + bytes([ord("A") + i]) for i in range(8)]
+    for value in range(3):
+        for serial in serials:
+            procpool.put(memoryview(plainrecord(serial, value)))
+    records = queued(procpool)
+    for serial in serials:
+        index = zlib.crc32(serial) % 3
+        assert [record[18] for record in records[index] if record[8:18] == serial] == [0, 1, 2]
+        assert not any(record[8:18] == serial for other in records if other is not records[index] for record in other)
+    # serials are spread over the workers
+    assert all(records)
+
+
+def test_shard_scrambled(pool):
+    "Test that scrambled records of a datalogger (same serial, other data) go to the same worker"
+    procpool = pool(4)
+    other = RECORD[:18] + bytes(len(RECORD) - 20) + RECORD[-2:]
+    assert procpool.shard(RECORD) == procpool.shard(other) == zlib.crc32(RECORD[8:18]) % 4
+
+
+class PvSink:
+    "PVOutput sender stand-in of the main process"
+
+    def __init__(self):
+        self.statuses = []
+
+    def add(self, systemid, kind, status, serial=None):
+        self.statuses.append((systemid, kind, status, serial))
+
+
+def test_pvoutput_shared(pool, monkeypatch):
+    "Test that the PVOutput statuses of all workers are sent by the one PVOutput sender of the main process"
+    sink = PvSink()
+    procpool = pool(2, pvsink=sink)
+
+    def conf(verrel, worker=None):
+        # worker configuration: no PVOutput sender of its own
+        return types.SimpleNamespace(pvoutput=True, pvsink=None, ifsink=None, mqttsink=None, verbose=False,
+                                     freeze=lambda: None, worker=worker)
+
+    sinks = []
+
+    def procdata(conf, data):
+        sinks.append(type(conf.pvsink))
+        conf.pvsink.add("12345", "status", {"d": "20210209", "t": "12:00", "v2": data[18]}, "INV" + str(conf.worker))
+    monkeypatch.setattr(grottconf, "Conf", conf)
+    monkeypatch.setattr(grottdata, "procdata", procdata)
+
+    workers = []
+    for index in range(2):
+        records = queue.Queue()
+        records.put((plainrecord(b"DLG0000000", index), None))
+        records.put(None)
+        workers.append(threading.Thread(target=work, args=("test", index, records, procpool.reports)))
+        workers[-1].start()
+    for worker in workers:
+        worker.join(5)
+    deadline = time.monotonic() + 5
+    while len(sink.statuses) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert sorted(sink.statuses, key=lambda status: status[3]) == [
+        ("12345", "status", {"d": "20210209", "t": "12:00", "v2": 0}, "INV0"),
+        ("12345", "status", {"d": "20210209", "t": "12:00", "v2": 1}, "INV1"),
+    ]
+    assert sinks == [GrottPvOutputForward, GrottPvOutputForward]